@@ -0,0 +1,166 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import warnings
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+# RadTA modules are flat scripts in radta/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "radta"))
+from synthetic import generate_cohort
+from instrument import get_peak_rss
+
+#-----------------------------------------------------#
+#                  Benchmark Stages                   #
+#-----------------------------------------------------#
+# Stages in pipeline order (each one runs in a fresh process)
+STAGES = ["process_xlsx", "process_parquet", "run_eval", "plot_summary"]
+
+def run_stage(stage, path_out, boa_pairs, chunk_size=None):
+    # Import RadTA modules before measuring (baseline memory of the process)
+    warnings.simplefilter("ignore")
+    import pandas as pd
+    from scheduler import store_pair_tables
+    from process import process_boa_cohort
+    from evaluate import run_eval, find_table, read_table
+    from plot import plot_summary
+    from render import RENDER_REGISTRY
+    path_eval = os.path.join(path_out, "evaluation")
+    if stage == "plot_summary":
+        dt_eval = read_table(find_table(path_eval, "evaluation_table"))
+        path_registry = os.path.join(path_eval, RENDER_REGISTRY)
+        if os.path.exists(path_registry) : os.remove(path_registry)
+    rss_base = get_peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    # First processing parses the Excel workbooks, later ones the columnar cache
+    if stage in ["process_xlsx", "process_parquet"]:
+        rt_cohort, _ = process_boa_cohort(boa_pairs)
+        store_pair_tables(rt_cohort, path_out)
+    # Complete evaluation from the stored radiomics tables
+    elif stage == "run_eval" : run_eval(path_out, analysis=False,
+                                        chunk_size=chunk_size)
+    # Rendering of the summary heatmaps only
+    elif stage == "plot_summary" : plot_summary(dt_eval, path_eval)
+    # Return measurements
+    return {"wall_s": time.perf_counter() - wall_start,
+            "cpu_s": time.process_time() - cpu_start,
+            "rss_base_bytes": rss_base,
+            "peak_rss_bytes": get_peak_rss()}
+
+def run_scale(n_pairs, path_work, n_unique, stages, chunk_size=None):
+    # Generate synthetic BOA outputs for all volume-pairs
+    path_out = os.path.join(path_work, "pairs_" + str(n_pairs))
+    if os.path.exists(path_out) : shutil.rmtree(path_out)
+    time_start = time.perf_counter()
+    boa_pairs = generate_cohort(path_out, n_pairs, n_unique)
+    print("Generated " + str(n_pairs) + " volume-pairs in " + \
+          "%.1fs" % (time.perf_counter() - time_start))
+    # Later stages require the outputs of earlier ones (run them untimed)
+    required = set(stages)
+    if "process_parquet" in required : required.add("process_xlsx")
+    if "run_eval" in required or "plot_summary" in required:
+        required.add("process_xlsx")
+    if "plot_summary" in required : required.add("run_eval")
+    # Run each stage in a fresh process for isolated peak memory
+    results = {}
+    for stage in STAGES:
+        if stage not in required : continue
+        with ProcessPoolExecutor(max_workers=1,
+                                 mp_context=mp.get_context("spawn")) as pool:
+            res = pool.submit(run_stage, stage, path_out, boa_pairs,
+                              chunk_size).result()
+        if stage not in stages : continue
+        res["pairs_per_s"] = n_pairs / res["wall_s"]
+        results[stage] = res
+        print_result(n_pairs, stage, res)
+    shutil.rmtree(path_out)
+    return results
+
+#-----------------------------------------------------#
+#                  Result Reporting                   #
+#-----------------------------------------------------#
+def print_result(n_pairs, stage, res, baseline=None):
+    line = "%8d pairs  %-16s wall %9.2fs  cpu %9.2fs  %10.1f pairs/s  " % \
+           (n_pairs, stage, res["wall_s"], res["cpu_s"], res["pairs_per_s"]) + \
+           "peak %8.1f MB (+%.1f MB)" % (res["peak_rss_bytes"] / 1024**2,
+           (res["peak_rss_bytes"] - res["rss_base_bytes"]) / 1024**2)
+    if baseline is not None : line += "  speedup %.2fx" % \
+                                      (baseline["wall_s"] / res["wall_s"])
+    print(line)
+
+def compare_results(results, baseline):
+    # Compare wall time against a stored baseline run
+    print("Comparison with baseline:")
+    for scale, res_scale in results.items():
+        for stage, res in res_scale.items():
+            base = baseline.get(scale, {}).get(stage)
+            if base is None : continue
+            print_result(int(scale), stage, res, base)
+
+#-----------------------------------------------------#
+#                     Entry Point                     #
+#-----------------------------------------------------#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RadTA: Offline benchmark " + \
+                                     "of processing and evaluation")
+    parser.add_argument("-n", "--scales", type=int, nargs="+",
+                        default=[10, 1000, 100000],
+                        help="Numbers of volume-pairs to benchmark", dest="scales")
+    parser.add_argument("-s", "--stages", type=str, nargs="+",
+                        choices=STAGES, default=STAGES,
+                        help="Stages to benchmark", dest="stages")
+    parser.add_argument("-u", "--unique", type=int, default=100,
+                        help="Number of distinct synthetic volume-pairs", dest="n_unique")
+    parser.add_argument("-c", "--chunk_size", type=int, default=None,
+                        help="Evaluate out-of-core in chunks of volume-pairs", dest="chunk_size")
+    parser.add_argument("-w", "--workdir", type=str, default=None,
+                        help="Working directory for synthetic outputs", dest="path_work")
+    parser.add_argument("--save", type=str, default=None,
+                        help="Store results as JSON (e.g. as baseline)", dest="path_save")
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="Compare results against a stored JSON", dest="path_baseline")
+    args = parser.parse_args()
+
+    # Run benchmark for each scale
+    path_work = args.path_work or tempfile.mkdtemp(prefix="radta_bench_")
+    results = {}
+    for n_pairs in args.scales:
+        results[str(n_pairs)] = run_scale(n_pairs, path_work, args.n_unique,
+                                          args.stages, args.chunk_size)
+    if args.path_work is None : shutil.rmtree(path_work)
+
+    # Store and compare results
+    if args.path_save is not None:
+        with open(args.path_save, "w") as fh : json.dump(results, fh, indent=2)
+    if args.path_baseline is not None:
+        with open(args.path_baseline, "r") as fh : baseline = json.load(fh)
+        compare_results(results, baseline)
\ No newline at end of file
@@ -0,0 +1,194 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+#-----------------------------------------------------#
+#              BOA Outcome Configuration              #
+#-----------------------------------------------------#
+# Sheets of the BOA outcome Excel (as used by RadTA)
+SHEET_BCA = "bca-aggregated_measurements"
+SHEET_TS = "regions-statistics"
+# Body regions, aggregations and tissues of the BCA sheet
+BCA_REGIONS = ["Whole Scan", "Abdominal Cavity", "Thoracic Cavity",
+               "Ventral Cavity", "Mediastinum", "Pericardium"] + \
+              ["L" + str(i) for i in range(5, 0, -1)] + \
+              ["T" + str(i) for i in range(12, 0, -1)] + \
+              ["C" + str(i) for i in range(7, 0, -1)]
+BCA_AGGREGATIONS = ["Mean_mL", "Std_mL", "Min_mL", "Q1_mL", "Q2_mL",
+                    "Q3_mL", "Max_mL", "Sum_mL", "Mean_HU"]
+BCA_TISSUES = ["Bone", "Muscle", "IMAT", "SAT", "VAT", "PAT", "EAT", "TAT"]
+# Anatomical structures of the TotalSegmentator 'total' model
+TS_REGIONS = ["spleen", "kidney_right", "kidney_left", "gallbladder", "liver",
+              "stomach", "pancreas", "adrenal_gland_right", "adrenal_gland_left",
+              "lung_upper_lobe_left", "lung_lower_lobe_left",
+              "lung_upper_lobe_right", "lung_middle_lobe_right",
+              "lung_lower_lobe_right", "esophagus", "trachea", "thyroid_gland",
+              "small_bowel", "duodenum", "colon", "urinary_bladder", "prostate",
+              "sacrum", "heart", "aorta", "pulmonary_vein",
+              "brachiocephalic_trunk", "superior_vena_cava",
+              "inferior_vena_cava", "portal_vein_and_splenic_vein",
+              "spinal_cord", "brain", "skull", "sternum", "costal_cartilages"] + \
+             ["vertebrae_" + v for v in ["S1", "L5", "L4", "L3", "L2", "L1"] + \
+              ["T" + str(i) for i in range(12, 0, -1)] + \
+              ["C" + str(i) for i in range(7, 0, -1)]] + \
+             [s + "_" + side for s in ["humerus", "scapula", "clavicula", "femur",
+                                       "hip", "gluteus_maximus", "gluteus_medius",
+                                       "gluteus_minimus", "autochthon", "iliopsoas",
+                                       "iliac_artery", "iliac_vena"] \
+              for side in ["left", "right"]] + \
+             ["rib_" + side + "_" + str(i) for side in ["left", "right"] \
+              for i in range(1, 13)]
+# Additional models without any segmented structure
+TS_MODELS_ABSENT = ["lung_vessels", "body"]
+
+def convert_name(name):
+    # BOA naming scheme (e.g. "kidney_left" -> "KidneyLeft")
+    return "".join(s.capitalize() for s in name.lower().replace(" ", "_").split("_"))
+
+#-----------------------------------------------------#
+#                  Synthetic Sheets                   #
+#-----------------------------------------------------#
+def generate_bca(rng, present, scale):
+    # BCA aggregations for each body region (with and without extremities)
+    rows = []
+    for region, is_present in zip(BCA_REGIONS, present):
+        for suffix in ["", "_NoExtremities"]:
+            name = convert_name(region) + suffix
+            if not is_present:
+                rows.append({"BodyPart": name, "Present": False})
+                continue
+            for aggtype in BCA_AGGREGATIONS:
+                row = {"BodyPart": name, "Present": True,
+                       "AggregationType": aggtype}
+                for i, tissue in enumerate(BCA_TISSUES):
+                    if aggtype == "Mean_HU":
+                        row[tissue] = rng.normal(-50 + 40 * i, 15)
+                    else : row[tissue] = rng.gamma(2.0, 40.0) * scale[i]
+                rows.append(row)
+    return pd.DataFrame(rows, columns=["BodyPart", "Present",
+                                       "AggregationType"] + BCA_TISSUES)
+
+def generate_ts(rng, present, scale):
+    # Region statistics of the TotalSegmentator structures
+    rows = []
+    for region, is_present, s in zip(TS_REGIONS, present, scale):
+        if not is_present:
+            rows.append({"ModelName": "Total", "BodyRegion": convert_name(region),
+                         "Present": False})
+            continue
+        hu = np.sort(rng.normal(40 * s, 25, 64))
+        rows.append({"ModelName": "Total",
+                     "BodyRegion": convert_name(region),
+                     "Present": True,
+                     "VolumeMl": rng.gamma(4.0, 60.0) * s,
+                     "MeanHU": hu.mean(), "StdHU": hu.std(),
+                     "MinHU": hu[0], "MedianHU": np.median(hu), "MaxHU": hu[-1],
+                     "25thPercentileHU": np.percentile(hu, 25),
+                     "75thPercentileHU": np.percentile(hu, 75),
+                     "CNR": rng.normal(5, 2)})
+    # Models without segmented structures have no body region
+    for model in TS_MODELS_ABSENT:
+        rows.append({"ModelName": convert_name(model), "Present": False})
+    return pd.DataFrame(rows, columns=["ModelName", "BodyRegion", "Present",
+                                       "VolumeMl", "MeanHU", "StdHU", "MinHU",
+                                       "MedianHU", "MaxHU", "25thPercentileHU",
+                                       "75thPercentileHU", "CNR"])
+
+def generate_pair(seed, p_absent=0.1):
+    # Pre and post sheets of one patient (shared anatomy, changed values)
+    rng = np.random.default_rng(seed)
+    present_bca = rng.random(len(BCA_REGIONS)) >= p_absent
+    present_ts = rng.random(len(TS_REGIONS)) >= p_absent
+    scale_bca = rng.lognormal(0, 0.3, len(BCA_TISSUES))
+    scale_ts = rng.lognormal(0, 0.3, len(TS_REGIONS))
+    sheets = []
+    for change in [1.0, rng.normal(1.02, 0.05)]:
+        # Body parts can disappear from the field of view in a follow-up scan
+        flip_bca = rng.random(len(BCA_REGIONS)) < p_absent / 4
+        flip_ts = rng.random(len(TS_REGIONS)) < p_absent / 4
+        dt_bca = generate_bca(rng, present_bca & ~flip_bca, scale_bca * change)
+        dt_ts = generate_ts(rng, present_ts & ~flip_ts, scale_ts * change)
+        sheets.append((dt_bca, dt_ts))
+    return sheets
+
+#-----------------------------------------------------#
+#                  Synthetic Outputs                  #
+#-----------------------------------------------------#
+def write_workbook(path_xlsx, dt_bca, dt_ts):
+    # Store sheets like a BOA outcome Excel
+    os.makedirs(os.path.dirname(path_xlsx), exist_ok=True)
+    with pd.ExcelWriter(path_xlsx) as writer:
+        dt_bca.to_excel(writer, sheet_name=SHEET_BCA, index=False)
+        dt_ts.to_excel(writer, sheet_name=SHEET_TS, index=False)
+
+def link_workbook(path_src, path_dst):
+    # Reuse a workbook via hard link (copy on file systems without links)
+    os.makedirs(os.path.dirname(path_dst), exist_ok=True)
+    if os.path.exists(path_dst) : os.remove(path_dst)
+    try : os.link(path_src, path_dst)
+    except OSError:
+        with open(path_src, "rb") as fh_src, open(path_dst, "wb") as fh_dst:
+            fh_dst.write(fh_src.read())
+
+def generate_cohort(path_out, n_pairs, n_unique=100, seed=0):
+    # Create BOA output directories for n volume-pairs (<name>.boa.pre/post)
+    boa_pairs = []
+    for i in range(n_pairs):
+        name = "pair" + str(i).zfill(6)
+        path_pre = os.path.join(path_out, name + ".boa.pre", "output.xlsx")
+        path_post = os.path.join(path_out, name + ".boa.post", "output.xlsx")
+        # Only n_unique distinct patients are generated, others are linked
+        if i < n_unique:
+            (pre_bca, pre_ts), (post_bca, post_ts) = generate_pair(seed + i)
+            write_workbook(path_pre, pre_bca, pre_ts)
+            write_workbook(path_post, post_bca, post_ts)
+        else:
+            name_src = "pair" + str(i % n_unique).zfill(6)
+            link_workbook(os.path.join(path_out, name_src + ".boa.pre",
+                                       "output.xlsx"), path_pre)
+            link_workbook(os.path.join(path_out, name_src + ".boa.post",
+                                       "output.xlsx"), path_post)
+        boa_pairs.append((path_pre, path_post, name))
+    # Return BOA outcome pathes of all volume-pairs
+    return boa_pairs
+
+#-----------------------------------------------------#
+#                     Entry Point                     #
+#-----------------------------------------------------#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RadTA: Synthetic BOA outputs")
+    parser.add_argument("-o", "--output", type=str, required=True,
+                        help="Path to output directory", dest="path_out")
+    parser.add_argument("-n", "--pairs", type=int, default=10,
+                        help="Number of volume-pairs", dest="n_pairs")
+    parser.add_argument("-u", "--unique", type=int, default=100,
+                        help="Number of distinct generated volume-pairs", dest="n_unique")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="Random seed", dest="seed")
+    args = parser.parse_args()
+    generate_cohort(args.path_out, args.n_pairs, args.n_unique, args.seed)
\ No newline at end of file
@@ -0,0 +1,170 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import shutil
+import pandas as pd
+import numpy as np
+
+#-----------------------------------------------------#
+#               Aggregate Configuration               #
+#-----------------------------------------------------#
+# Keys of the per-feature aggregates
+AGG_KEYS = ["model", "feature", "metric"]
+# Sufficient statistics (sums and counts are additive, Welford for pairs)
+AGG_COLS = ["n_abs", "sum_abs", "n_rel", "sum_rel",
+            "n_paired", "mean_paired", "m2_paired"]
+
+#-----------------------------------------------------#
+#                 Compute Aggregates                  #
+#-----------------------------------------------------#
+def compute_aggregates(rt_merged, keys=AGG_KEYS):
+    # Paired differences are only defined if both volumes are present
+    dt = rt_merged[keys + ["diff_absolute", "diff_relative"]].copy()
+    dt["diff_paired"] = rt_merged["volume_pre"] - rt_merged["volume_post"]
+    dt.loc[rt_merged["volume_pre"].isna() | rt_merged["volume_post"].isna(),
+           "diff_paired"] = np.nan
+    # Compute all grouped reductions in a single pass
+    agg = dt.groupby(keys, observed=True).agg(
+                n_abs=("diff_absolute", "count"),
+                sum_abs=("diff_absolute", "sum"),
+                n_rel=("diff_relative", "count"),
+                sum_rel=("diff_relative", "sum"),
+                n_paired=("diff_paired", "count"),
+                mean_paired=("diff_paired", "mean"),
+                var_paired=("diff_paired", "var"))
+    agg = agg.reset_index()
+    # Convert variance into sum of squared deviations (M2)
+    agg["m2_paired"] = agg["var_paired"] * (agg["n_paired"] - 1)
+    agg.loc[agg["n_paired"] < 2, "m2_paired"] = 0.0
+    agg["mean_paired"] = agg["mean_paired"].fillna(0.0)
+    # Use plain string keys to allow merging with stored aggregates
+    for col in keys : agg[col] = agg[col].astype(str)
+    agg = agg.sort_values(keys, ignore_index=True)
+    return agg[keys + AGG_COLS]
+
+def compute_aggregates_chunked(chunks, path_spill, keys=AGG_KEYS, n_buckets=64):
+    # Out-of-core aggregation of a stream of radiomics table chunks
+    cols = keys + ["volume_pre", "volume_post", "diff_absolute", "diff_relative"]
+    results = compute_partitioned(chunks, path_spill, cols,
+                                  [lambda dt: compute_aggregates(dt, keys)],
+                                  n_buckets)
+    if results is None : return None
+    return results[0].sort_values(keys, ignore_index=True)
+
+def compute_partitioned(chunks, path_spill, cols, funcs, n_buckets=64):
+    # Out-of-core group-by: spill chunks into partitions of whole features
+    # (spilled partitions of an interrupted run are removed first)
+    if os.path.exists(path_spill) : shutil.rmtree(path_spill)
+    os.makedirs(path_spill)
+    try:
+        n_chunks = 0
+        for i, rt_chunk in enumerate(chunks):
+            n_chunks += 1
+            buckets = pd.util.hash_pandas_object(rt_chunk["feature"],
+                                                 index=False).values % n_buckets
+            for bucket, dt in rt_chunk[cols].groupby(buckets, sort=False):
+                path_part = os.path.join(path_spill, str(bucket))
+                if not os.path.exists(path_part) : os.mkdir(path_part)
+                dt.to_parquet(os.path.join(path_part, str(i).zfill(8) + \
+                                           ".parquet"), index=False)
+        if n_chunks == 0 : return None
+        # Each partition holds all rows of its features in the original order
+        # (results are identical to a single in-memory group-by)
+        results = [[] for func in funcs]
+        for bucket in sorted(os.listdir(path_spill)):
+            path_part = os.path.join(path_spill, bucket)
+            dt = pd.concat([pd.read_parquet(os.path.join(path_part, f)) \
+                            for f in sorted(os.listdir(path_part))],
+                           axis=0, ignore_index=True)
+            for i, func in enumerate(funcs) : results[i].append(func(dt))
+    finally : shutil.rmtree(path_spill, ignore_errors=True)
+    # Return combined results of each function
+    return [pd.concat(res, axis=0, ignore_index=True) for res in results]
+
+#-----------------------------------------------------#
+#                  Merge Aggregates                   #
+#-----------------------------------------------------#
+def merge_aggregates(agg_a, agg_b, keys=AGG_KEYS):
+    # Align both aggregate tables on their keys
+    agg = pd.merge(agg_a, agg_b, on=keys, how="outer", suffixes=("_a", "_b"))
+    for col in AGG_COLS:
+        agg[col + "_a"] = agg[col + "_a"].fillna(0)
+        agg[col + "_b"] = agg[col + "_b"].fillna(0)
+    # Counts and sums are additive
+    for col in ["n_abs", "sum_abs", "n_rel", "sum_rel", "n_paired"]:
+        agg[col] = agg[col + "_a"] + agg[col + "_b"]
+    # Combine Welford mean and M2 of the paired differences (Chan et al.)
+    n_a, n_b, n = agg["n_paired_a"], agg["n_paired_b"], agg["n_paired"]
+    delta = agg["mean_paired_b"] - agg["mean_paired_a"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        agg["mean_paired"] = np.where(n > 0,
+                                      agg["mean_paired_a"] + delta * n_b / n,
+                                      0.0)
+        agg["m2_paired"] = np.where(n > 0,
+                                    agg["m2_paired_a"] + agg["m2_paired_b"] + \
+                                    delta**2 * n_a * n_b / n,
+                                    0.0)
+    for col in ["n_abs", "n_rel", "n_paired"]:
+        agg[col] = agg[col].astype(np.int64)
+    # Return merged aggregates sorted by keys
+    agg = agg.sort_values(keys, ignore_index=True)
+    return agg[keys + AGG_COLS]
+
+#-----------------------------------------------------#
+#                Aggregate Persistence                #
+#-----------------------------------------------------#
+def load_aggregates(path_eval):
+    path_agg = os.path.join(path_eval, "aggregates.csv")
+    path_ledger = os.path.join(path_eval, "aggregates.ledger.csv")
+    if not os.path.exists(path_agg) or not os.path.exists(path_ledger):
+        return None, None
+    agg = pd.read_csv(path_agg, keep_default_na=False, na_values=[""])
+    for col in AGG_KEYS : agg[col] = agg[col].astype(str)
+    ledger = pd.read_csv(path_ledger, dtype={"volume_pair": str})
+    return agg, ledger
+
+def store_aggregates(path_eval, agg, ledger):
+    # Write via temporary files to never leave a half-written state behind
+    for name, dt in [("aggregates.csv", agg), ("aggregates.ledger.csv", ledger)]:
+        path_file = os.path.join(path_eval, name)
+        dt.to_csv(path_file + ".tmp", index=False)
+        os.replace(path_file + ".tmp", path_file)
+
+def create_ledger(rt_files):
+    # Ledger of included volume-pairs with file state to detect changes
+    ledger = []
+    for name_pair, path_file in rt_files.items():
+        fstat = os.stat(path_file)
+        ledger.append((name_pair, fstat.st_size, fstat.st_mtime_ns))
+    return pd.DataFrame(ledger, columns=["volume_pair", "size", "mtime_ns"])
+
+def check_ledger(ledger, rt_files):
+    # Stored aggregates are only valid if no included table changed or vanished
+    current = create_ledger({name: rt_files[name] for name in \
+                             ledger["volume_pair"] if name in rt_files})
+    if len(current) != len(ledger) : return False
+    merged = pd.merge(ledger, current, on="volume_pair", suffixes=("", "_now"))
+    return bool(((merged["size"] == merged["size_now"]) & \
+                 (merged["mtime_ns"] == merged["mtime_ns_now"])).all())
@@ -23,45 +23,144 @@
 #                   Library imports                   #
 #-----------------------------------------------------#
 import os
+import shutil
+import inspect
+import warnings
 from pathlib import Path
-from body_organ_analysis.commands import analyze_ct
+from cache import compute_cache_key, read_stamp, write_stamp, \
+                  cache_lookup, cache_store, get_cached_volume, \
+                  CACHE_FILES, CACHE_MASKS
+from instrument import stage, get_path_size
+from retention import apply_retention, has_masks
+
+#-----------------------------------------------------#
+#                  BOA Model Selection                #
+#-----------------------------------------------------#
+# BOA models used by RadTA (TotalSegmentator regions & body composition)
+BOA_MODELS = ["total", "bca"]
+
+def get_feature_models(feature):
+    # BCA features are named <BodyPart>-<Tissue>, TotalSegmentator ones <Region>
+    if "-" in feature : return ["bca"]
+    # Wildcard patterns without separator can match features of both models
+    elif any(c in feature for c in "*?[") : return ["total", "bca"]
+    else : return ["total"]
+
+def get_required_models(models=None, features=None):
+    # Only run BOA models which are needed for the requested features
+    if models is None and features is None : return list(BOA_MODELS)
+    required = set(models) if models is not None else set()
+    if features is not None:
+        for feat in features : required.update(get_feature_models(feat))
+    # Keep canonical model order (part of the cache key)
+    return [m for m in BOA_MODELS if m in required]
 
 #-----------------------------------------------------#
 #                    BOA Connector                    #
 #-----------------------------------------------------#
-def run_boa(vol_pre, vol_post, path_out):
+def run_boa(vol_pre, vol_post, path_out,
+            path_cache=None, cache_size=None, refresh=False,
+            models=None, fast=False):
     # create working directory if not existend
     if not path_out.exists() : os.mkdir(path_out)
     # define boa output directories for each volume
-    name_pre = str(vol_pre).split("/")[-1].split(".")[0] + ".boa.pre"
-    path_out_pre = Path(os.path.join(path_out, name_pre))
-    name_post = str(vol_post).split("/")[-1].split(".")[0] + ".boa.post"
-    path_out_post = Path(os.path.join(path_out, name_post))
+    path_out_pre = get_boa_path(vol_pre, path_out, "pre")
+    path_out_post = get_boa_path(vol_post, path_out, "post")
+
+    # Run BOA for volume pre
+    path_boa_out_pre = run_boa_volume(vol_pre, path_out_pre, 
+                                      path_cache, cache_size, refresh,
+                                      models, fast)
+    # Run BOA for volume post
+    path_boa_out_post = run_boa_volume(vol_post, path_out_post, 
+                                       path_cache, cache_size, refresh,
+                                       models, fast)
+
+    # Return pathes to BOA outcome excel files
+    return path_boa_out_pre, path_boa_out_post
+
+def get_boa_options(analyze_ct, models, fast=False):
+    # Optional arguments of analyze_ct differ between BOA releases (BOA is
+    # installed from source), only those of the installed version are passed
+    options = {"compute_contrast_information": "total" in models,
+               "fast_total": fast, "fast_bca": fast}
+    params = inspect.signature(analyze_ct).parameters
+    if not any(p.kind == p.VAR_KEYWORD for p in params.values()):
+        options = {key: value for key, value in options.items() if key in params}
+    if fast and not ("fast_total" in options and "fast_bca" in options):
+        warnings.warn("RadTA: Installed BOA version has no fast variants, " + \
+                      "segmenting in full resolution.")
+    return options
+
+def get_boa_path(vol, path_out, tag):
+    # Define BOA output directory for a volume (e.g. <name>.boa.pre)
+    name = str(vol).split("/")[-1].split(".")[0] + ".boa." + tag
+    return Path(os.path.join(path_out, name))
+
+def run_boa_volume(vol, path_out_vol,
+                   path_cache=None, cache_size=None, refresh=False,
+                   models=None, fast=False, retention="all", native=False):
+    # Record timing and resources of the segmentation of this volume
+    with stage("segmentation", volume=str(vol)) as record:
+        if record : record["volume_bytes"] = get_path_size(vol)
+        path_boa_out = run_boa_volume_traced(vol, path_out_vol, record,
+                                             path_cache, cache_size, refresh,
+                                             models, fast, native)
+    # Prune or archive the masks right after the segmentation of this volume
+    apply_retention(path_out_vol, retention)
+    return path_boa_out
+
+def run_boa_volume_traced(vol, path_out_vol, record,
+                          path_cache=None, cache_size=None, refresh=False,
+                          models=None, fast=False, native=False):
+    # Define BOA models and outcome excel file
+    if models is None : models = list(BOA_MODELS)
+    # Native region statistics also require the segmentation from the cache
+    masks = CACHE_MASKS if native else []
+    files = CACHE_FILES + masks
+    path_boa_out = os.path.join(path_out_vol, "output.xlsx")
+    record["cache"] = "off" if path_cache is None else "miss"
+    record["models"] = "+".join(models) + ("+fast" if fast else "")
+
+    # Check segmentation cache (skipped if caching is disabled)
+    if path_cache is not None:
+        key = compute_cache_key(vol, models + (["fast"] if fast else []))
+        # Reuse finished BOA outputs from an earlier run (if the masks for native
+        # region statistics were not pruned) or from the cache
+        if not refresh and read_stamp(path_out_vol) == key and \
+            has_masks(path_out_vol, masks):
+            record["cache"] = "stamp"
+            return path_boa_out
+        if not refresh and cache_lookup(path_cache, key, path_out_vol, files):
+            record["cache"] = "hit"
+            return path_boa_out
 
     # Define nnU-Net config
     os.environ["nnUNet_USE_TRITON"] = "0"
+    # BOA (torch, nnU-Net) is only loaded if a volume has to be segmented
+    from body_organ_analysis.commands import analyze_ct
 
-    # Run BOA for volume pre
+    # Run BOA into a temporary directory (a crash never leaves partial outputs)
+    path_tmp = Path(str(path_out_vol) + ".tmp")
+    if path_tmp.exists() : shutil.rmtree(path_tmp)
+    os.makedirs(path_tmp)
+    # Run BOA (on the decompressed volume if the volume cache is active)
     analyze_ct(
-        input_folder=vol_pre,
-        processed_output_folder=path_out_pre,
-        excel_output_folder=path_out_pre,
-        models=["total","bca"],
+        input_folder=get_cached_volume(vol),
+        processed_output_folder=path_tmp,
+        excel_output_folder=path_tmp,
+        models=models,
         total_preview=False,
-        bca_pdf=False
+        bca_pdf=False,
+        **get_boa_options(analyze_ct, models, fast)
     )
 
-    # Run BOA for volume post
-    analyze_ct(
-        input_folder=vol_post,
-        processed_output_folder=path_out_post,
-        excel_output_folder=path_out_post,
-        models=["total","bca"],
-        total_preview=False,
-        bca_pdf=False
-    )
+    # Publish complete BOA outputs and register them in the segmentation cache
+    if path_cache is not None : write_stamp(path_tmp, key)
+    if os.path.exists(path_out_vol) : shutil.rmtree(path_out_vol)
+    os.replace(path_tmp, path_out_vol)
+    if path_cache is not None:
+        cache_store(path_cache, key, path_out_vol, cache_size, files)
 
-    # Return pathes to BOA outcome excel files
-    path_boa_out_pre = os.path.join(path_out_pre, "output.xlsx")
-    path_boa_out_post = os.path.join(path_out_post, "output.xlsx")
-    return path_boa_out_pre, path_boa_out_post
\ No newline at end of file
+    # Return path to BOA outcome excel file
+    return path_boa_out
@@ -0,0 +1,202 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import gzip
+import hashlib
+import shutil
+from pathlib import Path
+from importlib import metadata
+from instrument import stage
+
+#-----------------------------------------------------#
+#                 Cache Configuration                 #
+#-----------------------------------------------------#
+# Files of a BOA output directory which are stored in the cache
+CACHE_FILES = ["output.xlsx"]
+# Segmentation masks which are additionally cached for native region statistics
+CACHE_MASKS = ["total.nii.gz"]
+# Name of the stamp file which links a BOA output directory to its cache key
+CACHE_STAMP = "radta.cachekey"
+# Environment variables which activate the volume cache (shared with workers)
+VOLUME_CACHE_ENV = "RADTA_VOLUME_CACHE"
+VOLUME_CACHE_SIZE_ENV = "RADTA_VOLUME_CACHE_SIZE"
+# Name of the decompressed NIfTI file inside a volume cache entry
+VOLUME_FILE = "volume.nii"
+
+#-----------------------------------------------------#
+#                      Cache Key                      #
+#-----------------------------------------------------#
+def get_boa_version():
+    # Identify installed BOA version (distribution naming differs by release)
+    for dist in ["body-organ-analysis", "body_organ_analysis"]:
+        try : return metadata.version(dist)
+        except metadata.PackageNotFoundError : continue
+    return "unknown"
+
+def hash_volume(path_vol, hasher):
+    # Collect files (a volume can be a NIfTI file or a DICOM directory)
+    path_vol = Path(path_vol)
+    if path_vol.is_dir():
+        files = sorted(p for p in path_vol.rglob("*") if p.is_file())
+    else : files = [path_vol]
+    # Hash file content in chunks to keep memory usage low
+    for path_file in files:
+        if path_vol.is_dir():
+            hasher.update(str(path_file.relative_to(path_vol)).encode())
+        with open(path_file, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b""):
+                hasher.update(chunk)
+
+def compute_cache_key(path_vol, models):
+    # Key = hash(volume content, BOA model list, BOA version)
+    hasher = hashlib.sha256()
+    hash_volume(path_vol, hasher)
+    hasher.update(("|".join(models)).encode())
+    hasher.update(get_boa_version().encode())
+    return hasher.hexdigest()
+
+#-----------------------------------------------------#
+#                  Stamp Bookkeeping                  #
+#-----------------------------------------------------#
+def read_stamp(path_boa):
+    # Return cache key of an existing BOA output directory (if complete)
+    path_stamp = os.path.join(path_boa, CACHE_STAMP)
+    if not os.path.exists(path_stamp) : return None
+    for f in CACHE_FILES:
+        if not os.path.exists(os.path.join(path_boa, f)) : return None
+    with open(path_stamp, "r") as fh:
+        return fh.read().strip()
+
+def write_stamp(path_boa, key):
+    with open(os.path.join(path_boa, CACHE_STAMP), "w") as fh:
+        fh.write(key)
+
+#-----------------------------------------------------#
+#                 Cache Lookup & Store                #
+#-----------------------------------------------------#
+def cache_lookup(path_cache, key, path_boa, files=CACHE_FILES):
+    # Check if cache entry exists (with all required files)
+    path_entry = os.path.join(path_cache, key)
+    if not os.path.isdir(path_entry) : return False
+    for f in files:
+        if not os.path.exists(os.path.join(path_entry, f)) : return False
+    # Restore cached BOA outputs into the BOA output directory
+    if not os.path.exists(path_boa) : os.makedirs(path_boa)
+    for f in files:
+        shutil.copy2(os.path.join(path_entry, f), os.path.join(path_boa, f))
+    write_stamp(path_boa, key)
+    # Mark entry as recently used for LRU eviction
+    os.utime(path_entry)
+    return True
+
+def cache_store(path_cache, key, path_boa, cache_size, files=CACHE_FILES):
+    # Copy BOA outputs into a temporary entry and publish it atomically
+    if not os.path.exists(path_cache) : os.makedirs(path_cache)
+    path_entry = os.path.join(path_cache, key)
+    path_tmp = path_entry + ".tmp." + str(os.getpid())
+    if os.path.exists(path_tmp) : shutil.rmtree(path_tmp)
+    os.mkdir(path_tmp)
+    for f in files:
+        shutil.copy2(os.path.join(path_boa, f), os.path.join(path_tmp, f))
+    if os.path.exists(path_entry) : shutil.rmtree(path_entry)
+    os.replace(path_tmp, path_entry)
+    # Enforce cache size limit
+    evict_lru(path_cache, cache_size)
+
+#-----------------------------------------------------#
+#                    LRU Eviction                     #
+#-----------------------------------------------------#
+def get_directory_size(path_dir):
+    size = 0
+    for root, dirs, files in os.walk(path_dir):
+        for f in files : size += os.path.getsize(os.path.join(root, f))
+    return size
+
+def evict_lru(path_cache, size_limit, keep=None):
+    # Skip eviction if no size limit is defined
+    if size_limit is None or not os.path.exists(path_cache) : return
+    # Gather cache entries with their last access and size
+    entries = []
+    for entry in os.listdir(path_cache):
+        path_entry = os.path.join(path_cache, entry)
+        if ".tmp." in entry or not os.path.isdir(path_entry) : continue
+        if path_entry == keep : continue
+        entries.append((os.path.getmtime(path_entry),
+                        get_directory_size(path_entry),
+                        path_entry))
+    # Remove least recently used entries until the limit is satisfied
+    total = sum(e[1] for e in entries)
+    for mtime, size, path_entry in sorted(entries):
+        if total <= size_limit : break
+        shutil.rmtree(path_entry, ignore_errors=True)
+        total -= size
+
+#-----------------------------------------------------#
+#                    Volume Cache                     #
+#-----------------------------------------------------#
+def enable_volume_cache(path_volcache, cache_size=None):
+    # Activate the volume cache for this process and all its workers
+    if not os.path.exists(path_volcache) : os.makedirs(path_volcache)
+    os.environ[VOLUME_CACHE_ENV] = os.path.abspath(path_volcache)
+    if cache_size is not None : os.environ[VOLUME_CACHE_SIZE_ENV] = str(cache_size)
+    return os.environ[VOLUME_CACHE_ENV]
+
+def compute_volume_key(path_vol):
+    # Key = hash(real path, size, modification time) without reading the file
+    fstat = os.stat(path_vol)
+    hasher = hashlib.sha256()
+    hasher.update(os.path.realpath(path_vol).encode())
+    hasher.update((str(fstat.st_size) + "|" + str(fstat.st_mtime_ns)).encode())
+    return hasher.hexdigest()
+
+def get_cached_volume(path_vol):
+    # Only compressed NIfTI files are cached (DICOM and .nii are read directly)
+    path_volcache = os.environ.get(VOLUME_CACHE_ENV)
+    if path_volcache is None or os.path.isdir(path_vol) or \
+       not str(path_vol).lower().endswith(".nii.gz"):
+        return path_vol
+    path_entry = os.path.join(path_volcache, compute_volume_key(path_vol))
+    path_file = os.path.join(path_entry, VOLUME_FILE)
+    # Reuse decompressed volume and mark entry as recently used
+    if os.path.exists(path_file):
+        os.utime(path_entry)
+        return Path(path_file)
+    # Decompress volume once into a temporary entry and publish it atomically
+    with stage("volume_cache", volume=str(path_vol)) as record:
+        path_tmp = path_entry + ".tmp." + str(os.getpid())
+        if os.path.exists(path_tmp) : shutil.rmtree(path_tmp)
+        os.makedirs(path_tmp)
+        with gzip.open(path_vol, "rb") as fh_src, \
+             open(os.path.join(path_tmp, VOLUME_FILE), "wb") as fh_dst:
+            shutil.copyfileobj(fh_src, fh_dst, 1 << 24)
+        if record : record["volume_bytes"] = get_directory_size(path_tmp)
+        # Another worker may have published the same volume in the meantime
+        try : os.replace(path_tmp, path_entry)
+        except OSError : shutil.rmtree(path_tmp, ignore_errors=True)
+    # Enforce cache size limit (the requested volume is never evicted)
+    cache_size = os.environ.get(VOLUME_CACHE_SIZE_ENV)
+    evict_lru(path_volcache, None if cache_size is None else int(cache_size),
+              keep=path_entry)
+    return Path(path_file)
@@ -22,60 +22,497 @@
 #-----------------------------------------------------#
 #                   Library imports                   #
 #-----------------------------------------------------#
+import sys
 import argparse
 from pathlib import Path
 import os
 
+#-----------------------------------------------------#
+#                     Subcommands                     #
+#-----------------------------------------------------#
+# Pipeline steps which can be run separately (heavy libraries are only loaded
+# by the steps requiring them)
+SUBCOMMANDS = {"segment": "Segment the volumes via BOA (and compute native " + \
+                          "region statistics)",
+               "process": "Create the radiomics tables of the volume-pairs " + \
+                          "from existing BOA outputs",
+               "evaluate": "Compute the evaluation statistics from existing " + \
+                           "radiomics tables (no figures)",
+               "plot": "Render the summary and analysis figures of an " + \
+                       "existing evaluation",
+               "watch": "Watch the input directories and process new " + \
+                        "volume-pairs as they arrive"}
+
 #-----------------------------------------------------#
 #               Command Line Interface                #
 #-----------------------------------------------------#
 def parse_arguments():
+    # Identify pipeline step (complete pipeline if no subcommand is given)
+    argv = sys.argv[1:]
+    if len(argv) > 0 and argv[0] in SUBCOMMANDS : command, argv = argv[0], argv[1:]
+    else : command = "run"
+
     # Initialize CLI
-    parser = argparse.ArgumentParser(description="CLI for RadTA: Radiomics Trend Analysis for CT scans")
+    if command == "run":
+        parser = argparse.ArgumentParser(description="CLI for RadTA: Radiomics " + \
+                                         "Trend Analysis for CT scans",
+                                         epilog="Pipeline steps can be run " + \
+                                         "separately via the subcommands " + \
+                                         ", ".join(SUBCOMMANDS) + \
+                                         " (e.g. 'main.py evaluate --help')")
+    else:
+        parser = argparse.ArgumentParser(prog="main.py " + command,
+                                         description="RadTA: " + \
+                                         SUBCOMMANDS[command])
+
+    # Input arguments (pre/post volumes or multiple timepoints)
+    if command in ["run", "segment", "process"] : add_input_arguments(parser)
+    if command == "watch" : add_input_arguments(parser, timepoints=False)
+
+    # Optional arguments
+    parser.add_argument("-o", "--output", 
+                        type=Path,
+                        help="Path to evaluation output directory",
+                        default="out/",
+                        dest="path_output")
+    if command in ["run", "segment", "plot", "watch"]:
+        parser.add_argument("-w", "--workers", 
+                            type=int,
+                            help="Number of parallel workers for processing volume pairs",
+                            default=1,
+                            dest="workers")
+    if command in ["run", "evaluate"]:
+        parser.add_argument("--incremental", 
+                            action="store_true",
+                            help="Update stored evaluation statistics with new volume pairs only",
+                            dest="incremental")
+        add_eval_arguments(parser, plots=command == "run")
+    if command == "watch" : add_eval_arguments(parser)
+    if command == "plot" : add_plot_arguments(parser)
+    if command == "process" : add_format_arguments(parser)
+    if command in ["run", "segment"]:
+        parser.add_argument("--preflight", 
+                            action="store_true",
+                            help="Only validate the input volumes (NIfTI headers) and " + \
+                                 "write the manifest.csv without processing",
+                            dest="preflight")
+    if command == "run":
+        parser.add_argument("--shard", 
+                            type=str,
+                            help="Process only shard I of N (format I/N, 0 <= I < N) " + \
+                                 "and write a partial result bundle (see radta/merge.py)",
+                            default=None,
+                            dest="shard")
+    parser.add_argument("--trace", 
+                        action="store_true",
+                        help="Record time, CPU and memory of each pipeline stage " + \
+                             "(trace.jsonl and metrics.prom in the output directory)",
+                        dest="trace")
+    if command in ["run", "segment", "watch"] : add_segmentation_arguments(parser)
+    if command in ["run", "segment", "process", "watch"]:
+        add_feature_arguments(parser)
+    if command == "watch" : add_watch_arguments(parser)
+
+    # Parse arguments
+    args = parser.parse_args(argv)
+    args.command = command
 
-    # Required arguments
+    # Parse volume queue of the input volumes
+    if command in ["run", "segment", "process"]:
+        queue_vol_pre, queue_vol_post, mode_single = parse_inputs(args)
+    elif command == "watch" : check_watch_arguments(args)
+    if command not in ["run", "segment", "process"]:
+        queue_vol_pre, queue_vol_post, mode_single = None, None, False
+
+    # Check number of workers
+    if "workers" in args and args.workers < 1:
+        raise ValueError("RadTA: Number of workers must be at least 1.")
+
+    # Check evaluation configuration
+    if command in ["run", "evaluate", "watch"] : check_eval_arguments(args)
+
+    # Check native region statistics
+    if command in ["run", "segment", "process", "watch"]:
+        if args.hu_window is not None:
+            if args.hu_window[0] > args.hu_window[1]:
+                raise ValueError("RadTA: Lower bound of the HU window exceeds the upper bound.")
+            args.native = True
+    if command in ["run", "segment", "watch"]:
+        if args.native and args.models is not None and "total" not in args.models:
+            raise ValueError("RadTA: Native region statistics require the total model.")
+
+    # Parse shard of a multi-node run
+    if command == "run" and args.shard is not None:
+        if mode_single:
+            raise ValueError("RadTA: Sharding requires directory or timepoint inputs.")
+        args.shard = parse_shard(args.shard)
+
+    # Check timeout and retries of the segmentations
+    if command in ["run", "segment", "watch"] : check_segmentation_arguments(args)
+
+    # Return arguments
+    return queue_vol_pre, queue_vol_post, args.path_output, mode_single, args
+
+#-----------------------------------------------------#
+#                   Input Arguments                   #
+#-----------------------------------------------------#
+def add_input_arguments(parser, timepoints=True):
+    # Input arguments (pre/post volumes or multiple timepoints)
     parser.add_argument("-va", "--vol_pre", 
                         type=Path,
                         help="Path to pre volume(s) file or directory with multiple volumes", 
-                        required=True,
                         dest="vol_pre")
     parser.add_argument("-vb", "--vol_post", 
                         type=Path,
                         help="Path to post volume(s) file or directory with multiple volumes",
-                        required=True,
                         dest="vol_post")
+    if not timepoints : return
+    parser.add_argument("-vt", "--vol_timepoints", 
+                        type=Path,
+                        nargs="+",
+                        help="Paths to directories with volumes of each timepoint " + \
+                             "in chronological order (longitudinal mode)",
+                        dest="vol_timepoints")
+    parser.add_argument("--compare", 
+                        type=str,
+                        choices=["consecutive", "baseline"],
+                        help="Timepoint pairs in longitudinal mode: consecutive " + \
+                             "timepoints or every timepoint against baseline",
+                        default="consecutive",
+                        dest="compare")
 
-    # Optional arguments
-    parser.add_argument("-o", "--output", 
+def parse_inputs(args):
+    # Parse volume queue for longitudinal mode
+    if args.vol_timepoints is not None:
+        if args.vol_pre is not None or args.vol_post is not None:
+            raise ValueError("RadTA: Timepoints can not be combined with pre/post inputs.")
+        queue_vol_pre, queue_vol_post = parse_timepoints(args.vol_timepoints,
+                                                         args.compare)
+        mode_single = False
+        args.longitudinal = True
+    # Parse volume queue for single file and directory mode
+    else:
+        queue_vol_pre, queue_vol_post, mode_single = parse_prepost(args.vol_pre,
+                                                                   args.vol_post)
+        args.longitudinal = False
+    return queue_vol_pre, queue_vol_post, mode_single
+
+def add_feature_arguments(parser):
+    # Feature selection and source of the region statistics
+    parser.add_argument("--features", 
+                        type=str,
+                        nargs="+",
+                        help="Evaluate only these features (shell-style patterns, " + \
+                             "e.g. 'Liver' or 'L3-*')",
+                        default=None,
+                        dest="features")
+    parser.add_argument("--native_stats", 
+                        action="store_true",
+                        help="Compute TotalSegmentator region statistics from the " + \
+                             "segmentations instead of the BOA report",
+                        dest="native")
+    parser.add_argument("--hu_window", 
+                        type=float,
+                        nargs=2,
+                        metavar=("LOW", "HIGH"),
+                        help="Restrict native region statistics to voxels in this " + \
+                             "HU range (implies --native_stats)",
+                        default=None,
+                        dest="hu_window")
+
+#-----------------------------------------------------#
+#                Segmentation Arguments               #
+#-----------------------------------------------------#
+def add_segmentation_arguments(parser):
+    # Segmentation arguments (BOA, caches and fault tolerance)
+    parser.add_argument("--boa_worker", 
                         type=Path,
-                        help="Path to evaluation output directory",
-                        default="out/",
-                        dest="path_output")
+                        help="Path to the Unix socket of a running segmentation worker " + \
+                             "(started via radta/worker.py)",
+                        default=None,
+                        dest="path_worker")
+    parser.add_argument("--models", 
+                        type=str,
+                        nargs="+",
+                        choices=["total", "bca"],
+                        help="BOA models to run: TotalSegmentator regions and/or " + \
+                             "body composition (default: all required by --features)",
+                        default=None,
+                        dest="models")
+    parser.add_argument("--fast", 
+                        action="store_true",
+                        help="Run the low-resolution fast variants of the BOA models",
+                        dest="fast")
+    parser.add_argument("--cache_dir", 
+                        type=Path,
+                        help="Path to segmentation cache directory (default: ~/.cache/radta)",
+                        default=Path.home() / ".cache" / "radta",
+                        dest="path_cache")
+    parser.add_argument("--cache_size", 
+                        type=float,
+                        help="Size limit of the segmentation cache in GB (LRU eviction)",
+                        default=10.0,
+                        dest="cache_size")
+    parser.add_argument("--no-cache", 
+                        action="store_true",
+                        help="Disable the segmentation cache and always run BOA",
+                        dest="no_cache")
+    parser.add_argument("--timeout", 
+                        type=float,
+                        help="Timeout of each segmentation in minutes, hung segmentations " + \
+                             "are killed and retried (default: no timeout)",
+                        default=None,
+                        dest="timeout")
+    parser.add_argument("--retries", 
+                        type=int,
+                        help="Number of retries of a failed or hung segmentation",
+                        default=2,
+                        dest="retries")
+    parser.add_argument("--backoff", 
+                        type=float,
+                        help="Delay before the first retry in seconds (doubled for " + \
+                             "each further retry)",
+                        default=30.0,
+                        dest="backoff")
+    parser.add_argument("--resume", 
+                        action="store_true",
+                        help="Continue an interrupted run from its journal (journal.jsonl " + \
+                             "in the output directory)",
+                        dest="resume")
+    parser.add_argument("--volume_cache", 
+                        type=Path,
+                        help="Path to a cache of decompressed volumes which is shared " + \
+                             "by all stages (default: disabled)",
+                        default=None,
+                        dest="path_volcache")
+    parser.add_argument("--volume_cache_size", 
+                        type=float,
+                        help="Size limit of the volume cache in GB (LRU eviction)",
+                        default=50.0,
+                        dest="volcache_size")
+    parser.add_argument("--refresh", 
+                        action="store_true",
+                        help="Ignore cached segmentations, rerun BOA and update the cache",
+                        dest="refresh")
+    parser.add_argument("--retention", 
+                        type=str,
+                        choices=["all", "features", "archive"],
+                        help="Outputs kept per volume after its features are extracted: " + \
+                             "all, only the feature tables or the feature tables and a " + \
+                             "compressed archive of all masks (see radta/retention.py)",
+                        default="all",
+                        dest="retention")
 
-    # Parse arguments
-    args = parser.parse_args()
+def check_segmentation_arguments(args):
+    # Check timeout and retries of the segmentations
+    if args.timeout is not None:
+        if args.timeout <= 0:
+            raise ValueError("RadTA: Timeout must be positive.")
+        args.timeout = args.timeout * 60
+    if args.retries < 0 or args.backoff < 0:
+        raise ValueError("RadTA: Retries and backoff can not be negative.")
+
+    # Configure segmentation cache
+    if args.no_cache : args.path_cache = None
+    args.cache_size = int(args.cache_size * 1024**3)
+    args.volcache_size = int(args.volcache_size * 1024**3)
+
+#-----------------------------------------------------#
+#                  Watch Arguments                    #
+#-----------------------------------------------------#
+def add_watch_arguments(parser):
+    # Polling of the input directories and cadence of the evaluation
+    parser.add_argument("--poll", 
+                        type=float,
+                        help="Interval in seconds between two scans of the input directories",
+                        default=30.0,
+                        dest="poll")
+    parser.add_argument("--settle", 
+                        type=float,
+                        help="Time in seconds both volumes of a pair must be unchanged " + \
+                             "(size and modification time) before it is processed",
+                        default=60.0,
+                        dest="settle")
+    parser.add_argument("--eval_interval", 
+                        type=float,
+                        help="Minimal time in minutes between two incremental " + \
+                             "evaluations of the cohort",
+                        default=10.0,
+                        dest="eval_interval")
 
-    # Check if both inputs exist
-    if not args.vol_pre.exists() or not args.vol_post.exists():
+def check_watch_arguments(args):
+    # Watch mode pairs volumes of two input directories by name
+    if args.vol_pre is None or args.vol_post is None or \
+        not args.vol_pre.is_dir() or not args.vol_post.is_dir():
+        raise ValueError("RadTA: Watch mode requires existing pre and post " + \
+                         "directories (-va, -vb).")
+    args.longitudinal = False
+    # Check polling and evaluation cadence
+    if args.poll <= 0:
+        raise ValueError("RadTA: Polling interval must be positive.")
+    if args.settle < 0 or args.eval_interval < 0:
+        raise ValueError("RadTA: Settle time and evaluation interval can not be negative.")
+    args.eval_interval = args.eval_interval * 60
+    # Every batch continues the journal (finished volume-pairs are skipped)
+    args.resume = True
+    args.incremental = True
+
+#-----------------------------------------------------#
+#                Evaluation Arguments                 #
+#-----------------------------------------------------#
+def add_format_arguments(parser):
+    # Output format of the radiomics and evaluation tables
+    parser.add_argument("--format", 
+                        type=str,
+                        choices=["parquet", "csv"],
+                        help="Output format of the radiomics and evaluation tables: " + \
+                             "Parquet (merged radiomics table partitioned by model) " + \
+                             "or CSV for compatibility",
+                        default="parquet",
+                        dest="output_format")
+
+def add_eval_arguments(parser, plots=True):
+    # Evaluation arguments (shared with the merge of sharded runs)
+    add_format_arguments(parser)
+    parser.add_argument("--chunk_size", 
+                        type=int,
+                        help="Evaluate radiomics tables out-of-core in chunks of " + \
+                             "this many volume-pairs (bounded memory)",
+                        default=None,
+                        dest="chunk_size")
+    parser.add_argument("--resamples", 
+                        type=int,
+                        help="Number of sign-flip permutations and bootstrap samples " + \
+                             "per feature (default: 0, resampling tests disabled)",
+                        default=0,
+                        dest="n_resamples")
+    parser.add_argument("--seed", 
+                        type=int,
+                        help="Random seed of the resampling tests",
+                        default=0,
+                        dest="seed")
+    parser.add_argument("--metadata", 
+                        type=Path,
+                        help="CSV file with a 'volume_pair' column and metadata " + \
+                             "columns (e.g. site, scanner, sex) for --stratify_by",
+                        default=None,
+                        dest="path_metadata")
+    parser.add_argument("--stratify_by", "--stratify-by", 
+                        type=str,
+                        nargs="+",
+                        help="Metadata columns defining strata which are evaluated " + \
+                             "separately (in addition to the whole cohort)",
+                        default=None,
+                        dest="stratify_by")
+    parser.add_argument("--strata_mode", 
+                        type=str,
+                        choices=["separate", "crossed"],
+                        help="Evaluate each --stratify_by column as a separate split " + \
+                             "of the cohort or the crossed strata of all columns",
+                        default="separate",
+                        dest="strata_mode")
+    # Plotting arguments (only if figures are rendered in the same run)
+    if plots : add_plot_arguments(parser)
+
+def add_plot_arguments(parser):
+    # Plotting arguments of the summary and analysis figures
+    parser.add_argument("--test", 
+                        type=str,
+                        choices=["ttest", "permutation"],
+                        help="Test defining the significance levels of the summary heatmaps",
+                        default="ttest",
+                        dest="test")
+    parser.add_argument("--correction", 
+                        type=str,
+                        choices=["fdr", "holm", "none"],
+                        help="Multiple testing correction of the summary heatmaps",
+                        default="fdr",
+                        dest="correction")
+    parser.add_argument("--no-analysis", 
+                        action="store_true",
+                        help="Skip rendering of the individual analysis figures per feature",
+                        dest="no_analysis")
+
+def check_eval_arguments(args):
+    # Check evaluation chunk size
+    if args.chunk_size is not None and args.chunk_size < 1:
+        raise ValueError("RadTA: Chunk size must be at least 1.")
+
+    # Check resampling configuration
+    if args.n_resamples < 0:
+        raise ValueError("RadTA: Number of resamples can not be negative.")
+    if "test" in args and args.test == "permutation" and args.n_resamples == 0:
+        raise ValueError("RadTA: Permutation test requires resamples (--resamples).")
+
+    # Check stratification
+    if args.stratify_by is not None and args.path_metadata is None:
+        raise ValueError("RadTA: Stratification requires a metadata file (--metadata).")
+    if args.path_metadata is not None and args.stratify_by is None:
+        raise ValueError("RadTA: Metadata is only used with --stratify_by.")
+
+def parse_shard(shard):
+    # Parse shard definition I/N into (index, number of shards)
+    try : index, n_shards = [int(x) for x in shard.split("/")]
+    except ValueError:
+        raise ValueError("RadTA: Shard must be given as I/N, e.g. 0/4.")
+    if n_shards < 1 or index < 0 or index >= n_shards:
+        raise ValueError("RadTA: Shard index must be in range 0 <= I < N.")
+    return index, n_shards
+
+#-----------------------------------------------------#
+#                 Volume Queue Parsing                #
+#-----------------------------------------------------#
+def parse_prepost(vol_pre, vol_post):
+    # Check if both inputs are provided and exist
+    if vol_pre is None or vol_post is None:
+        raise ValueError("RadTA: Both pre and post inputs (-va, -vb) are required.")
+    if not vol_pre.exists() or not vol_post.exists():
         raise ValueError("RadTA: One or both of the input pathes do not exist.")
 
     # Check if input volumes are files or directories
-    if args.vol_pre.is_file() and args.vol_post.is_file():
+    if vol_pre.is_file() and vol_post.is_file():
         mode_single = True
-    elif args.vol_pre.is_dir() and args.vol_post.is_dir():
+    elif vol_pre.is_dir() and vol_post.is_dir():
         mode_single = False
     else : raise ValueError("RadTA: Inputs must be both files or directories.")
 
     # Parse volume queue for single file and directory mode
     if mode_single:
-        queue_vol_pre = [args.vol_pre]
-        queue_vol_post = [args.vol_post]
+        queue_vol_pre = [vol_pre]
+        queue_vol_post = [vol_post]
     else:
         queue_vol_pre = []
         queue_vol_post = []
-        for x in os.listdir(args.vol_pre):
-            queue_vol_pre.append(Path(os.path.join(args.vol_pre, x)))
-            queue_vol_post.append(Path(os.path.join(args.vol_post, x)))
+        # Pair volumes by name (unmatched volumes are flagged by the pre-flight)
+        names = set(os.listdir(vol_pre)) | set(os.listdir(vol_post))
+        for x in sorted(names):
+            queue_vol_pre.append(Path(os.path.join(vol_pre, x)))
+            queue_vol_post.append(Path(os.path.join(vol_post, x)))
+    # Return volume queue
+    return queue_vol_pre, queue_vol_post, mode_single
 
-    # Return arguments
-    return queue_vol_pre, queue_vol_post, args.path_output, mode_single
\ No newline at end of file
+def parse_timepoints(vol_timepoints, compare):
+    # Check if timepoint directories exist
+    if len(vol_timepoints) < 2:
+        raise ValueError("RadTA: At least two timepoints are required.")
+    for path_tp in vol_timepoints:
+        if not path_tp.is_dir():
+            raise ValueError("RadTA: Timepoint directory does not exist: " + \
+                             str(path_tp))
+    # Gather all patients (volume file names) over all timepoints
+    patients = set()
+    for path_tp in vol_timepoints : patients.update(os.listdir(path_tp))
+    # Create volume pairs for each patient
+    queue_vol_pre = []
+    queue_vol_post = []
+    for x in sorted(patients):
+        # Identify available timepoints of the patient
+        vols = [Path(os.path.join(path_tp, x)) for path_tp in vol_timepoints \
+                if os.path.exists(os.path.join(path_tp, x))]
+        # Pair consecutive timepoints or each timepoint with the baseline
+        for i in range(1, len(vols)):
+            if compare == "consecutive" : queue_vol_pre.append(vols[i-1])
+            else : queue_vol_pre.append(vols[0])
+            queue_vol_post.append(vols[i])
+    # Return volume queue
+    return queue_vol_pre, queue_vol_post
\ No newline at end of file
@@ -23,50 +23,379 @@
 #                   Library imports                   #
 #-----------------------------------------------------#
 import os
+import shutil
 import pandas as pd
-from scipy import stats
-from plotnine import *
-import patchworklib as pw
+import numpy as np
+from pandas.api.types import union_categoricals
+from scipy import special
 import warnings
+from instrument import stage
+from aggregate import AGG_KEYS, compute_aggregates, compute_aggregates_chunked, \
+                      compute_partitioned, merge_aggregates, load_aggregates, \
+                      store_aggregates, create_ledger, check_ledger
+from significance import calc_resampling, calc_corrections
+from manifest import MANIFEST_FILE
+from strata import STRATUM_KEY, STRATA_DIR, load_strata, assign_strata, \
+                   report_unstratified, get_stratum_dir
 
 #-----------------------------------------------------#
 #                 Evaluation Function                 #
 #-----------------------------------------------------#
-def run_eval(path_output):
+def run_eval(path_output, rt_merged=None, incremental=False,
+             analysis=True, workers=1, chunk_size=None,
+             n_resamples=0, seed=0, test="ttest", correction="fdr",
+             path_eval=None, pair_tables=True,
+             path_metadata=None, stratify_by=None, strata_mode="separate",
+             plots=True, output_format="parquet"):
+    # Join metadata of the volume-pairs for a stratified evaluation
+    strata = None
+    if stratify_by is not None:
+        strata = load_strata(path_metadata, stratify_by, strata_mode)
     # Create evaluation directory
-    path_eval = os.path.join(path_output, "evaluation")
-    if not os.path.exists(path_eval) : os.mkdir(path_eval)
-    # Init merged radiomics table for all volume-pairs
-    rt_merged = []
-    # Iterate over all radiomics tables
-    for rt_file in os.listdir(path_output):
-        # Skip any non radiomics table file
-        if not rt_file.endswith(".csv") : continue
-        # Read radiomics table
-        rt = pd.read_csv(os.path.join(path_output, rt_file))
-        # Assign volume-pair name to radiomics table
-        rt["volume_pair"] = rt_file.split(".")[0]
-        # Append to list for merging
-        rt_merged.append(rt)
-    # Merge list of radiomics tables
-    rt_merged = pd.concat(rt_merged, axis=0, ignore_index=True)
-    # Store merged radiomics tables
-    rt_merged.to_csv(os.path.join(path_eval, "radiomics_table.csv"), index=False)
-    # Compute multiple statistical measurements
-    diffmean_rel = calc_diffmean(rt_merged, "diff_relative")
-    diffmean_abs = calc_diffmean(rt_merged, "diff_absolute")
-    ttest = calc_ttest(rt_merged)
-    obs = calc_observations(rt_merged)
-    # Merge evaluation list together
-    dt_eval = pd.merge(diffmean_rel, ttest, on=["model", "feature", "metric"])
-    dt_eval = pd.merge(diffmean_abs, dt_eval, on=["model", "feature", "metric"])
-    dt_eval = pd.merge(dt_eval, obs, on=["model", "feature", "metric"])
-    # Store evaluation table
-    dt_eval.to_csv(os.path.join(path_eval, "evaluation_table.csv"), index=False)
+    if path_eval is None : path_eval = os.path.join(path_output, "evaluation")
+    if not os.path.exists(path_eval) : os.makedirs(path_eval)
+    # Identify radiomics tables of all volume-pairs (or evaluate rt_merged only)
+    rt_files = list_pair_tables(path_output) if pair_tables else {}
+    # Merged radiomics table (CSV file or Parquet dataset partitioned by model)
+    path_rt = get_table_path(path_eval, "radiomics_table", output_format)
+    # Load stored aggregates and check if they are still valid
+    agg, ledger = None, None
+    if incremental:
+        agg, ledger = load_aggregates(path_eval)
+        if ledger is not None and not check_ledger(ledger, rt_files):
+            warnings.warn("RadTA: Radiomics tables changed since the last " + \
+                          "evaluation, recomputing all statistics.")
+            agg, ledger = None, None
+        # Stored radiomics table of another output format can not be extended
+        elif ledger is not None and not os.path.exists(path_rt):
+            warnings.warn("RadTA: No " + output_format + " radiomics table of " + \
+                          "the last evaluation, recomputing all statistics.")
+            agg, ledger = None, None
+    # Identify volume-pairs which are not included in the aggregates yet
+    if ledger is not None : included = set(ledger["volume_pair"])
+    else : included = set()
+    # Identify all volume-pairs (shared axis of the resampling)
+    pairs = set(rt_files)
+    if rt_merged is not None : pairs.update(rt_merged["volume_pair"].astype(str))
+    pairs = sorted(pairs)
+    func_res = lambda dt: calc_resampling(dt, pairs, n_resamples, seed)
+
+    # Compute sufficient statistics of new volume-pairs
+    path_spill = os.path.join(path_eval, ".spill")
+    agg_stored = agg is not None
+    rt_new, dt_res = None, None
+    with stage("eval.aggregates", incremental=agg_stored, chunk_size=chunk_size):
+        # Load all new radiomics tables into memory
+        if chunk_size is None:
+            rt_new = load_pair_tables(rt_files, rt_merged, exclude=included)
+            if rt_new is not None:
+                agg_new = compute_aggregates(rt_new)
+                store_radiomics_table(rt_new, path_rt, append=agg_stored)
+            else : agg_new = None
+        # Stream new radiomics tables in chunks of volume-pairs (bounded memory)
+        else:
+            chunks = iter_pair_tables(rt_files, rt_merged, included, chunk_size)
+            chunks = stream_radiomics_table(chunks, path_rt, append=agg_stored)
+            # Resample in the same pass if the stream covers all volume-pairs
+            if n_resamples > 0 and not agg_stored:
+                results = compute_partitioned(chunks, path_spill,
+                                              AGG_KEYS + ["volume_pair"] + RT_VALUES,
+                                              [compute_aggregates, func_res])
+                if results is not None:
+                    agg_new = results[0].sort_values(AGG_KEYS, ignore_index=True)
+                    dt_res = results[1]
+                else : agg_new = None
+            else : agg_new = compute_aggregates_chunked(chunks, path_spill)
+        # Merge sufficient statistics with stored aggregates
+        if agg_stored and agg_new is not None:
+            agg = merge_aggregates(agg, agg_new)
+        elif not agg_stored : agg = agg_new
+        if agg is None:
+            raise ValueError("RadTA: No radiomics tables found for evaluation.")
+        store_aggregates(path_eval, agg, create_ledger(rt_files))
+
+    # Resampling tests require the differences of all volume-pairs
+    if n_resamples > 0 and dt_res is None:
+        with stage("eval.resampling", resamples=n_resamples, pairs=len(pairs)):
+            if not agg_stored : dt_res = func_res(rt_new)
+            elif chunk_size is None:
+                dt_res = func_res(load_radiomics_table(path_rt, RT_RES_COLS,
+                                                       float32=False))
+            else:
+                chunks = iter_radiomics_table(path_rt, RT_RES_COLS, float32=False)
+                dt_res = compute_partitioned(chunks, path_spill, RT_RES_COLS,
+                                             [func_res])[0]
+
+    # Compute multiple statistical measurements from the aggregates
+    with stage("eval.statistics", features=len(agg)):
+        dt_eval = calc_statistics_aggregates(agg)
+        dt_eval = calc_statistics_resampling(dt_eval, dt_res)
+        # Store evaluation table
+        store_table(dt_eval, path_eval, "evaluation_table", output_format)
+    # Evaluate all strata in a single grouped pass
+    tables_strata = {}
+    if strata is not None:
+        with stage("eval.strata", strata=strata.stack().nunique()):
+            report_unstratified(pairs, strata)
+            if chunk_size is not None:
+                rt_all = None
+                chunks = iter_radiomics_table(path_rt, float32=False)
+            elif agg_stored:
+                rt_all = load_radiomics_table(path_rt, float32=False)
+            else : rt_all = rt_new
+            if rt_all is not None : chunks = [rt_all]
+            tables_strata = run_eval_strata(chunks, strata, pairs, path_eval,
+                                path_spill if chunk_size is not None else None,
+                                n_resamples, seed, output_format)
+    if not plots : return dt_eval
+
+    # Plotting libraries are only loaded if figures are rendered
+    from plot import plot_summary, plot_strata, plot_analysis
     # Plot summary figure as heatmap
-    plot_summary(dt_eval, path_eval)
-    # Plot individual analysis figures
-    # plot_analysis(rt_merged, dt_eval, path_eval)
+    with stage("eval.plot_summary"):
+        plot_summary(dt_eval, path_eval, workers, test, correction)
+    # Plot summary figures of all strata
+    if len(tables_strata) > 0:
+        with stage("eval.plot_strata", strata=len(tables_strata)):
+            plot_strata(tables_strata, path_eval, workers, test, correction)
+    # Plot individual analysis figures (requires the complete radiomics table)
+    if analysis:
+        with stage("eval.plot_analysis"):
+            if agg_stored or chunk_size is not None:
+                rt_all = load_radiomics_table(path_rt, RT_ANALYSIS_COLS)
+            else : rt_all = compact_table(rt_new[RT_ANALYSIS_COLS], float32=True)
+            plot_analysis(rt_all, dt_eval, path_eval, workers)
+    return dt_eval
+
+#-----------------------------------------------------#
+#                Stratified Evaluation                #
+#-----------------------------------------------------#
+def run_eval_strata(chunks, strata, pairs, path_eval, path_spill=None,
+                    n_resamples=0, seed=0, output_format="parquet"):
+    # Stratum is an additional key of all grouped reductions
+    keys = [STRATUM_KEY] + AGG_KEYS
+    funcs = [lambda dt: compute_aggregates(dt, keys)]
+    if n_resamples > 0:
+        funcs.append(lambda dt: calc_resampling(dt, pairs, n_resamples, seed,
+                                                keys=keys))
+    chunks = (assign_strata(rt, strata) for rt in chunks)
+    # Out-of-core partitions of whole features or a single in-memory pass
+    if path_spill is not None:
+        results = compute_partitioned(chunks, path_spill,
+                                      keys + ["volume_pair"] + RT_VALUES, funcs)
+    else:
+        rt = concat_compact(list(chunks))
+        results = [func(rt) for func in funcs] if len(rt) > 0 else None
+    if results is None:
+        warnings.warn("RadTA: No volume-pairs with metadata for the stratified " + \
+                      "evaluation.")
+        return {}
+    agg = results[0].sort_values(keys, ignore_index=True)
+    dt_eval = calc_statistics_aggregates(agg, keys)
+    dt_res = results[1] if n_resamples > 0 else None
+
+    # Per-stratum evaluation tables (p-values corrected within each stratum)
+    path_strata = os.path.join(path_eval, STRATA_DIR)
+    tables, list_eval = {}, []
+    for stratum, dt_stratum in dt_eval.groupby(STRATUM_KEY, sort=True):
+        dt_stratum = dt_stratum.drop(columns=[STRATUM_KEY])
+        dt_stratum = dt_stratum.reset_index(drop=True)
+        if dt_res is not None:
+            dt_res_stratum = dt_res[dt_res[STRATUM_KEY] == stratum]
+        else : dt_res_stratum = None
+        dt_stratum = calc_statistics_resampling(dt_stratum, dt_res_stratum)
+        path_stratum = os.path.join(path_strata, get_stratum_dir(stratum))
+        if not os.path.exists(path_stratum) : os.makedirs(path_stratum)
+        store_table(dt_stratum, path_stratum, "evaluation_table", output_format)
+        tables[get_stratum_dir(stratum)] = dt_stratum
+        list_eval.append(dt_stratum.assign(**{STRATUM_KEY: stratum}))
+    # Store evaluation table of all strata
+    dt_strata = pd.concat(list_eval, axis=0, ignore_index=True)
+    dt_strata = dt_strata[[STRATUM_KEY] + list(dt_strata.columns[:-1])]
+    store_table(dt_strata, path_eval, "evaluation_table.strata", output_format)
+    # Return evaluation tables of all strata (by directory name)
+    return tables
+
+#-----------------------------------------------------#
+#                   Table Formats                     #
+#-----------------------------------------------------#
+# Output formats of the radiomics and evaluation tables (CSV for compatibility)
+TABLE_FORMATS = {"parquet": ".parquet", "csv": ".csv"}
+
+def get_table_path(path_dir, name, output_format):
+    return os.path.join(path_dir, name + TABLE_FORMATS[output_format])
+
+def find_table(path_dir, name):
+    # Existing table of any output format (Parquet preferred)
+    for output_format in TABLE_FORMATS:
+        path_table = get_table_path(path_dir, name, output_format)
+        if os.path.exists(path_table) : return path_table
+    return None
+
+def store_table(dt, path_dir, name, output_format):
+    # Store a table in the output format and remove it in any other format
+    for fmt in TABLE_FORMATS:
+        path_other = get_table_path(path_dir, name, fmt)
+        if fmt != output_format and os.path.isfile(path_other):
+            os.remove(path_other)
+    path_table = get_table_path(path_dir, name, output_format)
+    if output_format == "csv" : dt.to_csv(path_table, index=False)
+    else : dt.to_parquet(path_table, index=False)
+    return path_table
+
+def read_table(path_table, dtype=None, **kwargs):
+    # Read a table of any output format (kwargs are CSV parser options)
+    if path_table.endswith(".csv"):
+        return pd.read_csv(path_table, dtype=dtype, **kwargs)
+    dt = pd.read_parquet(path_table)
+    return dt if dtype is None else dt.astype(dtype)
+
+#-----------------------------------------------------#
+#               Radiomics Table Loading               #
+#-----------------------------------------------------#
+# Repeated strings are stored as categories
+RT_KEYS = ["model", "feature", "metric", "volume_pair"]
+# Measurements and differences of the radiomics tables
+RT_VALUES = ["volume_pre", "volume_post", "diff_absolute", "diff_relative"]
+# Columns required for the individual analysis figures
+RT_ANALYSIS_COLS = ["feature", "metric", "volume_pre", "volume_post"]
+# Columns required for the resampling tests
+RT_RES_COLS = ["model", "feature", "metric", "volume_pair", "diff_relative"]
+
+def compact_table(rt, float32=False):
+    # Categorical keys (codes instead of repeated strings)
+    rt = rt.copy(deep=False)
+    for col in RT_KEYS:
+        if col in rt.columns and rt[col].dtype.name != "category":
+            rt[col] = rt[col].astype("category")
+    # Single precision values (only where exactness is not required, e.g. plots)
+    if float32:
+        for col in RT_VALUES:
+            if col in rt.columns : rt[col] = rt[col].astype(np.float32)
+    return rt
+
+def concat_compact(rt_list):
+    # Concatenate tables and unify the categories of their keys
+    for col in RT_KEYS:
+        if col not in rt_list[0].columns : continue
+        cats = union_categoricals([rt[col] for rt in rt_list],
+                                  sort_categories=True).categories
+        for rt in rt_list : rt[col] = rt[col].cat.set_categories(cats)
+    return pd.concat(rt_list, axis=0, ignore_index=True)
+
+def list_pair_tables(path_output):
+    # Identify radiomics tables of all volume-pairs (sorted for determinism)
+    rt_files = {}
+    for rt_file in sorted(os.listdir(path_output)):
+        # Skip any non radiomics table file
+        if not rt_file.endswith(tuple(TABLE_FORMATS.values())) or \
+            rt_file == MANIFEST_FILE : continue
+        rt_files[rt_file.split(".")[0]] = os.path.join(path_output, rt_file)
+    return rt_files
+
+def read_pair_table(path_file, name_pair):
+    # Read radiomics table with categorical keys
+    if path_file.endswith(".csv"):
+        rt = pd.read_csv(path_file, dtype={"model": "category",
+                                           "feature": "category",
+                                           "metric": "category"})
+    else : rt = compact_table(pd.read_parquet(path_file))
+    # Assign volume-pair name to radiomics table
+    rt["volume_pair"] = pd.Categorical([name_pair] * len(rt))
+    return rt
+
+def iter_pair_tables(rt_files, rt_merged=None, exclude=set(), chunk_size=None):
+    # Yield merged radiomics tables of (at most chunk_size) volume-pairs
+    processed = set(exclude)
+    if rt_merged is not None:
+        rt_merged = rt_merged[~rt_merged["volume_pair"].isin(processed)]
+        processed.update(rt_merged["volume_pair"].astype(str).unique())
+    rt_list = []
+    if rt_merged is not None and not rt_merged.empty:
+        rt_list.append(compact_table(rt_merged))
+    # Iterate over all radiomics tables
+    for name_pair, path_file in rt_files.items():
+        # Skip radiomics tables which are already provided or included
+        if name_pair in processed : continue
+        rt_list.append(read_pair_table(path_file, name_pair))
+        # Emit a chunk as soon as it is complete
+        if chunk_size is not None and len(rt_list) >= chunk_size:
+            yield concat_compact(rt_list)
+            rt_list = []
+    if len(rt_list) > 0 : yield concat_compact(rt_list)
+
+def load_pair_tables(rt_files, rt_merged=None, exclude=set()):
+    # Merge radiomics tables of all volume-pairs into a single table
+    rt_list = list(iter_pair_tables(rt_files, rt_merged, exclude))
+    if len(rt_list) == 0 : return None
+    return rt_list[0]
+
+def store_radiomics_table(rt, path_rt, append=False):
+    # Store (or append new volume-pairs to) merged radiomics tables
+    if not append:
+        path_eval, name = os.path.split(os.path.splitext(path_rt)[0])
+        for output_format in TABLE_FORMATS:
+            path_old = get_table_path(path_eval, name, output_format)
+            if os.path.isdir(path_old) : shutil.rmtree(path_old)
+            elif os.path.exists(path_old) : os.remove(path_old)
+    if path_rt.endswith(".csv"):
+        rt.to_csv(path_rt, mode="a" if append else "w", header=not append,
+                  index=False)
+    # Parquet dataset partitioned by model (new files for appended volume-pairs)
+    # with dictionary-encoded keys
+    else:
+        rt.to_parquet(path_rt, partition_cols=["model"], index=False,
+                      use_dictionary=[col for col in RT_KEYS if col != "model"])
+
+def stream_radiomics_table(chunks, path_rt, append=False):
+    # Store chunks of the merged radiomics table while passing them on
+    for rt_chunk in chunks:
+        store_radiomics_table(rt_chunk, path_rt, append)
+        append = True
+        yield rt_chunk
+
+def iter_radiomics_table(path_rt, columns=None, float32=True,
+                         chunk_size=1000000, filters=None):
+    # Read merged radiomics table in chunks of rows with compact dtypes
+    dtypes = {col: "category" for col in RT_KEYS}
+    dtypes.update({col: np.float32 if float32 else np.float64 \
+                   for col in RT_VALUES})
+    if path_rt.endswith(".csv"):
+        usecols = columns
+        if columns is not None and filters is not None:
+            usecols = list(columns) + [c for c in filters if c not in columns]
+        for rt in pd.read_csv(path_rt, usecols=usecols, dtype=dtypes,
+                              chunksize=chunk_size):
+            # Filters are applied to each chunk after parsing
+            if filters is not None:
+                for col, values in filters.items():
+                    rt = rt[rt[col].isin(values)]
+                if columns is not None : rt = rt[list(columns)]
+            yield compact_table(rt)
+        return
+    # Parquet dataset: only row groups and partitions matching the filters are
+    # read (predicate pushdown, e.g. filters={"model": ["Total"]})
+    import pyarrow.dataset as ds
+    dataset = ds.dataset(path_rt, format="parquet", partitioning="hive")
+    expression = None
+    for col, values in (filters or {}).items():
+        condition = ds.field(col).isin(list(values))
+        expression = condition if expression is None else expression & condition
+    empty = True
+    for batch in dataset.to_batches(columns=columns, filter=expression,
+                                    batch_size=chunk_size):
+        if batch.num_rows == 0 : continue
+        empty = False
+        rt = batch.to_pandas()
+        yield compact_table(rt.astype({col: dtypes[col] for col in rt.columns \
+                                       if col in RT_VALUES}))
+    # Empty table with all columns if no rows match the filters
+    if empty : yield compact_table(dataset.head(0, columns=columns).to_pandas())
+
+def load_radiomics_table(path_rt, columns=None, float32=True, filters=None):
+    # Load merged radiomics table with compact dtypes
+    return concat_compact(list(iter_radiomics_table(path_rt, columns, float32,
+                                                    filters=filters)))
 
 #-----------------------------------------------------#
 #               Statistical Measurements              #
@@ -74,171 +403,65 @@ def run_eval(path_output):
 def calc_diffmean(rt_merged, feat):
     observations = rt_merged.groupby(["model", 
                                     "feature", 
-                                    "metric"])[feat].mean(numeric_only=True)
+                                    "metric"], observed=True)[feat].mean(numeric_only=True)
     dt_diffmean = observations.to_frame().reset_index()
     dt_diffmean.rename({feat: "mean_" + feat}, axis=1, inplace=True)
     return dt_diffmean
 
 def calc_ttest(rt_merged):
-    feat_group = rt_merged.groupby(["model", 
-                                    "feature", 
-                                    "metric"])[["volume_pre", "volume_post"]]
-    def apply_ttest(x):
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            x.dropna(axis=0, inplace=True)
-            t_statistic, p_value = stats.ttest_rel(x["volume_pre"], 
-                                                x["volume_post"],
-                                                nan_policy="propagate")
-        return pd.Series([t_statistic, p_value], index=["ttest_statistic",
-                                                        "ttest_pvalue"])
-    dt_ttest = feat_group.apply(apply_ttest)
-    dt_ttest= dt_ttest.reset_index()
-    return dt_ttest
+    dt_stats = calc_statistics(rt_merged)
+    return dt_stats[["model", "feature", "metric",
+                     "ttest_statistic", "ttest_pvalue"]]
 
 def calc_observations(rt_merged):
     observations = rt_merged.groupby(["model", 
                                       "feature", 
-                                      "metric"])["diff_relative"].count()
+                                      "metric"], observed=True)["diff_relative"].count()
     dt_counts = observations.to_frame().reset_index()
     dt_counts.rename({"diff_absolute": "observations"}, axis=1, inplace=True)
     return dt_counts
 
-#-----------------------------------------------------#
-#                Summary Plot - Heatmap               #
-#-----------------------------------------------------#
-def plot_summary(dt_eval, path_eval):
-    # iterate through models
-    for model_name in dt_eval["model"].unique():
-        # Create dataframe subset for corresponding model
-        dt_model = dt_eval[dt_eval["model"]==model_name]
-
-        # Create and configure significance levels for the ttest
-        significance_bins = [0, 0.01, 0.05, 0.1, 1.0]
-        significance_names = ["<= " + str(x) for x in significance_bins[1:]]
-        significance_names[-1] = "reject"
-        significance_colors = ["#32CD32", "#7FFFD4", "#088F8F", "#800020"]
-        significance_color_map = {}
-        for i, sl in enumerate(significance_names):
-            significance_color_map[sl] = significance_colors[i]
-        # Apply significance levels to the ttest pvalues
-        dt_model["significance"] = pd.cut(dt_model["ttest_pvalue"], 
-                                        significance_bins,
-                                        labels=significance_names)
-        dt_model["significance"] = dt_model["significance"].astype(str)
-
-        # Round relative mean difference
-        dt_model["mean_diff_relative"] = dt_model["mean_diff_relative"].round(2)
-        dt_model["mean_diff_relative"] = dt_model["mean_diff_relative"].apply(lambda x: "+"+str(x) if x>0 else x)
-
-        # Generate summary figure
-        fig = (ggplot(dt_model, aes("metric", "feature", fill="significance"))
-                    + geom_tile(color="white", size=1.5)
-                    + geom_text(aes("metric", "feature", 
-                                    label="mean_diff_relative"), 
-                                color="black", size=5.0)
-                    # + ggtitle("Radiomic Trend Analysis Evaluation Summary for Model: " + model_name)
-                    + labs(title="Radiomic Trend Analysis\n" + \
-                            "Evaluation Summary for Model: " + model_name,
-                            subtitle="Label: Mean of Relative Difference (in %)\n" + \
-                                    "Color: P-value of Paired t-Test")
-                    + xlab("Measurement Metric")
-                    + ylab("Feature")
-                    + scale_fill_manual(values=significance_color_map)
-                    + theme_bw()
-                    + theme(axis_text_x=element_text(angle = 65, vjust = 1.0,
-                                                    hjust = 0.99),
-                            legend_title=element_blank(),
-                            legend_direction="horizontal", 
-                            legend_box="horizontal",
-                            legend_position="top", 
-                            legend_box_just="left"))
-
-        # Compute height resolution
-        n_feat = len(dt_model["feature"].unique()) 
-        height = int(round(n_feat / 5.5)) # 5.5 is a magic number (every good tool need magic numbers)
-
-        # Store figure to disk
-        filename = "plot.summary." + model_name + ".png"
-        fig.save(filename=filename, path=path_eval, 
-                 width=8, height=height, dpi=300,
-                 limitsize=False)
+def calc_ttest_moments(n, mean, var):
+    # Closed-form paired t-test from count, mean and variance of the differences
+    n = np.asarray(n, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t_statistic = np.divide(mean, np.sqrt(var / n))
+        p_value = 2 * special.stdtr(n - 1, -np.abs(t_statistic))
+    # Require at least two observations (as scipy.stats.ttest_rel)
+    t_statistic = np.where(n < 2, np.nan, t_statistic)
+    p_value = np.where(n < 2, np.nan, p_value)
+    return t_statistic, p_value
 
-#-----------------------------------------------------#
-#      Analysis Plot - Individual Box+Line Plots      #
-#-----------------------------------------------------#
-def plot_analysis(rt_merged, dt_eval, path_eval):
-    # create evaluation analysis directory
-    path_eval_analysis = os.path.join(path_eval, "analysis_figures")
-    if not os.path.exists(path_eval_analysis) : os.mkdir(path_eval_analysis)
-    # Iterate over each feature
-    for feat in dt_eval["feature"].unique():
-        # create subset
-        dt_eval_feat = dt_eval[dt_eval["feature"]==feat]
-        dt_merged_feat = rt_merged[rt_merged["feature"]==feat]
-        # filter out nan rows
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            dt_eval_feat.dropna(subset=["mean_diff_absolute"], 
-                                axis=0, 
-                                inplace=True)
-            dt_merged_feat.dropna(subset=["volume_pre", "volume_post"], 
-                                  axis=0, 
-                                  inplace=True)
-        # Skip empty feature tables
-        if dt_merged_feat.empty : continue
-
-        # Generate feature analysis figure - TOP LEFT
-        figtopleft = (ggplot(dt_eval_feat, aes("metric", "mean_diff_relative"))
-                    + geom_boxplot()
-                    + labs(title="Boxplot - Mean Relative Difference: " + feat)
-                    + xlab("")
-                    + ylab("Mean Relative Difference")
-                    + facet_wrap("metric", scales = "free", shrink=True)
-                    + theme_bw()
-                    + theme(legend_text=element_text(size=1)))
-        filename = "plot.analysis." + feat + ".topleft.png"
-        figtopleft.save(filename=filename, path=path_eval_analysis, 
-                 width=4, height=4, dpi=300,
-                 limitsize=False)
-        # Generate feature analysis figure - TOP LEFT
-        figtopright = (ggplot(dt_eval_feat, aes("metric", "mean_diff_absolute"))
-                    + geom_boxplot()
-                    + labs(title="Boxplot - Mean Absolute Difference: " + feat)
-                    + xlab("")
-                    + ylab("Mean Absolute Difference")
-                    + facet_wrap("metric", scales = "free")
-                    + theme_bw()
-                    + theme(legend_text=element_text(size=3),
-                            subplots_adjust={"wspace": 5.0}))
-        # Store figure to disk
-        filename = "plot.analysis." + feat + ".topright.png"
-        figtopright.save(filename=filename, path=path_eval_analysis, 
-                 width=4, height=4, dpi=300,
-                 limitsize=False)
-
-        # Generate feature analysis figure - BOTTOM
-        figbot = (ggplot(dt_merged_feat, aes("volume_pre", "volume_post"))
-                    + geom_point(size=0.5, color="royalblue")
-                    + geom_abline(intercept=1, linetype="dashed", size=0.5)
-                    + labs(title="Direct Comparison: " + feat)
-                    + xlab("Pre-Volume: Measurement")
-                    + ylab("Post-Volume: Measurement")
-                    + facet_wrap("metric", scales = "free")
-                    + theme_bw()
-                    + theme(legend_text=element_text(size=1)))
-        
-        # # Multi-plot Call
-        # g1 = pw.load_ggplot(figtopleft, figsize=(4,4))
-        # g2 = pw.load_ggplot(figtopright, figsize=(4,4))
-        # gbot = pw.load_ggplot(figbot, figsize=(8,4))
-        # g12b = (g1|g2)/gbot
-        # path_fig = os.path.join(path_eval_analysis,
-        #                         "plot.analysis." + feat + ".png")
-        # g12b.savefig(path_fig)
+def calc_statistics(rt_merged):
+    # Compute all grouped reductions in a single pass
+    return calc_statistics_aggregates(compute_aggregates(rt_merged))
 
-#-----------------------------------------------------#
-#                Debugging Main Method                #
-#-----------------------------------------------------#
-if __name__ == "__main__":
-    run_eval("out")
+def calc_statistics_aggregates(agg, keys=AGG_KEYS):
+    dt_stats = agg[keys].copy()
+    # Mean differences and observations from additive sums and counts
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dt_stats["mean_diff_absolute"] = np.where(agg["n_abs"] > 0,
+                                    agg["sum_abs"] / agg["n_abs"], np.nan)
+        dt_stats["mean_diff_relative"] = np.where(agg["n_rel"] > 0,
+                                    agg["sum_rel"] / agg["n_rel"], np.nan)
+        var_paired = agg["m2_paired"] / (agg["n_paired"] - 1)
+    # Derive paired t-test for all groups at once
+    t_statistic, p_value = calc_ttest_moments(agg["n_paired"],
+                                              agg["mean_paired"],
+                                              var_paired)
+    dt_stats["ttest_statistic"] = t_statistic
+    dt_stats["ttest_pvalue"] = p_value
+    dt_stats["diff_relative"] = agg["n_rel"]
+    # Return evaluation table
+    return dt_stats
+
+def calc_statistics_resampling(dt_eval, dt_res=None):
+    # Add permutation p-values and bootstrap CIs (NaN if resampling is disabled)
+    cols = ["perm_pvalue", "boot_ci_low", "boot_ci_high"]
+    if dt_res is not None:
+        dt_eval = pd.merge(dt_eval, dt_res[AGG_KEYS + cols], on=AGG_KEYS,
+                           how="left")
+    else:
+        for col in cols : dt_eval[col] = np.nan
+    # Adjust p-values for multiple testing over all features
+    return calc_corrections(dt_eval)
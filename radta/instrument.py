@@ -0,0 +1,140 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+#-----------------------------------------------------#
+#               Trace Configuration                   #
+#-----------------------------------------------------#
+# Environment variables are inherited by spawned pool workers
+TRACE_ENV = "RADTA_TRACE"
+TRACE_RUN_ENV = "RADTA_TRACE_RUN"
+# Trace and metrics files in the output directory
+TRACE_FILE = "trace.jsonl"
+METRICS_FILE = "metrics.prom"
+
+def enable_trace(path_output):
+    # Activate instrumentation for this process and all its workers
+    if not os.path.exists(path_output) : os.makedirs(path_output)
+    os.environ[TRACE_ENV] = os.path.abspath(os.path.join(path_output, TRACE_FILE))
+    os.environ[TRACE_RUN_ENV] = time.strftime("%Y%m%dT%H%M%S") + "-" + \
+                                str(os.getpid())
+    return os.environ[TRACE_ENV]
+
+def get_peak_rss():
+    # Peak resident set size in bytes (Linux reports KB, macOS bytes)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+def get_path_size(path):
+    # Size of a volume file or DICOM directory in bytes
+    if not os.path.isdir(path) : return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) \
+               for root, _, files in os.walk(path) for f in files)
+
+#-----------------------------------------------------#
+#                 Stage Instrumentation               #
+#-----------------------------------------------------#
+@contextmanager
+def stage(name, **labels):
+    # Instrumentation is a no-op if tracing is disabled
+    path_trace = os.environ.get(TRACE_ENV)
+    if path_trace is None:
+        yield {}
+        return
+    # Record can be extended with labels inside the stage
+    record = {"run": os.environ.get(TRACE_RUN_ENV), "stage": name, **labels}
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    record["status"] = "error"
+    try:
+        yield record
+        record["status"] = "ok"
+    finally:
+        record["wall_s"] = time.perf_counter() - wall_start
+        record["cpu_s"] = time.process_time() - cpu_start
+        record["peak_rss_bytes"] = get_peak_rss()
+        record["pid"] = os.getpid()
+        record["time"] = time.time()
+        # Append one line per stage (single small write with O_APPEND)
+        with open(path_trace, "a") as fh:
+            fh.write(json.dumps(record, default=str) + "\n")
+
+#-----------------------------------------------------#
+#                  Prometheus Metrics                 #
+#-----------------------------------------------------#
+def write_metrics(path_output):
+    # Summarize all stages of the current run
+    path_trace = os.environ.get(TRACE_ENV)
+    if path_trace is None or not os.path.exists(path_trace) : return None
+    run = os.environ.get(TRACE_RUN_ENV)
+    summary = {}
+    with open(path_trace, "r") as fh:
+        for line in fh:
+            record = json.loads(line)
+            if record.get("run") != run : continue
+            s = summary.setdefault(record["stage"], {"count": 0, "errors": 0,
+                                                     "wall": 0.0, "cpu": 0.0,
+                                                     "rss": 0, "bytes": 0})
+            s["count"] += 1
+            s["errors"] += record["status"] != "ok"
+            s["wall"] += record["wall_s"]
+            s["cpu"] += record["cpu_s"]
+            s["rss"] = max(s["rss"], record["peak_rss_bytes"])
+            s["bytes"] += record.get("volume_bytes", 0)
+    # Define metrics in Prometheus text exposition format
+    metrics = [
+        ("radta_stage_wall_seconds", "summary",
+         "Wall time of pipeline stages", "wall"),
+        ("radta_stage_cpu_seconds", "summary",
+         "CPU time of pipeline stages", "cpu"),
+        ("radta_stage_errors_total", "counter",
+         "Failed calls of pipeline stages", "errors"),
+        ("radta_stage_peak_rss_bytes", "gauge",
+         "Peak resident memory of processes running a stage", "rss"),
+        ("radta_stage_volume_bytes_total", "counter",
+         "Size of the volumes processed by a stage", "bytes"),
+    ]
+    lines = ["# HELP radta_run_info RadTA run of these metrics",
+             "# TYPE radta_run_info gauge",
+             'radta_run_info{run="' + str(run) + '"} 1']
+    for metric, mtype, text, field in metrics:
+        lines.append("# HELP " + metric + " " + text)
+        lines.append("# TYPE " + metric + " " + mtype)
+        for name, s in sorted(summary.items()):
+            label = '{stage="' + name + '"}'
+            if mtype == "summary":
+                lines.append(metric + "_sum" + label + " " + repr(s[field]))
+                lines.append(metric + "_count" + label + " " + str(s["count"]))
+            else : lines.append(metric + label + " " + str(s[field]))
+    # Store metrics atomically (e.g. for a node exporter textfile collector)
+    path_metrics = os.path.join(path_output, METRICS_FILE)
+    with open(path_metrics + ".tmp", "w") as fh : fh.write("\n".join(lines) + "\n")
+    os.replace(path_metrics + ".tmp", path_metrics)
+    return path_metrics
\ No newline at end of file
@@ -0,0 +1,98 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import json
+import time
+
+#-----------------------------------------------------#
+#                Journal Configuration                #
+#-----------------------------------------------------#
+# Run journal in the output directory (one JSON record per line)
+JOURNAL_FILE = "journal.jsonl"
+# Final states of a journaled task (volume, regions or volume-pair)
+JOURNAL_DONE = "done"
+JOURNAL_FAILED = "failed"
+
+#-----------------------------------------------------#
+#                   Journal Records                   #
+#-----------------------------------------------------#
+def get_journal_path(path_output):
+    return os.path.join(path_output, JOURNAL_FILE)
+
+def start_journal(path_output, resume=False):
+    # Start a new journal or continue the journal of an interrupted run
+    if not os.path.exists(path_output) : os.makedirs(path_output)
+    path_journal = get_journal_path(path_output)
+    if not resume and os.path.exists(path_journal) : os.remove(path_journal)
+    states = load_journal(path_output) if resume else {}
+    write_journal(path_output, "run", str(os.getpid()),
+                  "resume" if resume else "start")
+    return states
+
+def write_journal(path_output, kind, name, state, **info):
+    # Append a record of a single task
+    append_journal(path_output, [create_record(kind, name, state, **info)])
+
+def write_journal_batch(path_output, kind, names, state):
+    # Append records of many tasks at once (a single disk sync)
+    append_journal(path_output, [create_record(kind, name, state) \
+                                 for name in names])
+
+def create_record(kind, name, state, **info):
+    return {"time": time.time(), "kind": kind, "name": str(name),
+            "state": state, **info}
+
+def append_journal(path_output, records):
+    # Append records and force them to disk (survives a crash of the run)
+    if len(records) == 0 : return
+    lines = "".join(json.dumps(r, default=str) + "\n" for r in records)
+    with open(get_journal_path(path_output), "a") as fh:
+        fh.write(lines)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+def load_journal(path_output):
+    # Latest state of each task (a truncated last line of a crash is ignored)
+    states = {}
+    path_journal = get_journal_path(path_output)
+    if not os.path.exists(path_journal) : return states
+    with open(path_journal, "r") as fh:
+        for line in fh:
+            try : record = json.loads(line)
+            except ValueError : continue
+            states[(record["kind"], record["name"])] = record
+    return states
+
+def is_done(states, kind, name, path_result=None):
+    # Task finished in an earlier run and its result still exists
+    record = states.get((kind, str(name)))
+    if record is None or record["state"] != JOURNAL_DONE : return False
+    return path_result is None or os.path.exists(path_result)
+
+def journal_events(path_output, kind):
+    # Event callback of the job runners which records each state change
+    def on_event(job_id, state, **info):
+        write_journal(path_output, kind, job_id, state, **info)
+    return on_event
\ No newline at end of file
@@ -22,40 +22,161 @@
 #-----------------------------------------------------#
 #                   Library imports                   #
 #-----------------------------------------------------#
-import os
-from pathlib import Path
 from cli import parse_arguments
-from boa import run_boa
-from process import process_boa_results
-from evaluate import run_eval
-from tqdm import tqdm
+from instrument import enable_trace, write_metrics, stage
+# Pipeline steps are imported lazily by the subcommands requiring them
+# (e.g. an evaluation never loads BOA, the GPU stack or plotnine)
+
+#-----------------------------------------------------#
+#                   Pipeline Steps                    #
+#-----------------------------------------------------#
+def plan_volumes(input_vol_pre, input_vol_post, path_output, args, append=False):
+    from scheduler import build_plan
+    from manifest import run_preflight, apply_manifest
+    from shard import select_shard
+    # Plan segmentation of unique volumes and processing of volume-pairs
+    volumes, pairs = build_plan(input_vol_pre, input_vol_post, path_output,
+                                longitudinal=args.longitudinal)
+    # Validate volume headers and schedule the most expensive volumes first
+    manifest, costs = run_preflight(volumes, pairs, path_output, append)
+    if "preflight" in args and args.preflight : raise SystemExit(0)
+    volumes, pairs, failed_preflight = apply_manifest(volumes, pairs,
+                                                      manifest, costs)
+    # Select the volume-pairs of this node in a multi-node run
+    if "shard" in args and args.shard is not None:
+        volumes, pairs = select_shard(volumes, pairs, costs, *args.shard)
+    return volumes, pairs, failed_preflight
+
+def run_segmentation(volumes, pairs, path_output, args, process=True):
+    from scheduler import run_sequential, run_parallel
+    from boa import get_required_models
+    from cache import enable_volume_cache
+    from journal import start_journal
+    # Activate the cache of decompressed volumes
+    if args.path_volcache is not None:
+        enable_volume_cache(args.path_volcache, args.volcache_size)
+    # Identify BOA models required for the requested features
+    models = get_required_models(args.models, args.features)
+    if args.native : models = get_required_models(models + ["total"])
+    # Journal the state of all tasks (continued with --resume)
+    states = start_journal(path_output, args.resume)
+    # Segmentation without processing stores no tables
+    output_format = args.output_format if "output_format" in args else "parquet"
+
+    # Process queue in parallel via a process pool
+    if args.workers > 1:
+        rt_cohort, failed = run_parallel(volumes, pairs, path_output, args.workers,
+                                         path_cache=args.path_cache,
+                                         cache_size=args.cache_size,
+                                         refresh=args.refresh,
+                                         path_worker=args.path_worker,
+                                         models=models, fast=args.fast,
+                                         features=args.features,
+                                         native=args.native,
+                                         hu_window=args.hu_window,
+                                         states=states,
+                                         timeout=args.timeout,
+                                         retries=args.retries,
+                                         backoff=args.backoff,
+                                         process=process,
+                                         retention=args.retention,
+                                         output_format=output_format)
+    # Process queue sequentially
+    else:
+        rt_cohort, failed = run_sequential(volumes, pairs, path_output,
+                                           path_cache=args.path_cache,
+                                           cache_size=args.cache_size,
+                                           refresh=args.refresh,
+                                           path_worker=args.path_worker,
+                                           models=models, fast=args.fast,
+                                           features=args.features,
+                                           native=args.native,
+                                           hu_window=args.hu_window,
+                                           states=states,
+                                           timeout=args.timeout,
+                                           retries=args.retries,
+                                           backoff=args.backoff,
+                                           process=process,
+                                           retention=args.retention,
+                                           output_format=output_format)
+    return rt_cohort, failed
+
+def run_evaluation(path_output, args, rt_cohort=None, n_pairs=None, plots=True):
+    from evaluate import run_eval
+    # Compute statistics (and render figures) of all radiomics tables
+    with stage("evaluation", pairs=n_pairs):
+        run_eval(path_output, rt_merged=rt_cohort,
+                 incremental=args.incremental,
+                 analysis=plots and not args.no_analysis,
+                 workers=args.workers if plots else 1,
+                 chunk_size=args.chunk_size,
+                 n_resamples=args.n_resamples,
+                 seed=args.seed,
+                 test=args.test if plots else "ttest",
+                 correction=args.correction if plots else "fdr",
+                 path_metadata=args.path_metadata,
+                 stratify_by=args.stratify_by,
+                 strata_mode=args.strata_mode,
+                 plots=plots,
+                 output_format=args.output_format)
 
 #-----------------------------------------------------#
 #                     RadTA Runner                    #
 #-----------------------------------------------------#
 if __name__ == "__main__":
     # Parse arguments via CI
-    input_vol_pre, input_vol_post, path_output, mode_single = parse_arguments()
-        
-    # Process queue
-    for i in tqdm(range(0, len(input_vol_pre))):
-        # Get next volumes from the queue
-        path_vol_pre = input_vol_pre[i]
-        path_vol_post = input_vol_post[i]
-
-        # Run TotalSegmentator and BOA
-        pboa_pre, pboa_post = run_boa(path_vol_pre, path_vol_post, path_output)
-        # Load and parse BOA results into a feature table
-        dt_ft = process_boa_results(pboa_pre, pboa_post)
+    input_vol_pre, input_vol_post, path_output, mode_single, args = parse_arguments()
+    # Activate per-stage instrumentation
+    if args.trace : enable_trace(path_output)
 
-        # Store radiomics table including differences
-        name_pre = str(path_vol_pre).split("/")[-1].split(".")[0]
-        name_post = str(path_vol_post).split("/")[-1].split(".")[0]
-        if name_pre != name_post:
-            path_out_diff = os.path.join(path_output, name_pre + "-" + name_post)
-        else:
-            path_out_diff = os.path.join(path_output, name_pre)
-        dt_ft.to_csv(path_out_diff + ".csv", index=False)
+    # Segment all volumes (without creating radiomics tables)
+    if args.command == "segment":
+        volumes, pairs, _ = plan_volumes(input_vol_pre, input_vol_post,
+                                         path_output, args)
+        run_segmentation(volumes, pairs, path_output, args, process=False)
+    # Create radiomics tables from existing BOA outputs
+    elif args.command == "process":
+        from scheduler import build_plan, run_processing
+        volumes, pairs = build_plan(input_vol_pre, input_vol_post, path_output,
+                                    longitudinal=args.longitudinal)
+        run_processing(volumes, pairs, path_output, features=args.features,
+                       native=args.native, output_format=args.output_format)
+    # Evaluate existing radiomics tables (statistics only)
+    elif args.command == "evaluate":
+        run_evaluation(path_output, args, plots=False)
+    # Render figures of an existing evaluation
+    elif args.command == "plot":
+        from plot import run_plots
+        with stage("plot"):
+            run_plots(path_output, analysis=not args.no_analysis,
+                      workers=args.workers, test=args.test,
+                      correction=args.correction)
+    # Process new volume-pairs as they arrive and evaluate them periodically
+    elif args.command == "watch":
+        from watch import run_watch
+        def process_batch(queue_vol_pre, queue_vol_post):
+            volumes, pairs, _ = plan_volumes(queue_vol_pre, queue_vol_post,
+                                             path_output, args, append=True)
+            run_segmentation(volumes, pairs, path_output, args)
+        run_watch(args.vol_pre, args.vol_post, process_batch,
+                  lambda: run_evaluation(path_output, args),
+                  poll=args.poll, settle=args.settle,
+                  interval=args.eval_interval)
+    # Run the complete pipeline
+    else:
+        volumes, pairs, failed_preflight = plan_volumes(input_vol_pre,
+                                                        input_vol_post,
+                                                        path_output, args)
+        rt_cohort, failed = run_segmentation(volumes, pairs, path_output, args)
+        failed = failed_preflight + failed
+        # Store partial result bundle of this shard (evaluated by radta/merge.py)
+        if args.shard is not None:
+            from shard import write_bundle
+            write_bundle(path_output, pairs, args.shard, rt_cohort, args.chunk_size,
+                         args.output_format)
+        # If directory mode, run evaluation
+        elif not mode_single:
+            run_evaluation(path_output, args, rt_cohort, len(pairs))
 
-    # If directory mode, run evaluation
-    if not mode_single : run_eval(path_output)
\ No newline at end of file
+    # Summarize instrumentation as Prometheus metrics
+    if args.trace : write_metrics(path_output)
\ No newline at end of file
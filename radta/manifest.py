@@ -0,0 +1,191 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from instrument import stage, get_path_size
+
+#-----------------------------------------------------#
+#                Pre-flight Configuration             #
+#-----------------------------------------------------#
+# Name of the pre-flight manifest in the output directory
+MANIFEST_FILE = "manifest.csv"
+# Voxel spacing (mm) to which TotalSegmentator resamples the volumes
+COST_SPACING = 1.5
+# Voxel data types of CT volumes (masks or RGB images are rejected)
+CT_DTYPES = ["int16", "int32", "uint16", "float32", "float64"]
+# Size of the file sample (bytes) used to detect duplicate volumes
+SAMPLE_SIZE = 1 << 16
+# Issues which exclude a volume-pair from processing
+ERRORS = ["missing", "unreadable", "not 3D", "non-CT data type",
+          "same volume as pre and post", "duplicate pair name"]
+
+#-----------------------------------------------------#
+#                  NIfTI Header Reader                #
+#-----------------------------------------------------#
+def sample_fingerprint(vol, header):
+    # Header, file size and a small sample from the middle of the file
+    size = os.path.getsize(vol)
+    with open(vol, "rb") as fh:
+        fh.seek(max(0, size // 2 - SAMPLE_SIZE // 2))
+        sample = hashlib.sha256(fh.read(SAMPLE_SIZE)).hexdigest()
+    return (size, header.binaryblock, sample)
+
+def read_volume_header(vol):
+    # Collect volume information without loading any voxel data
+    info = {"shape": "", "spacing": "", "dtype": "", "orientation": "",
+            "cost": 0.0, "fingerprint": None, "issues": []}
+    if not os.path.exists(vol):
+        info["issues"].append("missing")
+        return info
+    # DICOM directories are not validated, cost is estimated by size (int16)
+    if os.path.isdir(vol):
+        info["cost"] = get_path_size(vol) / 2
+        return info
+    # NIfTI reader is only loaded for the pre-flight (not by the evaluation)
+    import nibabel as nib
+    try : img = nib.load(str(vol))
+    except Exception:
+        info["issues"].append("unreadable")
+        return info
+    # Parse header (nibabel proxies the voxel data, only the header is read)
+    header = img.header
+    shape = header.get_data_shape()
+    zooms = header.get_zooms()
+    dtype = header.get_data_dtype()
+    info["shape"] = "x".join(str(s) for s in shape)
+    info["spacing"] = "x".join(str(round(float(z), 3)) for z in zooms[:3])
+    info["dtype"] = dtype.name
+    info["fingerprint"] = sample_fingerprint(vol, header)
+    # Validate volume as a single 3D CT volume
+    if len(shape) < 3 or (len(shape) > 3 and int(np.prod(shape[3:])) > 1):
+        info["issues"].append("not 3D")
+        return info
+    if dtype.name not in CT_DTYPES : info["issues"].append("non-CT data type")
+    info["orientation"] = "".join(nib.aff2axcodes(img.affine))
+    # Estimate cost as number of voxels after resampling
+    extent = np.asarray(shape[:3], dtype=float) * np.asarray(zooms[:3], dtype=float)
+    info["cost"] = float(np.prod(extent / COST_SPACING))
+    return info
+
+#-----------------------------------------------------#
+#                 Volume-Pair Validation              #
+#-----------------------------------------------------#
+def validate_pair(vol_pre, vol_post, info_pre, info_post):
+    # Issues of the individual volumes
+    issues = [i + " (pre)" for i in info_pre["issues"]] + \
+             [i + " (post)" for i in info_post["issues"]]
+    if vol_pre == vol_post : issues.append("same volume as pre and post")
+    # Warn about volumes which can not be compared voxel-wise
+    if info_pre["orientation"] and info_post["orientation"] and \
+        info_pre["orientation"] != info_post["orientation"]:
+        issues.append("orientation mismatch")
+    if info_pre["cost"] > 0 and info_post["cost"] > 0 and \
+        max(info_pre["cost"], info_post["cost"]) > \
+        4 * min(info_pre["cost"], info_post["cost"]):
+        issues.append("field of view mismatch")
+    return issues
+
+def get_status(issues):
+    # Pair status: error (excluded), warning or ok
+    if any(i.split(" (")[0] in ERRORS for i in issues) : return "error"
+    elif issues : return "warning"
+    else : return "ok"
+
+#-----------------------------------------------------#
+#                 Pre-flight Manifest                 #
+#-----------------------------------------------------#
+def run_preflight(volumes, pairs, path_output, append=False):
+    with stage("preflight", volumes=len(volumes)):
+        # Read headers of all unique volumes
+        infos = {vol: read_volume_header(vol) for vol in volumes}
+        # Flag different files with identical header, size and content sample
+        seen = {}
+        for vol, info in infos.items():
+            if info["fingerprint"] is None : continue
+            if info["fingerprint"] in seen:
+                info["issues"].append("possible duplicate of " + \
+                                      str(seen[info["fingerprint"]]))
+            else : seen[info["fingerprint"]] = vol
+
+        # Validate volume-pairs
+        rows = []
+        names = set()
+        for vol_pre, vol_post, name_pair in pairs:
+            info_pre, info_post = infos[vol_pre], infos[vol_post]
+            issues = validate_pair(vol_pre, vol_post, info_pre, info_post)
+            if name_pair in names : issues.append("duplicate pair name")
+            names.add(name_pair)
+            rows.append({"volume_pair": name_pair,
+                         "vol_pre": str(vol_pre),
+                         "vol_post": str(vol_post),
+                         "shape_pre": info_pre["shape"],
+                         "shape_post": info_post["shape"],
+                         "spacing_pre": info_pre["spacing"],
+                         "spacing_post": info_post["spacing"],
+                         "dtype_pre": info_pre["dtype"],
+                         "dtype_post": info_post["dtype"],
+                         "cost": info_pre["cost"] + info_post["cost"],
+                         "status": get_status(issues),
+                         "issues": "; ".join(issues)})
+        manifest = pd.DataFrame(rows, columns=["volume_pair", "vol_pre",
+                        "vol_post", "shape_pre", "shape_post", "spacing_pre",
+                        "spacing_post", "dtype_pre", "dtype_post", "cost",
+                        "status", "issues"])
+
+        # Store manifest in the output directory
+        os.makedirs(path_output, exist_ok=True)
+        path_manifest = os.path.join(path_output, MANIFEST_FILE)
+        # Keep rows of earlier batches (watch mode), replace those of this batch
+        if append and os.path.exists(path_manifest):
+            stored = pd.read_csv(path_manifest, keep_default_na=False,
+                                 dtype={"volume_pair": str})
+            stored = stored[~stored["volume_pair"].isin(names)]
+            pd.concat([stored, manifest]).to_csv(path_manifest, index=False)
+        else : manifest.to_csv(path_manifest, index=False)
+    # Return manifest and volume costs
+    costs = {vol: info["cost"] for vol, info in infos.items()}
+    return manifest, costs
+
+def apply_manifest(volumes, pairs, manifest, costs):
+    # Exclude volume-pairs with errors (manifest rows follow the pair order)
+    errors = (manifest["status"]=="error").tolist()
+    for _, row in manifest[manifest["status"]=="error"].iterrows():
+        print("RadTA: Pre-flight excluded volume-pair " + row["volume_pair"] + \
+              " (" + row["issues"] + ")")
+    n_warn = (manifest["status"]=="warning").sum()
+    if n_warn > 0:
+        print("RadTA: Pre-flight warnings for " + str(n_warn) + \
+              " volume-pair(s), see " + MANIFEST_FILE)
+    pairs_ok = [p for p, e in zip(pairs, errors) if not e]
+    failed = [p[2] for p, e in zip(pairs, errors) if e]
+    # Schedule most expensive volumes first (shorter tail in parallel runs)
+    required = set(v for p in pairs_ok for v in p[:2])
+    order = sorted([vol for vol in volumes if vol in required],
+                   key=lambda vol: -costs[vol])
+    volumes_ok = {vol: volumes[vol] for vol in order}
+    # Return scheduled volumes, valid volume-pairs and excluded pair names
+    return volumes_ok, pairs_ok, failed
\ No newline at end of file
@@ -0,0 +1,80 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import argparse
+from pathlib import Path
+from cli import add_eval_arguments, check_eval_arguments
+from shard import merge_bundles
+from evaluate import TABLE_FORMATS, run_eval, find_table
+
+#-----------------------------------------------------#
+#                 Shard Merge Runner                  #
+#-----------------------------------------------------#
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Merge shard bundles of a " + \
+                                     "multi-node RadTA run and evaluate the cohort")
+    parser.add_argument("bundles", 
+                        type=Path,
+                        nargs="+",
+                        help="Output directories of the shards (radta/main.py --shard)")
+    parser.add_argument("-o", "--output", 
+                        type=Path,
+                        help="Path to evaluation output directory",
+                        default="out/",
+                        dest="path_output")
+    parser.add_argument("-w", "--workers", 
+                        type=int,
+                        help="Number of parallel workers for rendering figures",
+                        default=1,
+                        dest="workers")
+    add_eval_arguments(parser)
+    # Without --format, the output format of the shard bundles is kept
+    parser.set_defaults(output_format=None)
+    args = parser.parse_args()
+    check_eval_arguments(args)
+
+    # Merge radiomics tables and aggregates of all shards
+    merge_bundles(args.bundles, args.path_output)
+    # Identify the output format of the shards from the merged radiomics table
+    # (another format requires a full recomputation of the evaluation)
+    if args.output_format is None:
+        path_rt = find_table(os.path.join(args.path_output, "evaluation"),
+                             "radiomics_table")
+        formats = {ext: fmt for fmt, ext in TABLE_FORMATS.items()}
+        args.output_format = formats[os.path.splitext(path_rt)[1]]
+    # Evaluate cohort from the merged aggregates (tables are not read again)
+    run_eval(args.path_output, incremental=True,
+             analysis=not args.no_analysis,
+             workers=args.workers,
+             chunk_size=args.chunk_size,
+             n_resamples=args.n_resamples,
+             seed=args.seed,
+             test=args.test,
+             correction=args.correction,
+             path_metadata=args.path_metadata,
+             stratify_by=args.stratify_by,
+             strata_mode=args.strata_mode,
+             output_format=args.output_format)
@@ -0,0 +1,276 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import warnings
+import pandas as pd
+from plotnine import *
+import patchworklib as pw
+from render import render_figures
+from instrument import stage
+from evaluate import RT_ANALYSIS_COLS, load_radiomics_table, find_table, \
+                     read_table
+from strata import STRATA_DIR
+
+#-----------------------------------------------------#
+#                    Plot Function                    #
+#-----------------------------------------------------#
+def run_plots(path_output, analysis=True, workers=1, test="ttest",
+              correction="fdr"):
+    # Render figures from the stored tables of a finished evaluation
+    path_eval = os.path.join(path_output, "evaluation")
+    path_table = find_table(path_eval, "evaluation_table")
+    if path_table is None:
+        raise ValueError("RadTA: No evaluation table found in " + path_eval + \
+                         " (run the evaluation first).")
+    dt_eval = load_evaluation_table(path_table)
+    if test == "permutation" and ("perm_pvalue" not in dt_eval or \
+                                  dt_eval["perm_pvalue"].isna().all()):
+        raise ValueError("RadTA: Permutation test requires an evaluation " + \
+                         "with resamples (--resamples).")
+    # Plot summary figure as heatmap
+    with stage("plot.summary"):
+        plot_summary(dt_eval, path_eval, workers, test, correction)
+    # Plot summary figures of all strata
+    path_strata = os.path.join(path_eval, STRATA_DIR)
+    if os.path.exists(path_strata):
+        paths_strata = {stratum: find_table(os.path.join(path_strata, stratum),
+                                            "evaluation_table") \
+                        for stratum in sorted(os.listdir(path_strata))}
+        tables = {stratum: load_evaluation_table(path_table) \
+                  for stratum, path_table in paths_strata.items() \
+                  if path_table is not None}
+        with stage("plot.strata", strata=len(tables)):
+            plot_strata(tables, path_eval, workers, test, correction)
+    # Plot individual analysis figures
+    if analysis:
+        with stage("plot.analysis"):
+            rt_all = load_radiomics_table(find_table(path_eval, "radiomics_table"),
+                                          RT_ANALYSIS_COLS)
+            plot_analysis(rt_all, dt_eval, path_eval, workers)
+
+def load_evaluation_table(path_table):
+    # Keys are read as strings (feature names like "NA" are no missing values)
+    return read_table(path_table, keep_default_na=False, na_values=[""],
+                      dtype={"model": str, "feature": str, "metric": str})
+
+#-----------------------------------------------------#
+#                Summary Plots - Strata               #
+#-----------------------------------------------------#
+def plot_strata(tables, path_eval, workers=1, test="ttest", correction="fdr"):
+    # Collect heatmaps of all strata and render them together
+    path_strata = os.path.join(path_eval, STRATA_DIR)
+    jobs = []
+    for stratum, dt_stratum in tables.items():
+        jobs += get_summary_jobs(dt_stratum, os.path.join(path_strata, stratum),
+                                 test, correction, prefix=stratum + "/")
+    render_figures(jobs, path_strata, workers)
+
+#-----------------------------------------------------#
+#                Summary Plot - Heatmap               #
+#-----------------------------------------------------#
+def plot_summary(dt_eval, path_eval, workers=1, test="ttest", correction="fdr"):
+    # Render figures with changed inputs
+    jobs = get_summary_jobs(dt_eval, path_eval, test, correction)
+    render_figures(jobs, path_eval, workers)
+
+def get_summary_jobs(dt_eval, path_eval, test="ttest", correction="fdr",
+                     prefix=""):
+    # Identify p-values which define the significance levels
+    pvalue = {"ttest": "ttest_pvalue", "permutation": "perm_pvalue"}[test]
+    label = {"ttest": "Paired t-Test",
+             "permutation": "Sign-Flip Permutation Test"}[test]
+    # Tables without corrections (e.g. of older RadTA versions) fall back to
+    # the unadjusted p-values
+    if correction != "none" and pvalue + "_" + correction not in dt_eval:
+        warnings.warn("RadTA: Evaluation table has no " + pvalue + "_" + \
+                      correction + " column, using unadjusted p-values.")
+    elif correction != "none":
+        pvalue += "_" + correction
+        label += " (" + {"fdr": "FDR", "holm": "Holm"}[correction] + " adjusted)"
+    # Create one rendering job for each model
+    jobs = []
+    for model_name, dt_model in dt_eval.groupby("model", sort=False,
+                                                observed=True):
+        filename = "plot.summary." + str(model_name) + ".png"
+        jobs.append({"name": prefix + filename,
+                     "func": plot_summary_model,
+                     "data": [dt_model],
+                     "kwargs": {"model_name": str(model_name),
+                                "path_eval": path_eval,
+                                "pvalue": pvalue,
+                                "pvalue_label": label},
+                     "outputs": [os.path.join(path_eval, filename)]})
+    return jobs
+
+def plot_summary_model(dt_model, model_name, path_eval,
+                       pvalue="ttest_pvalue", pvalue_label="Paired t-Test"):
+    # Create dataframe copy for corresponding model
+    dt_model = dt_model.copy()
+
+    # Create and configure significance levels for the p-values
+    significance_bins = [0, 0.01, 0.05, 0.1, 1.0]
+    significance_names = ["<= " + str(x) for x in significance_bins[1:]]
+    significance_names[-1] = "reject"
+    significance_colors = ["#32CD32", "#7FFFD4", "#088F8F", "#800020"]
+    significance_color_map = {}
+    for i, sl in enumerate(significance_names):
+        significance_color_map[sl] = significance_colors[i]
+    # Apply significance levels to the (adjusted) pvalues
+    dt_model["significance"] = pd.cut(dt_model[pvalue], 
+                                    significance_bins,
+                                    labels=significance_names)
+    dt_model["significance"] = dt_model["significance"].astype(str)
+
+    # Round relative mean difference
+    dt_model["mean_diff_relative"] = dt_model["mean_diff_relative"].round(2)
+    dt_model["mean_diff_relative"] = dt_model["mean_diff_relative"].apply(lambda x: "+"+str(x) if x>0 else x)
+
+    # Generate summary figure
+    fig = (ggplot(dt_model, aes("metric", "feature", fill="significance"))
+                + geom_tile(color="white", size=1.5)
+                + geom_text(aes("metric", "feature", 
+                                label="mean_diff_relative"), 
+                            color="black", size=5.0)
+                # + ggtitle("Radiomic Trend Analysis Evaluation Summary for Model: " + model_name)
+                + labs(title="Radiomic Trend Analysis\n" + \
+                        "Evaluation Summary for Model: " + model_name,
+                        subtitle="Label: Mean of Relative Difference (in %)\n" + \
+                                "Color: P-value of " + pvalue_label)
+                + xlab("Measurement Metric")
+                + ylab("Feature")
+                + scale_fill_manual(values=significance_color_map)
+                + theme_bw()
+                + theme(axis_text_x=element_text(angle = 65, vjust = 1.0,
+                                                hjust = 0.99),
+                        legend_title=element_blank(),
+                        legend_direction="horizontal", 
+                        legend_box="horizontal",
+                        legend_position="top", 
+                        legend_box_just="left"))
+
+    # Compute height resolution
+    n_feat = len(dt_model["feature"].unique()) 
+    height = int(round(n_feat / 5.5)) # 5.5 is a magic number (every good tool need magic numbers)
+    height = max(height, 3)           # title and legend of small feature subsets
+
+    # Store figure to disk
+    filename = "plot.summary." + model_name + ".png"
+    fig.save(filename=filename, path=path_eval, 
+             width=8, height=height, dpi=300,
+             limitsize=False)
+
+#-----------------------------------------------------#
+#      Analysis Plot - Individual Box+Line Plots      #
+#-----------------------------------------------------#
+def plot_analysis(rt_merged, dt_eval, path_eval, workers=1):
+    # create evaluation analysis directory
+    path_eval_analysis = os.path.join(path_eval, "analysis_figures")
+    if not os.path.exists(path_eval_analysis) : os.mkdir(path_eval_analysis)
+    # Create subsets for each feature in a single grouping pass
+    rt_groups = dict(list(rt_merged.groupby("feature", sort=False,
+                                            observed=True)))
+    jobs = []
+    for feat, dt_eval_feat in dt_eval.groupby("feature", sort=False,
+                                              observed=True):
+        if feat not in rt_groups : continue
+        # filter out nan rows
+        dt_eval_feat = dt_eval_feat.dropna(subset=["mean_diff_absolute"], 
+                                           axis=0)
+        dt_merged_feat = rt_groups[feat].dropna(subset=["volume_pre", 
+                                                        "volume_post"], 
+                                                axis=0)
+        dt_merged_feat = dt_merged_feat[["metric", "volume_pre", "volume_post"]]
+        dt_merged_feat = dt_merged_feat.assign(
+                            metric=dt_merged_feat["metric"].astype(str))
+        # Skip empty feature tables
+        if dt_merged_feat.empty : continue
+        # Create rendering job for the feature
+        outputs = [os.path.join(path_eval_analysis, 
+                                "plot.analysis." + str(feat) + "." + pos + ".png") \
+                   for pos in ["topleft", "topright", "bottom"]]
+        jobs.append({"name": "plot.analysis." + str(feat),
+                     "func": plot_analysis_feature,
+                     "data": [dt_eval_feat, dt_merged_feat],
+                     "kwargs": {"feat": str(feat),
+                                "path_eval_analysis": path_eval_analysis},
+                     "outputs": outputs})
+    # Render figures with changed inputs
+    render_figures(jobs, path_eval, workers)
+
+def plot_analysis_feature(dt_eval_feat, dt_merged_feat, feat, 
+                          path_eval_analysis):
+    # Generate feature analysis figure - TOP LEFT
+    figtopleft = (ggplot(dt_eval_feat, aes("metric", "mean_diff_relative"))
+                + geom_boxplot()
+                + labs(title="Boxplot - Mean Relative Difference: " + feat)
+                + xlab("")
+                + ylab("Mean Relative Difference")
+                + facet_wrap("metric", scales = "free", shrink=True)
+                + theme_bw()
+                + theme(legend_text=element_text(size=1)))
+    filename = "plot.analysis." + feat + ".topleft.png"
+    figtopleft.save(filename=filename, path=path_eval_analysis, 
+             width=4, height=4, dpi=300,
+             limitsize=False)
+    # Generate feature analysis figure - TOP RIGHT
+    figtopright = (ggplot(dt_eval_feat, aes("metric", "mean_diff_absolute"))
+                + geom_boxplot()
+                + labs(title="Boxplot - Mean Absolute Difference: " + feat)
+                + xlab("")
+                + ylab("Mean Absolute Difference")
+                + facet_wrap("metric", scales = "free")
+                + theme_bw()
+                + theme(legend_text=element_text(size=3),
+                        subplots_adjust={"wspace": 5.0}))
+    # Store figure to disk
+    filename = "plot.analysis." + feat + ".topright.png"
+    figtopright.save(filename=filename, path=path_eval_analysis, 
+             width=4, height=4, dpi=300,
+             limitsize=False)
+
+    # Generate feature analysis figure - BOTTOM
+    figbot = (ggplot(dt_merged_feat, aes("volume_pre", "volume_post"))
+                + geom_point(size=0.5, color="royalblue")
+                + geom_abline(intercept=1, linetype="dashed", size=0.5)
+                + labs(title="Direct Comparison: " + feat)
+                + xlab("Pre-Volume: Measurement")
+                + ylab("Post-Volume: Measurement")
+                + facet_wrap("metric", scales = "free")
+                + theme_bw()
+                + theme(legend_text=element_text(size=1)))
+    # Store figure to disk
+    filename = "plot.analysis." + feat + ".bottom.png"
+    figbot.save(filename=filename, path=path_eval_analysis, 
+             width=8, height=4, dpi=300,
+             limitsize=False)
+    
+    # # Multi-plot Call
+    # g1 = pw.load_ggplot(figtopleft, figsize=(4,4))
+    # g2 = pw.load_ggplot(figtopright, figsize=(4,4))
+    # gbot = pw.load_ggplot(figbot, figsize=(8,4))
+    # g12b = (g1|g2)/gbot
+    # path_fig = os.path.join(path_eval_analysis,
+    #                         "plot.analysis." + feat + ".png")
+    # g12b.savefig(path_fig)
\ No newline at end of file
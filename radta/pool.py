@@ -0,0 +1,227 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import time
+import signal
+import traceback
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from tqdm import tqdm
+
+#-----------------------------------------------------#
+#                Worker Thread Budget                 #
+#-----------------------------------------------------#
+THREAD_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+               "NUMEXPR_NUM_THREADS", "VECLIB_MAXIMUM_THREADS"]
+
+def get_thread_budget(workers):
+    # Split available cores evenly across workers
+    return max(1, (os.cpu_count() or 1) // workers)
+
+def init_worker(n_threads):
+    # Environment is inherited from the parent, torch has to be set explicitly
+    for var in THREAD_VARS : os.environ[var] = str(n_threads)
+    try:
+        import torch
+        torch.set_num_threads(n_threads)
+    except ImportError : pass
+
+#-----------------------------------------------------#
+#                   Process Pool Jobs                 #
+#-----------------------------------------------------#
+def run_jobs(func, jobs, workers, desc=None, retries=2):
+    # Define thread budget before spawning (BLAS reads it at import time)
+    n_threads = get_thread_budget(workers)
+    for var in THREAD_VARS : os.environ[var] = str(n_threads)
+    # Run jobs in a process pool, a crashed worker only restarts the pool
+    results = {}
+    attempts = {job_id: 0 for job_id in jobs}
+    pending = list(jobs)
+    suspects = []
+    pbar = tqdm(total=len(jobs), desc=desc)
+    while pending or suspects:
+        # Jobs which were running when a worker died are retried one at a time,
+        # so the crash is only charged to the job which caused it
+        isolate = len(suspects) > 0
+        queue = suspects if isolate else pending
+        slots = 1 if isolate else workers
+        with ProcessPoolExecutor(max_workers=slots,
+                                 mp_context=mp.get_context("spawn"),
+                                 initializer=init_worker,
+                                 initargs=(n_threads,)) as pool:
+            # Keep at most one job per worker in flight
+            running = {}
+            broken = False
+            while (queue or running) and not broken:
+                while queue and len(running) < slots:
+                    job_id = queue.pop(0)
+                    running[pool.submit(func, **jobs[job_id])] = job_id
+                future = next(as_completed(running))
+                job_id = running.pop(future)
+                try:
+                    results[job_id] = future.result()
+                except BrokenProcessPool as e:
+                    # Worker died (e.g. OOM kill) -> retry job in a new pool
+                    broken = True
+                    if not isolate:
+                        suspects.append(job_id)
+                        continue
+                    attempts[job_id] += 1
+                    if attempts[job_id] <= retries:
+                        suspects.append(job_id)
+                        continue
+                    results[job_id] = e
+                except Exception as e:
+                    results[job_id] = e
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                pbar.update(1)
+            # Other jobs of a broken pool did not necessarily cause the crash
+            suspects += list(running.values())
+    pbar.close()
+    return results
+
+#-----------------------------------------------------#
+#                  Isolated Job Runner                #
+#-----------------------------------------------------#
+def run_isolated(func, jobs, workers, desc=None, timeout=None, retries=2,
+                 backoff=30.0, on_event=None):
+    # Run each job in its own process: a hung job is killed after the timeout
+    # and failed jobs are retried with exponential backoff (others continue)
+    n_threads = get_thread_budget(workers)
+    for var in THREAD_VARS : os.environ[var] = str(n_threads)
+    ctx = mp.get_context("spawn")
+    results = {}
+    attempts = {job_id: 0 for job_id in jobs}
+    ready = {job_id: 0.0 for job_id in jobs}
+    pending = list(jobs)
+    running = {}
+    pbar = tqdm(total=len(jobs), desc=desc)
+    try:
+        while pending or running:
+            # Start jobs (after their backoff) as long as workers are free
+            now = time.monotonic()
+            for job_id in [j for j in pending if ready[j] <= now]:
+                if len(running) >= workers : break
+                conn_recv, conn_send = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=run_isolated_job,
+                                   args=(func, jobs[job_id], n_threads, conn_send))
+                proc.start()
+                conn_send.close()
+                attempts[job_id] += 1
+                deadline = None if timeout is None else now + timeout
+                running[job_id] = (proc, conn_recv, deadline)
+                pending.remove(job_id)
+                if on_event : on_event(job_id, "running", attempt=attempts[job_id])
+            # Sleep until a job finishes, a deadline passes or a backoff expires
+            wakeups = [r[2] for r in running.values() if r[2] is not None]
+            if len(running) < workers : wakeups += [ready[j] for j in pending]
+            wait_s = None if not wakeups else max(0.0, min(wakeups) - time.monotonic())
+            wait([r[1] for r in running.values()] + \
+                 [r[0].sentinel for r in running.values()], timeout=wait_s)
+            # Collect finished, crashed and hung jobs
+            for job_id, (proc, conn, deadline) in list(running.items()):
+                if conn.poll():
+                    try : status, result = conn.recv()
+                    except EOFError:
+                        status, result = "error", RuntimeError("RadTA: Job " + \
+                                         str(job_id) + " died without a result")
+                elif not proc.is_alive():
+                    status, result = "error", RuntimeError("RadTA: Job " + \
+                                     str(job_id) + " died (exit code " + \
+                                     str(proc.exitcode) + ")")
+                elif deadline is not None and time.monotonic() >= deadline:
+                    kill_job(proc)
+                    status, result = "error", TimeoutError("RadTA: Job " + \
+                                     str(job_id) + " exceeded the timeout of " + \
+                                     str(timeout) + "s")
+                else : continue
+                proc.join()
+                # Processes started by a failed job (e.g. nnU-Net workers) are reaped
+                if status == "error" : kill_job(proc)
+                conn.close()
+                del running[job_id]
+                # Retry failed job after an exponential backoff
+                if status == "error" and attempts[job_id] <= retries:
+                    delay = backoff * 2 ** (attempts[job_id] - 1)
+                    ready[job_id] = time.monotonic() + delay
+                    pending.append(job_id)
+                    if on_event : on_event(job_id, "retry", attempt=attempts[job_id],
+                                           error=repr(result), backoff_s=delay)
+                    continue
+                results[job_id] = result
+                if on_event:
+                    if status == "ok" : on_event(job_id, "done", attempt=attempts[job_id])
+                    else : on_event(job_id, "failed", attempt=attempts[job_id],
+                                    error=repr(result))
+                pbar.update(1)
+    # Never leave jobs (and the processes they started) behind
+    finally:
+        for proc, conn, _ in running.values():
+            kill_job(proc)
+            conn.close()
+        pbar.close()
+    return results
+
+def kill_job(proc):
+    # Kill a job together with all processes it started (own process group)
+    if hasattr(os, "killpg"):
+        try : os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError) : pass
+    proc.kill()
+    proc.join()
+
+def run_isolated_job(func, kwargs, n_threads, conn):
+    # Execute job in a fresh process and send back its result or exception
+    # (not daemonic, as BOA/nnU-Net start processes of their own)
+    if hasattr(os, "setpgid") : os.setpgid(0, 0)
+    init_worker(n_threads)
+    try : result = ("ok", func(**kwargs))
+    except Exception as e:
+        traceback.print_exception(type(e), e, e.__traceback__)
+        result = ("error", e)
+    try : conn.send(result)
+    except Exception : conn.send(("error", RuntimeError(repr(result[1]))))
+    conn.close()
+
+def run_retrying(func, kwargs, job_id, retries=2, backoff=30.0, on_event=None):
+    # Run a job in this process and retry failures with exponential backoff
+    for attempt in range(1, retries + 2):
+        if on_event : on_event(job_id, "running", attempt=attempt)
+        try : result = func(**kwargs)
+        except Exception as e:
+            if attempt > retries:
+                if on_event : on_event(job_id, "failed", attempt=attempt,
+                                       error=repr(e))
+                raise
+            delay = backoff * 2 ** (attempt - 1)
+            traceback.print_exception(type(e), e, e.__traceback__)
+            if on_event : on_event(job_id, "retry", attempt=attempt,
+                                   error=repr(e), backoff_s=delay)
+            time.sleep(delay)
+            continue
+        if on_event : on_event(job_id, "done", attempt=attempt)
+        return result
@@ -22,20 +22,120 @@
 #-----------------------------------------------------#
 #                   Library imports                   #
 #-----------------------------------------------------#
+import os
+import warnings
+from fnmatch import fnmatchcase
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from instrument import stage
 
 #-----------------------------------------------------#
 #                  BOA Output Loader                  #
 #-----------------------------------------------------#
-def load_boa_results(path_boa_outcome):
-    # Load BCA results from the BOA outcome Excel
-    dt_bca = pd.read_excel(path_boa_outcome, sheet_name="bca-aggregated_measurements")
-    # Load TotalSegmentator results from the BOA outcome Excel
-    dt_ts = pd.read_excel(path_boa_outcome, sheet_name="regions-statistics")
+# Sheets of the BOA outcome Excel which are used by RadTA
+SHEET_BCA = "bca-aggregated_measurements"
+SHEET_TS = "regions-statistics"
+# Alternative sheet names of the BCA results (depending on BOA version)
+SHEET_BCA_ALIASES = [SHEET_BCA, "bca-aggregated-measurements"]
+# Minimal columns of a sheet which was not computed (subset of BOA models)
+COLS_BCA = ["BodyPart", "Present", "AggregationType"]
+COLS_TS = ["ModelName", "BodyRegion", "Present"]
+# Parquet metadata key with the state (size, mtime) of the source BOA outcome
+SOURCE_KEY = b"radta.source"
+
+def get_native_path(path_boa_outcome):
+    # Native region statistics (radta/regions.py) replace the 'total' model rows
+    # of the TotalSegmentator sheet and are stored next to the BOA outcome Excel
+    return os.path.join(os.path.dirname(str(path_boa_outcome)), "regions.parquet")
+
+def get_columnar_paths(path_boa_outcome):
+    # Columnar cache files are stored next to the BOA outcome Excel
+    path_base = os.path.splitext(str(path_boa_outcome))[0]
+    return path_base + ".bca.parquet", path_base + ".ts.parquet"
+
+def get_source_state(path_boa_outcome):
+    # Size and modification time identify the BOA outcome Excel of a cache file
+    fstat = os.stat(path_boa_outcome)
+    return (str(fstat.st_size) + "|" + str(fstat.st_mtime_ns)).encode()
+
+def write_columnar(dt, path_parquet, state):
+    # Store sheet with the state of its source Excel in the Parquet metadata
+    table = pa.Table.from_pandas(dt, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[SOURCE_KEY] = state
+    pq.write_table(table.replace_schema_metadata(metadata), path_parquet)
+
+def is_columnar_valid(path_boa_outcome, paths_parquet):
+    # Columnar cache is only valid for the Excel it was imported from (a restored
+    # Excel keeps the modification time of its cached copy)
+    if not all(os.path.exists(p) for p in paths_parquet) : return False
+    if not os.path.exists(path_boa_outcome) : return True
+    state = get_source_state(path_boa_outcome)
+    for path_parquet in paths_parquet:
+        metadata = pq.read_schema(path_parquet).metadata or {}
+        if metadata.get(SOURCE_KEY) != state : return False
+    return True
+
+def import_boa_results(path_boa_outcome):
+    # Identify available sheets (only computed BOA models are included)
+    with pd.ExcelFile(path_boa_outcome) as workbook:
+        sheet_bca = [s for s in SHEET_BCA_ALIASES if s in workbook.sheet_names]
+        sheet_ts = [s for s in [SHEET_TS] if s in workbook.sheet_names]
+        if not sheet_bca and not sheet_ts:
+            raise ValueError("RadTA: BOA outcome " + str(path_boa_outcome) + \
+                             " contains neither BCA nor TotalSegmentator results")
+        # Parse available sheets of the BOA outcome Excel in a single pass
+        sheets = pd.read_excel(workbook, sheet_name=sheet_bca[:1] + sheet_ts)
+    # Use empty tables for missing sheets
+    if sheet_bca : dt_bca = sheets[sheet_bca[0]]
+    else : dt_bca = pd.DataFrame(columns=COLS_BCA)
+    if sheet_ts : dt_ts = sheets[SHEET_TS]
+    else : dt_ts = pd.DataFrame(columns=COLS_TS)
+    # Store sheets as columnar cache for all following loads
+    path_bca, path_ts = get_columnar_paths(path_boa_outcome)
+    try:
+        state = get_source_state(path_boa_outcome)
+        write_columnar(dt_bca, path_bca, state)
+        write_columnar(dt_ts, path_ts, state)
+    except Exception as e:
+        warnings.warn("RadTA: Columnar cache could not be written (" + \
+                      str(e) + "), falling back to Excel parsing.")
     # Return dataframes
     return dt_bca, dt_ts
 
+def load_boa_results(path_boa_outcome, native=False):
+    with stage("process.load", path=str(path_boa_outcome)) as record:
+        # Load BCA & TotalSegmentator results from the columnar cache (if valid)
+        path_bca, path_ts = get_columnar_paths(path_boa_outcome)
+        if is_columnar_valid(path_boa_outcome, [path_bca, path_ts]):
+            record["source"] = "parquet"
+            dt_bca = pd.read_parquet(path_bca)
+            dt_ts = pd.read_parquet(path_ts)
+        # Otherwise, import results from the BOA outcome Excel
+        else:
+            record["source"] = "xlsx"
+            dt_bca, dt_ts = import_boa_results(path_boa_outcome)
+        # Replace TotalSegmentator 'total' model rows by native region statistics
+        # (region statistics of all other models are kept)
+        if native:
+            dt_native = pd.read_parquet(get_native_path(path_boa_outcome))
+            dt_ts = pd.concat([dt_ts[dt_ts["ModelName"] != "Total"], dt_native],
+                              axis=0, ignore_index=True)
+    # Return dataframes
+    return dt_bca, dt_ts
+
+#-----------------------------------------------------#
+#                  Feature Selection                  #
+#-----------------------------------------------------#
+def select_features(dt, features=None):
+    # Keep only features matching one of the given (shell-style) patterns
+    if features is None : return dt
+    names = dt["feature"].astype(str).unique()
+    selected = [n for n in names if any(fnmatchcase(n, f) for f in features)]
+    return dt[dt["feature"].isin(selected)]
+
 #-----------------------------------------------------#
 #              Refine: Missing Body Parts             #
 #-----------------------------------------------------#
@@ -76,13 +176,13 @@ def refine_bca_missing_bodyparts(dt):
 #-----------------------------------------------------#
 #                    Restructuring                    #
 #-----------------------------------------------------#
-def restructure_ts(dt):
+def restructure_ts(dt, id_vars=[]):
     # Delete unnecessary cols
     cols = ["Present"]
     dt = dt.drop(columns=cols)
     # Melt dataframework into Feature-Value
     dt_melted = pd.melt(dt, 
-                        id_vars=["ModelName", "BodyRegion"], 
+                        id_vars=["ModelName", "BodyRegion"] + id_vars, 
                         value_vars=None,
                         var_name="metric", 
                         value_name="value")
@@ -103,13 +203,13 @@ def restructure_ts(dt):
     # Return restructured dataframe
     return dt_restructured
 
-def restructure_bca(dt):
+def restructure_bca(dt, id_vars=[]):
     # Delete unnecessary cols
     cols = ["Present"]
     dt = dt.drop(columns=cols)
     # Melt dataframework into Feature-Value
     dt_melted = pd.melt(dt, 
-                        id_vars=["BodyPart", "AggregationType"], 
+                        id_vars=["BodyPart", "AggregationType"] + id_vars, 
                         value_vars=None,
                         var_name="type", 
                         value_name="value")
@@ -123,7 +223,7 @@ def restructure_bca(dt):
     dt_restructured = dt_restructured.drop(columns=cols)
     # Restructure dataframe
     dt_restructured["model"] = "BCA"
-    dt_restructured = dt_restructured[["model", "feature", "metric", "value"]]
+    dt_restructured = dt_restructured[["model", "feature", "metric", "value"] + id_vars]
     # Rename metric quantile naming for better filtering later
     dt_restructured["metric"] = dt_restructured["metric"].str.replace("mL", "ml")
     dt_restructured["metric"] = dt_restructured["metric"].str.replace("Sum", "Volume")
@@ -162,31 +262,136 @@ def compute_differences(dt_merged):
 #-----------------------------------------------------#
 #                 Process BOA Results                 #
 #-----------------------------------------------------#
-def process_boa_results(boa_pre, boa_post):
+def process_boa_results(boa_pre, boa_post, features=None, native=False):
     # Load boa results
-    dt_pre_bca, dt_pre_ts = load_boa_results(boa_pre)
-    dt_post_bca, dt_post_ts = load_boa_results(boa_post)
-
-    # Refine model: TotalSegmentator
-    dt_pre_ts = refine_ts_missing_bodyparts(dt_pre_ts)
-    dt_post_ts = refine_ts_missing_bodyparts(dt_post_ts)
-    # Refine model: BCA
-    dt_pre_bca = refine_bca_missing_bodyparts(dt_pre_bca)
-    dt_post_bca = refine_bca_missing_bodyparts(dt_post_bca)
-
-    # Restructure: TotalSegmentator
-    dt_pre_ts = restructure_ts(dt_pre_ts)
-    dt_post_ts = restructure_ts(dt_post_ts)
-    # Restructure: BCA
-    dt_pre_bca = restructure_bca(dt_pre_bca)
-    dt_post_bca = restructure_bca(dt_post_bca)
+    dt_pre_bca, dt_pre_ts = load_boa_results(boa_pre, native)
+    dt_post_bca, dt_post_ts = load_boa_results(boa_post, native)
+
+    with stage("process.refine"):
+        # Refine model: TotalSegmentator
+        dt_pre_ts = refine_ts_missing_bodyparts(dt_pre_ts)
+        dt_post_ts = refine_ts_missing_bodyparts(dt_post_ts)
+        # Refine model: BCA
+        dt_pre_bca = refine_bca_missing_bodyparts(dt_pre_bca)
+        dt_post_bca = refine_bca_missing_bodyparts(dt_post_bca)
+
+    with stage("process.restructure"):
+        # Restructure: TotalSegmentator
+        dt_pre_ts = restructure_ts(dt_pre_ts)
+        dt_post_ts = restructure_ts(dt_post_ts)
+        # Restructure: BCA
+        dt_pre_bca = restructure_bca(dt_pre_bca)
+        dt_post_bca = restructure_bca(dt_post_bca)
+        # Select requested features
+        dt_pre_ts = select_features(dt_pre_ts, features)
+        dt_post_ts = select_features(dt_post_ts, features)
+        dt_pre_bca = select_features(dt_pre_bca, features)
+        dt_post_bca = select_features(dt_post_bca, features)
 
     # Merge BOA feature tables 
-    dt_merged = merge_feature_tables(dt_pre_ts, dt_pre_bca, 
-                                     dt_post_ts, dt_post_bca)
+    with stage("process.merge"):
+        dt_merged = merge_feature_tables(dt_pre_ts, dt_pre_bca, 
+                                         dt_post_ts, dt_post_bca)
     
     # Compute differences between pre and post radiomics
-    dt_proc = compute_differences(dt_merged)
+    with stage("process.differences"):
+        dt_proc = compute_differences(dt_merged)
 
     # Return processed BOA results
     return dt_proc
+
+#-----------------------------------------------------#
+#             Process BOA Results - Cohort            #
+#-----------------------------------------------------#
+def refine_bca_missing_bodyparts_stacked(dt):
+    # Identify aggregation types per volume and missing body parts
+    dt_present = dt[dt["Present"]==True]
+    aggtypes = dt_present[["volume", "AggregationType"]].drop_duplicates()
+    missing_bps = dt.loc[dt["Present"]==False, ["volume", "BodyPart"]]
+    # Create dummy rows (NaN features) for each missing body part & aggtype
+    dt_missbps = pd.merge(missing_bps, aggtypes, on="volume", how="inner")
+    dt_missbps["Present"] = False
+    # Combine with present body parts dataframe (grouped by volume)
+    dt_refined = pd.concat((dt_present, dt_missbps), axis=0, ignore_index=True)
+    dt_refined = dt_refined.sort_values("volume", kind="stable")
+    # Return refined dataframe
+    return dt_refined.reset_index(drop=True)
+
+def load_boa_cohort(paths_boa, on_error="raise", native=False):
+    # Load BOA results of all volumes and stack them with a volume index
+    list_bca, list_ts, failed = [], [], []
+    for i, path_boa in enumerate(paths_boa):
+        try:
+            dt_bca, dt_ts = load_boa_results(path_boa, native)
+        except Exception as e:
+            if on_error == "raise" : raise
+            warnings.warn("RadTA: Skipping BOA results " + str(path_boa) + \
+                          " (" + str(e) + ")")
+            failed.append(i)
+            continue
+        list_bca.append(dt_bca.assign(volume=i))
+        list_ts.append(dt_ts.assign(volume=i))
+    # No BOA results could be loaded
+    if len(list_bca) == 0 : return None, None, failed
+    # Return stacked dataframes
+    dt_bca = pd.concat(list_bca, axis=0, ignore_index=True)
+    dt_ts = pd.concat(list_ts, axis=0, ignore_index=True)
+    return dt_bca, dt_ts, failed
+
+def process_boa_cohort(boa_pairs, on_error="raise", features=None,
+                       native=False):
+    # Identify unique BOA outcomes (each volume is loaded only once)
+    paths_boa = list(dict.fromkeys([str(p) for pair in boa_pairs \
+                                    for p in pair[:2]]))
+    index_boa = {p: i for i, p in enumerate(paths_boa)}
+    dt_pairs = pd.DataFrame({
+                    "volume_pair": [pair[2] for pair in boa_pairs],
+                    "vol_pre": [index_boa[str(pair[0])] for pair in boa_pairs],
+                    "vol_post": [index_boa[str(pair[1])] for pair in boa_pairs]})
+    dt_pairs["pair"] = np.arange(len(dt_pairs))
+
+    # Load boa results for all volumes
+    dt_bca, dt_ts, failed = load_boa_cohort(paths_boa, on_error, native)
+    # Volume-pairs with a volume which could not be loaded
+    failed_pairs = dt_pairs["vol_pre"].isin(failed) | \
+                   dt_pairs["vol_post"].isin(failed)
+    failed = list(dt_pairs.loc[failed_pairs, "volume_pair"])
+    if dt_bca is None : return None, failed
+    dt_pairs = dt_pairs[~failed_pairs]
+    with stage("process.restructure", volumes=len(paths_boa)):
+        # Refine & restructure: TotalSegmentator
+        dt_ts = restructure_ts(refine_ts_missing_bodyparts(dt_ts), ["volume"])
+        dt_ts = select_features(dt_ts, features)
+        dt_ts = dt_ts.sort_values("volume", kind="stable")
+        # Refine & restructure: BCA
+        dt_bca = restructure_bca(refine_bca_missing_bodyparts_stacked(dt_bca),
+                                 ["volume"])
+        dt_bca = select_features(dt_bca, features)
+        dt_bca = dt_bca.sort_values("volume", kind="stable")
+
+    with stage("process.merge", pairs=len(boa_pairs)):
+        # Combine models with categorical keys (row order as in a single pair)
+        dt_long = pd.concat([dt_ts, dt_bca], axis=0, ignore_index=True)
+        dt_long = dt_long.sort_values("volume", kind="stable", ignore_index=True)
+        dt_long["row"] = dt_long.groupby("volume").cumcount()
+        for col in ["model", "feature", "metric"]:
+            dt_long[col] = dt_long[col].astype("category")
+
+        # Merge pre and post radiomics of all volume-pairs at once
+        dt_pre = dt_long.rename({"volume": "vol_pre", "value": "volume_pre"}, axis=1)
+        dt_post = dt_long.rename({"volume": "vol_post", "value": "volume_post"}, axis=1)
+        dt_post = dt_post.drop(columns=["row"])
+        dt_merged = pd.merge(dt_pairs, dt_pre, on="vol_pre", how="inner")
+        dt_merged = pd.merge(dt_merged, dt_post,
+                             on=["vol_post", "model", "feature", "metric"],
+                             how="inner")
+        dt_merged = dt_merged.sort_values(["pair", "row"], kind="stable",
+                                          ignore_index=True)
+
+    # Compute differences between pre and post radiomics
+    with stage("process.differences", pairs=len(boa_pairs)):
+        dt_proc = compute_differences(dt_merged)
+    # Return cohort radiomics table and volume-pairs which failed to load
+    dt_proc["volume_pair"] = dt_proc["volume_pair"].astype("category")
+    return dt_proc[["model", "feature", "metric", "volume_pre", "volume_post",
+                    "diff_absolute", "diff_relative", "volume_pair"]], failed
@@ -0,0 +1,135 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import argparse
+from pathlib import Path
+from cli import add_eval_arguments, check_eval_arguments
+from store import sync_store, query_store
+from evaluate import run_eval
+
+#-----------------------------------------------------#
+#                 Subset Query Runner                 #
+#-----------------------------------------------------#
+def read_pair_list(path_list):
+    # One volume-pair name per line (empty lines and comments are ignored)
+    with open(path_list, "r") as fh:
+        return [l.strip() for l in fh if l.strip() and not l.startswith("#")]
+
+if __name__ == "__main__":
+    # Parse arguments
+    parser = argparse.ArgumentParser(description="Query the results store of " + \
+                                     "a RadTA run and evaluate a subset of the cohort")
+    parser.add_argument("-o", "--output", 
+                        type=Path,
+                        help="Path to output directory of a RadTA run",
+                        default="out/",
+                        dest="path_output")
+    parser.add_argument("--pairs", 
+                        type=str,
+                        nargs="+",
+                        help="Names of the volume-pairs to select",
+                        default=None,
+                        dest="pairs")
+    parser.add_argument("--pair_list", 
+                        type=Path,
+                        help="File with one volume-pair name per line to select",
+                        default=None,
+                        dest="pair_list")
+    parser.add_argument("--models", 
+                        type=str,
+                        nargs="+",
+                        help="Models to select (e.g. Total)",
+                        default=None,
+                        dest="models")
+    parser.add_argument("--features", 
+                        type=str,
+                        nargs="+",
+                        help="Features to select (wildcards allowed, e.g. 'Liver*')",
+                        default=None,
+                        dest="features")
+    parser.add_argument("--metrics", 
+                        type=str,
+                        nargs="+",
+                        help="Metrics to select (wildcards allowed, e.g. 'Mean*')",
+                        default=None,
+                        dest="metrics")
+    parser.add_argument("--name", 
+                        type=str,
+                        help="Name of the subset evaluation (evaluation_<name>)",
+                        default="subset",
+                        dest="name")
+    parser.add_argument("--export", 
+                        type=Path,
+                        help="Store the selected radiomics as CSV instead of evaluating them",
+                        default=None,
+                        dest="path_export")
+    parser.add_argument("-w", "--workers", 
+                        type=int,
+                        help="Number of parallel workers for rendering figures",
+                        default=1,
+                        dest="workers")
+    add_eval_arguments(parser)
+    args = parser.parse_args()
+    check_eval_arguments(args)
+    if not args.path_output.exists():
+        raise ValueError("RadTA: Output directory does not exist: " + \
+                         str(args.path_output))
+
+    # Combine volume-pair selections
+    pairs = None
+    if args.pairs is not None or args.pair_list is not None:
+        pairs = list(args.pairs or [])
+        if args.pair_list is not None : pairs += read_pair_list(args.pair_list)
+
+    # Import radiomics tables which are not in the store yet
+    sync_store(args.path_output)
+    # Load the selected radiomics via the store index
+    rt_subset = query_store(args.path_output, pairs, args.models,
+                            args.features, args.metrics)
+    if rt_subset.empty:
+        raise ValueError("RadTA: No radiomics match the query.")
+    print("RadTA: Selected " + str(rt_subset["volume_pair"].nunique()) + \
+          " volume-pair(s) with " + str(len(rt_subset)) + " measurement(s).")
+
+    # Export selected radiomics
+    if args.path_export is not None:
+        rt_subset.to_csv(args.path_export, index=False)
+    # Evaluate subset (radiomics tables of other volume-pairs are not read)
+    else:
+        run_eval(args.path_output, rt_merged=rt_subset,
+                 analysis=not args.no_analysis,
+                 workers=args.workers,
+                 chunk_size=args.chunk_size,
+                 n_resamples=args.n_resamples,
+                 seed=args.seed,
+                 test=args.test,
+                 correction=args.correction,
+                 path_metadata=args.path_metadata,
+                 stratify_by=args.stratify_by,
+                 strata_mode=args.strata_mode,
+                 path_eval=os.path.join(args.path_output,
+                                        "evaluation_" + args.name),
+                 pair_tables=False,
+                 output_format=args.output_format)
\ No newline at end of file
@@ -0,0 +1,220 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import numpy as np
+import pandas as pd
+import nibabel as nib
+from scipy import ndimage
+from totalsegmentator.map_to_binary import class_map
+from instrument import stage
+from process import get_native_path
+from cache import get_cached_volume
+from retention import MASK_ARCHIVE, apply_retention, expand_masks
+
+#-----------------------------------------------------#
+#             Region Statistics Configuration         #
+#-----------------------------------------------------#
+# Segmentation of the TotalSegmentator 'total' model in the BOA output
+SEG_FILE = "total.nii.gz"
+# Columns of the BOA 'regions-statistics' sheet
+TS_COLUMNS = ["ModelName", "BodyRegion", "Present", "VolumeMl", "MeanHU",
+              "StdHU", "MinHU", "MedianHU", "MaxHU", "25thPercentileHU",
+              "75thPercentileHU", "CNR"]
+# HU range of adipose tissue (as in BOA)
+ADIPOSE_TISSUE = (-200, -40)
+# Lung lobes for the pulmonary fat attenuation volume (CT-PFAV)
+LUNG_LOBES = ["lung_upper_lobe_left", "lung_lower_lobe_left",
+              "lung_upper_lobe_right", "lung_middle_lobe_right",
+              "lung_lower_lobe_right"]
+
+def convert_name(name):
+    # BOA naming of regions (e.g. kidney_left -> KidneyLeft)
+    return "".join(s.capitalize() for s in name.split("_"))
+
+#-----------------------------------------------------#
+#             Vectorized Group Statistics             #
+#-----------------------------------------------------#
+def quantile_linear(part, n, q):
+    # Linear interpolated quantile of a partitioned array (as numpy)
+    idx = q * (n - 1)
+    lo = int(np.floor(idx))
+    hi = min(lo + 1, n - 1)
+    t = idx - lo
+    a, b = float(part[lo]), float(part[hi])
+    if t < 0.5 : return a + (b - a) * t
+    else : return b - (b - a) * (1 - t)
+
+def compute_group_statistics(hu, groups, n_groups):
+    # Moments of all groups in a single pass via bincount reductions
+    counts = np.bincount(groups, minlength=n_groups)
+    sums = np.bincount(groups, weights=hu, minlength=n_groups)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = sums / counts
+        sq = np.bincount(groups, weights=(hu - mean[groups])**2,
+                         minlength=n_groups)
+        std = np.sqrt(sq / counts)
+    # Sort voxels by group once (stable radix sort for small integers)
+    order = np.argsort(groups.astype(np.int16 if n_groups < 2**15 \
+                                     else np.int32), kind="stable")
+    hu_sorted = hu[order]
+    ends = np.cumsum(counts)
+    # Order statistics via partitioning of each group (no full sort)
+    order_stats = np.full((n_groups, 5), np.nan)
+    for g in np.nonzero(counts)[0]:
+        n = int(counts[g])
+        seg = hu_sorted[ends[g]-n:ends[g]]
+        kth = sorted(set([0, n-1, (n-1)//2, n//2] + \
+                         [int(np.floor(q * (n-1))) for q in [0.25, 0.75]] + \
+                         [min(int(np.floor(q * (n-1))) + 1, n-1) \
+                          for q in [0.25, 0.75]]))
+        part = np.partition(seg, kth)
+        if n % 2 == 1 : median = float(part[n//2])
+        else : median = (float(part[n//2-1]) + float(part[n//2])) / 2
+        order_stats[g] = [part[0], quantile_linear(part, n, 0.25), median,
+                          quantile_linear(part, n, 0.75), part[n-1]]
+    # Return count, mean, std, min, q1, median, q3, max of each group
+    return counts, mean, std, order_stats
+
+def build_records(names, hu, groups, ml_per_voxel, reference):
+    # Table rows in the format of the BOA 'regions-statistics' sheet
+    counts, mean, std, order_stats = compute_group_statistics(hu, groups,
+                                                              len(names))
+    records = []
+    for g, name in enumerate(names):
+        record = {"ModelName": "Total", "BodyRegion": convert_name(name),
+                  "Present": bool(counts[g] > 0)}
+        if counts[g] > 0:
+            record.update({"VolumeMl": counts[g] * ml_per_voxel,
+                           "MeanHU": mean[g], "StdHU": std[g],
+                           "MinHU": order_stats[g, 0],
+                           "MedianHU": order_stats[g, 2],
+                           "MaxHU": order_stats[g, 4],
+                           "25thPercentileHU": order_stats[g, 1],
+                           "75thPercentileHU": order_stats[g, 3]})
+            if reference is not None:
+                record["CNR"] = (mean[g] - reference[0]) / reference[1]
+        records.append(record)
+    return records
+
+#-----------------------------------------------------#
+#                 CNR Reference Region                #
+#-----------------------------------------------------#
+def compute_autochthon_reference(ct, seg, labels):
+    # Autochthonous back muscles without fat, eroded by a 6x6x6 kernel
+    mask = np.isin(seg, labels) & ((ct < ADIPOSE_TISSUE[0]) | \
+                                   (ct > ADIPOSE_TISSUE[1]))
+    if not mask.any() : return None
+    # Erode only the bounding box (with a margin larger than the kernel)
+    bbox = tuple(slice(max(0, int(idx.min()) - 4), int(idx.max()) + 5) \
+                 for idx in np.nonzero(mask))
+    kernel = np.zeros((7, 7, 7), dtype=bool)
+    kernel[:6, :6, :6] = True
+    eroded = ndimage.binary_erosion(mask[bbox], structure=kernel, border_value=1)
+    if not eroded.any() : return None
+    hu = ct[bbox][eroded]
+    return float(np.mean(hu)), float(np.std(hu))
+
+#-----------------------------------------------------#
+#               Native Region Statistics              #
+#-----------------------------------------------------#
+def compute_region_statistics(path_ct, path_seg, hu_window=None):
+    # Load CT and label map once (scaled voxel values in HU)
+    img_ct, img_seg = nib.load(str(path_ct)), nib.load(str(path_seg))
+    if img_ct.shape[:3] != img_seg.shape[:3]:
+        raise ValueError("RadTA: CT volume and segmentation have a different " + \
+                         "shape: " + str(path_ct) + ", " + str(path_seg))
+    ct = np.asanyarray(img_ct.dataobj).reshape(img_ct.shape[:3])
+    seg = np.asanyarray(img_seg.dataobj).reshape(img_seg.shape[:3])
+    if seg.dtype.kind == "f" : seg = np.rint(seg).astype(np.int32)
+    ml_per_voxel = float(np.prod(img_ct.header.get_zooms()[:3])) / 1000.0
+    # Label map of the 'total' model
+    label_map = {name: label for label, name in class_map["total"].items()}
+    names = list(label_map)
+    lut = np.full(max(seg.max(), max(label_map.values())) + 1, -1, dtype=np.int32)
+    for g, name in enumerate(names) : lut[label_map[name]] = g
+    # CNR reference (full label map, independent of the HU window)
+    reference = None
+    if "autochthon_left" in label_map and "autochthon_right" in label_map:
+        reference = compute_autochthon_reference(ct, seg,
+                        [label_map["autochthon_left"],
+                         label_map["autochthon_right"]])
+
+    # Select labeled voxels (within the HU window)
+    keep = seg > 0
+    if hu_window is not None:
+        keep &= (ct >= hu_window[0]) & (ct <= hu_window[1])
+    hu = ct[keep].astype(np.float64)
+    groups = lut[seg[keep]]
+    valid = groups >= 0
+    hu, groups = hu[valid], groups[valid]
+
+    # Statistics of all regions in one vectorized pass
+    records = build_records(names, hu, groups, ml_per_voxel, reference)
+    # Both autochthonous back muscles combined
+    if "autochthon_left" in label_map and "autochthon_right" in label_map:
+        sel = (groups == names.index("autochthon_left")) | \
+              (groups == names.index("autochthon_right"))
+        records += build_records(["autochthon"], hu[sel],
+                                 np.zeros(sel.sum(), dtype=np.int64),
+                                 ml_per_voxel, reference)
+    # Pulmonary fat attenuation volume of lobes, lungs sides and both lungs
+    if all(lobe in label_map for lobe in LUNG_LOBES):
+        lobe_index = np.full(len(names), -1)
+        for i, lobe in enumerate(LUNG_LOBES) : lobe_index[names.index(lobe)] = i
+        sel = (lobe_index[groups] >= 0) & (hu >= ADIPOSE_TISSUE[0]) & \
+              (hu <= ADIPOSE_TISSUE[1])
+        hu_fat, lobe_fat = hu[sel], lobe_index[groups[sel]]
+        records += build_records(["ct_pfav_" + l for l in LUNG_LOBES], hu_fat,
+                                 lobe_fat, ml_per_voxel, reference)
+        side = np.array([0 if l.endswith("left") else 1 for l in LUNG_LOBES])
+        records += build_records(["ct_pfav_lobe_left", "ct_pfav_lobe_right"],
+                                 hu_fat, side[lobe_fat], ml_per_voxel, reference)
+        records += build_records(["ct_pfav_lungs"], hu_fat,
+                                 np.zeros(len(hu_fat), dtype=np.int64),
+                                 ml_per_voxel, reference)
+    # Return regions statistics table
+    return pd.DataFrame(records, columns=TS_COLUMNS)
+
+def write_region_statistics(vol, path_out_vol, hu_window=None, retention="all"):
+    # Compute region statistics of a volume from its BOA segmentation
+    with stage("regions", volume=str(vol)):
+        path_seg = os.path.join(path_out_vol, SEG_FILE)
+        # Expand the segmentation on demand from an archive of an earlier run
+        if not os.path.exists(path_seg) and \
+            os.path.exists(os.path.join(path_out_vol, MASK_ARCHIVE)):
+            expand_masks(path_out_vol, [SEG_FILE])
+        if os.path.isdir(vol) or not os.path.exists(path_seg):
+            raise ValueError("RadTA: Native region statistics require a NIfTI " + \
+                             "volume and its segmentation " + path_seg + \
+                             " (pruned segmentations are recreated with --refresh)")
+        dt_ts = compute_region_statistics(get_cached_volume(vol), path_seg,
+                                          hu_window)
+        path_native = get_native_path(os.path.join(path_out_vol, "output.xlsx"))
+        dt_ts.to_parquet(path_native + ".tmp", index=False)
+        os.replace(path_native + ".tmp", path_native)
+    # Segmentation is no longer required after the region statistics
+    apply_retention(path_out_vol, retention)
+    # Return path to the native region statistics
+    return path_native
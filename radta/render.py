@@ -0,0 +1,94 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import json
+import hashlib
+import pandas as pd
+from pool import run_jobs
+from instrument import stage
+
+#-----------------------------------------------------#
+#                Render Configuration                 #
+#-----------------------------------------------------#
+# Increase to invalidate all rendered figures (e.g. after a style change)
+RENDER_VERSION = "1"
+# Registry of input hashes of all rendered figures
+RENDER_REGISTRY = "figures.json"
+
+#-----------------------------------------------------#
+#                  Figure Input Hash                  #
+#-----------------------------------------------------#
+def hash_figure_inputs(func, data, kwargs):
+    # Hash the rendering function, its data subsets and its arguments
+    hasher = hashlib.sha256()
+    hasher.update((RENDER_VERSION + func.__module__ + "." + \
+                   func.__name__).encode())
+    for dt in data:
+        hasher.update(str(list(dt.columns)).encode())
+        hasher.update(pd.util.hash_pandas_object(dt, index=False).values.tobytes())
+    hasher.update(repr(sorted(kwargs.items())).encode())
+    return hasher.hexdigest()
+
+#-----------------------------------------------------#
+#                  Figure Rendering                   #
+#-----------------------------------------------------#
+def render_figures(jobs, path_eval, workers=1):
+    # Load registry of previously rendered figures
+    path_registry = os.path.join(path_eval, RENDER_REGISTRY)
+    if os.path.exists(path_registry):
+        with open(path_registry, "r") as fh : registry = json.load(fh)
+    else : registry = {}
+
+    # Identify figures whose inputs changed or whose outputs are missing
+    pending = {}
+    hashes = {}
+    for job in jobs:
+        hashes[job["name"]] = hash_figure_inputs(job["func"], job["data"],
+                                                 job["kwargs"])
+        if registry.get(job["name"]) == hashes[job["name"]] and \
+            all(os.path.exists(f) for f in job["outputs"]) : continue
+        pending[job["name"]] = job
+
+    # Render pending figures (fan out to a process pool if requested)
+    if workers > 1 and len(pending) > 1:
+        results = run_jobs(render_job, 
+                           {name: {"job": job} for name, job in pending.items()},
+                           workers, desc="Rendering")
+    else:
+        results = {name: render_job(job) for name, job in pending.items()}
+
+    # Update registry with successfully rendered figures
+    for name, result in results.items():
+        if isinstance(result, Exception) : registry.pop(name, None)
+        else : registry[name] = hashes[name]
+    with open(path_registry + ".tmp", "w") as fh : json.dump(registry, fh)
+    os.replace(path_registry + ".tmp", path_registry)
+    return results
+
+def render_job(job):
+    # Call plotting function with its data subsets and arguments
+    with stage("plot", figure=job["name"]):
+        job["func"](*job["data"], **job["kwargs"])
+    return job["outputs"]
@@ -0,0 +1,209 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import io
+import os
+import argparse
+import warnings
+import numpy as np
+from instrument import stage, get_path_size
+from cache import CACHE_FILES, CACHE_STAMP
+from process import get_native_path, get_columnar_paths
+
+#-----------------------------------------------------#
+#                 Retention Configuration             #
+#-----------------------------------------------------#
+# Retention policies of the BOA output directories: keep all outputs, only the
+# feature tables or the feature tables and an archive of all masks
+RETENTION_POLICIES = ["all", "features", "archive"]
+# Single compressed archive of all NIfTI masks of a BOA output directory
+MASK_ARCHIVE = "masks.npz"
+
+def get_feature_files(path_out_vol):
+    # Feature tables and bookkeeping files which are kept by every policy
+    path_boa = os.path.join(path_out_vol, "output.xlsx")
+    files = [get_native_path(path_boa)] + list(get_columnar_paths(path_boa))
+    return set(CACHE_FILES + [CACHE_STAMP] + [os.path.basename(f) for f in files])
+
+def list_files(path_out_vol):
+    # Relative pathes of all files in a BOA output directory
+    files = []
+    for root, _, names in os.walk(path_out_vol):
+        for f in names:
+            files.append(os.path.relpath(os.path.join(root, f), path_out_vol))
+    return sorted(files)
+
+def is_nifti(name):
+    return name.endswith(".nii") or name.endswith(".nii.gz")
+
+def has_masks(path_out_vol, names):
+    # Check if masks exist as NIfTI files or in the mask archive
+    missing = [f for f in names if not os.path.exists(os.path.join(path_out_vol, f))]
+    if len(missing) == 0 : return True
+    path_archive = os.path.join(path_out_vol, MASK_ARCHIVE)
+    if not os.path.exists(path_archive) : return False
+    with np.load(path_archive) as archive:
+        archived = set(str(f) for f in archive["names"])
+    return set(missing) <= archived
+
+#-----------------------------------------------------#
+#                   Retention Policy                  #
+#-----------------------------------------------------#
+def apply_retention(path_out_vol, policy="all"):
+    # Keep complete BOA outputs
+    if policy == "all" or not os.path.isdir(path_out_vol) : return
+    with stage("retention", policy=policy) as record:
+        if record : record["bytes_before"] = get_path_size(path_out_vol)
+        # Pack all masks into a single archive before anything is removed
+        keep = get_feature_files(path_out_vol)
+        if policy == "archive":
+            # Masks which can not be archived are kept as they are
+            keep.update(pack_masks(path_out_vol))
+            keep.add(MASK_ARCHIVE)
+        # Remove masks and all other outputs which are not used by RadTA
+        for f in list_files(path_out_vol):
+            if f not in keep : os.remove(os.path.join(path_out_vol, f))
+        remove_empty_dirs(path_out_vol)
+        if record : record["bytes_after"] = get_path_size(path_out_vol)
+
+def remove_empty_dirs(path_out_vol):
+    # Remove subdirectories which are empty after pruning (deepest first)
+    for root, dirs, files in os.walk(path_out_vol, topdown=False):
+        if root != str(path_out_vol) and len(os.listdir(root)) == 0:
+            os.rmdir(root)
+
+#-----------------------------------------------------#
+#                     Mask Archive                    #
+#-----------------------------------------------------#
+def pack_masks(path_out_vol):
+    # nibabel is only loaded if masks are archived or expanded
+    import nibabel as nib
+    path_archive = os.path.join(path_out_vol, MASK_ARCHIVE)
+    entries = load_entries(path_archive)
+    # Masks expanded from the archive are already included
+    files = [f for f in list_files(path_out_vol) \
+             if is_nifti(f) and f not in entries]
+    if len(files) == 0 : return []
+    skipped = []
+    for f in files:
+        try : img = nib.load(os.path.join(path_out_vol, f))
+        except Exception : img = None
+        if not isinstance(img, (nib.Nifti1Image, nib.Nifti2Image)):
+            warnings.warn("RadTA: Mask " + os.path.join(str(path_out_vol), f) + \
+                          " is no NIfTI image and is kept unarchived.")
+            skipped.append(f)
+            continue
+        entries[f] = encode_mask(np.asanyarray(img.dataobj), img.header)
+    # Write all entries via a temporary file (a crash never leaves a partial
+    # archive while the masks are already removed)
+    arrays = {"names": np.array(list(entries))}
+    for i, f in enumerate(entries):
+        for key, value in entries[f].items() : arrays[key + str(i)] = value
+    with open(path_archive + ".tmp", "wb") as fh:
+        np.savez_compressed(fh, **arrays)
+    os.replace(path_archive + ".tmp", path_archive)
+    # Return masks which were not archived
+    return skipped
+
+def encode_mask(data, header):
+    # Header including extensions (restores affine, data type and label names)
+    fh = io.BytesIO()
+    header.write_to(fh)
+    entry = {"header": np.frombuffer(fh.getvalue(), dtype=np.uint8),
+             "shape": np.array(data.shape, dtype=np.int64),
+             "version": np.array(2 if header.sizeof_hdr == 540 else 1)}
+    # Binary masks are bit-packed (8 voxels per byte)
+    if ((data == 0) | (data == 1)).all():
+        entry["data"] = np.packbits(data.astype(bool), axis=None)
+        entry["packed"] = np.array(True)
+    # Multi-label masks are stored in the smallest sufficient integer type
+    else:
+        if data.dtype.kind in "iu" and data.min() >= 0:
+            data = data.astype(np.min_scalar_type(data.max()))
+        entry["data"] = data
+        entry["packed"] = np.array(False)
+    return entry
+
+def load_entries(path_archive):
+    # Entries of an existing archive by relative mask path
+    entries = {}
+    if not os.path.exists(path_archive) : return entries
+    with np.load(path_archive) as archive:
+        for i, f in enumerate(archive["names"]):
+            entries[str(f)] = {key: archive[key + str(i)] \
+                               for key in ["header", "shape", "data", "packed"]}
+            # NIfTI version (archives of older runs only hold NIfTI-1 masks)
+            key = "version" + str(i)
+            entries[str(f)]["version"] = archive[key] if key in archive \
+                                         else np.array(1)
+    return entries
+
+def expand_masks(path_out_vol, names=None):
+    import nibabel as nib
+    path_archive = os.path.join(path_out_vol, MASK_ARCHIVE)
+    if not os.path.exists(path_archive):
+        raise ValueError("RadTA: No mask archive found in " + str(path_out_vol))
+    # Restore all or the selected masks as NIfTI files
+    expanded = []
+    for f, entry in load_entries(path_archive).items():
+        if names is not None and f not in names : continue
+        shape = tuple(entry["shape"])
+        if entry["packed"]:
+            data = np.unpackbits(entry["data"], count=int(np.prod(shape)))
+            data = data.reshape(shape)
+        else : data = entry["data"]
+        cls_img = nib.Nifti2Image if int(entry["version"]) == 2 else nib.Nifti1Image
+        header = cls_img.header_class.from_fileobj(
+                    io.BytesIO(entry["header"].tobytes()))
+        img = cls_img(data, None, header=header)
+        # Write via a temporary file with the same extension (compression)
+        path_file = os.path.join(path_out_vol, f)
+        path_tmp = os.path.join(os.path.dirname(path_file),
+                                ".tmp." + os.path.basename(path_file))
+        os.makedirs(os.path.dirname(path_file), exist_ok=True)
+        nib.save(img, path_tmp)
+        os.replace(path_tmp, path_file)
+        expanded.append(path_file)
+    return expanded
+
+#-----------------------------------------------------#
+#                 Archive Entry Point                 #
+#-----------------------------------------------------#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RadTA: Expand archived masks of " + \
+                                     "BOA output directories")
+    parser.add_argument("paths", 
+                        type=str,
+                        nargs="+",
+                        help="BOA output directories (e.g. results/*.boa.pre)")
+    parser.add_argument("--masks", 
+                        type=str,
+                        nargs="+",
+                        help="Expand only these masks (e.g. total.nii.gz)",
+                        default=None,
+                        dest="masks")
+    args = parser.parse_args()
+    for path_out_vol in args.paths:
+        for path_file in expand_masks(path_out_vol, args.masks):
+            print("RadTA: Expanded " + path_file)
\ No newline at end of file
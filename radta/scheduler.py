@@ -0,0 +1,305 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import traceback
+from pathlib import Path
+from tqdm import tqdm
+from pool import run_jobs, run_isolated, run_retrying
+from boa import run_boa_volume, get_boa_path
+from worker import submit_volume
+from process import process_boa_cohort, get_native_path
+from store import write_store
+from evaluate import TABLE_FORMATS, get_table_path, find_table
+from cache import CACHE_MASKS
+from retention import has_masks
+from journal import JOURNAL_DONE, JOURNAL_FAILED, is_done, write_journal, \
+                    write_journal_batch, journal_events
+
+#-----------------------------------------------------#
+#                   Pair Processing                   #
+#-----------------------------------------------------#
+def get_timepoint_tag(vol):
+    # Timepoint tag is the name of the timepoint directory (without dots)
+    return Path(vol).resolve().parent.name.replace(".", "_")
+
+def get_pair_name(vol_pre, vol_post, longitudinal=False):
+    # Name of a volume-pair (used for the radiomics table file)
+    name_pre = str(vol_pre).split("/")[-1].split(".")[0]
+    name_post = str(vol_post).split("/")[-1].split(".")[0]
+    if longitudinal:
+        return name_pre + "_" + get_timepoint_tag(vol_pre) + "-" + \
+               get_timepoint_tag(vol_post)
+    elif name_pre != name_post : return name_pre + "-" + name_post
+    else : return name_pre
+
+def process_pairs(pairs, pboa, on_error="raise", features=None, native=False):
+    # Load and parse BOA results of all volume-pairs into one feature table
+    if len(pairs) == 0 : return None, []
+    boa_pairs = [(pboa[vol_pre], pboa[vol_post], name_pair) \
+                 for vol_pre, vol_post, name_pair in pairs]
+    # Volume-pairs with failed BOA outcome loading are returned as failed
+    return process_boa_cohort(boa_pairs, on_error=on_error, features=features,
+                              native=native)
+
+def store_pair_tables(rt_cohort, path_output, output_format="parquet"):
+    # Store radiomics table including differences for each volume-pair
+    for name_pair, dt_ft in rt_cohort.groupby("volume_pair", sort=False,
+                                              observed=True):
+        dt_ft = dt_ft.drop(columns=["volume_pair"])
+        if output_format == "csv" : content = dt_ft.to_csv(index=False).encode()
+        else:
+            # Dictionaries only contain the keys of this volume-pair
+            for col in dt_ft.columns:
+                if dt_ft[col].dtype.name == "category":
+                    dt_ft[col] = dt_ft[col].cat.remove_unused_categories()
+            content = dt_ft.to_parquet(index=False)
+        # Remove the table of this volume-pair in any other output format
+        for fmt in TABLE_FORMATS:
+            path_other = get_table_path(path_output, name_pair, fmt)
+            if fmt != output_format and os.path.exists(path_other):
+                os.remove(path_other)
+        # Keep unchanged tables untouched (preserves incremental evaluation)
+        path_file = get_table_path(path_output, name_pair, output_format)
+        if os.path.exists(path_file) and \
+            os.path.getsize(path_file) == len(content):
+            with open(path_file, "rb") as fh:
+                if fh.read() == content : continue
+        # Write via a temporary file (a crash never leaves a partial table)
+        with open(path_file + ".tmp", "wb") as fh : fh.write(content)
+        os.replace(path_file + ".tmp", path_file)
+
+#-----------------------------------------------------#
+#                   Segmentation Plan                 #
+#-----------------------------------------------------#
+def build_plan(queue_vol_pre, queue_vol_post, path_output, longitudinal=False):
+    # Deduplicate volumes over all pairs (each volume is segmented only once)
+    volumes = {}
+    pairs = []
+    tags = {}
+    for vol_pre, vol_post in zip(queue_vol_pre, queue_vol_post):
+        keys = []
+        for vol, tag in [(vol_pre, "pre"), (vol_post, "post")]:
+            key = Path(vol).resolve()
+            # Timepoint tags have to identify a single directory
+            # (otherwise volumes and pairs of two timepoints would collide)
+            if longitudinal:
+                tag = get_timepoint_tag(vol)
+                if tags.setdefault(tag, key.parent) != key.parent:
+                    raise ValueError("RadTA: Timepoint directories " + \
+                                     str(tags[tag]) + " and " + \
+                                     str(key.parent) + " share the tag '" + \
+                                     tag + "', please rename one of them.")
+            if key not in volumes:
+                volumes[key] = get_boa_path(vol, path_output, tag)
+            keys.append(key)
+        name_pair = get_pair_name(vol_pre, vol_post, longitudinal)
+        pairs.append((keys[0], keys[1], name_pair))
+    # Return unique volumes with BOA output directory and volume-pairs
+    return volumes, pairs
+
+#-----------------------------------------------------#
+#                   Resume & Journal                  #
+#-----------------------------------------------------#
+def resume_plan(volumes, pairs, path_output, states, native=False):
+    # Volume-pairs with a stored radiomics table are not processed again
+    pairs = [pair for pair in pairs if not (is_done(states, "pair", pair[2]) and \
+             find_table(path_output, pair[2]) is not None)]
+    needed = set(vol for pair in pairs for vol in pair[:2])
+    volumes = {vol: volumes[vol] for vol in volumes if vol in needed}
+    # Volumes with complete BOA outputs are not segmented again
+    pboa, regions_done = {}, set()
+    for vol in volumes:
+        path_boa = os.path.join(volumes[vol], "output.xlsx")
+        if not is_done(states, "volume", vol, path_boa) : continue
+        pboa[vol] = path_boa
+        if native and is_done(states, "regions", vol, get_native_path(path_boa)):
+            regions_done.add(vol)
+        # Segment again if the masks for native region statistics were pruned
+        elif native and not has_masks(volumes[vol], CACHE_MASKS) : del pboa[vol]
+    return volumes, pairs, pboa, regions_done
+
+def get_segmentation_jobs(volumes, path_cache=None, cache_size=None,
+                          refresh=False, path_worker=None, models=None,
+                          fast=False, retention="all", native=False):
+    # Segmentation job of each volume (for BOA or the segmentation worker)
+    jobs_seg = {}
+    for vol in volumes:
+        jobs_seg[vol] = {"vol": vol,
+                         "path_out_vol": volumes[vol],
+                         "path_cache": path_cache,
+                         "cache_size": cache_size,
+                         "refresh": refresh,
+                         "models": models,
+                         "fast": fast,
+                         "retention": retention,
+                         "native": native}
+        if path_worker is not None : jobs_seg[vol]["path_socket"] = path_worker
+    func_seg = run_boa_volume if path_worker is None else submit_volume
+    return func_seg, jobs_seg
+
+def store_pair_results(rt_cohort, path_output, output_format="parquet"):
+    # Store radiomics tables and mark their volume-pairs as done
+    if rt_cohort is None : return
+    store_pair_tables(rt_cohort, path_output, output_format)
+    write_store(rt_cohort, path_output)
+    write_journal_batch(path_output, "pair",
+                        rt_cohort["volume_pair"].astype(str).unique(), JOURNAL_DONE)
+
+#-----------------------------------------------------#
+#                    RadTA Runners                    #
+#-----------------------------------------------------#
+def run_sequential(volumes, pairs, path_output,
+                   path_cache=None, cache_size=None, refresh=False,
+                   path_worker=None, models=None, fast=False, features=None,
+                   native=False, hu_window=None,
+                   states={}, timeout=None, retries=2, backoff=30.0,
+                   process=True, retention="all", output_format="parquet"):
+    # create working directory if not existend
+    if not path_output.exists() : os.mkdir(path_output)
+    # Skip volumes and volume-pairs which finished in an interrupted run
+    volumes, pairs, pboa, regions_done = resume_plan(volumes, pairs, path_output,
+                                                     states, native)
+    # Segmentations are pruned after the native region statistics
+    retention_seg = "all" if native else retention
+    # Run TotalSegmentator and BOA for each unique volume
+    func_seg, jobs_seg = get_segmentation_jobs(
+                            {vol: volumes[vol] for vol in volumes if vol not in pboa},
+                            path_cache, cache_size, refresh, path_worker,
+                            models, fast, retention_seg, native)
+    on_seg = journal_events(path_output, "volume")
+    # A timeout requires a separate process which can be killed
+    if timeout is not None:
+        res_seg = run_isolated(func_seg, jobs_seg, 1, desc="Segmentation",
+                               timeout=timeout, retries=retries,
+                               backoff=backoff, on_event=on_seg)
+    # Run BOA (or submit to a running segmentation worker) in this process
+    else:
+        res_seg = {}
+        for vol in tqdm(jobs_seg, desc="Segmentation"):
+            # A volume which fails all retries only fails its volume-pairs
+            try : res_seg[vol] = run_retrying(func_seg, jobs_seg[vol], vol,
+                                              retries, backoff, on_event=on_seg)
+            except Exception as e : res_seg[vol] = e
+    res_seg.update(pboa)
+    # Compute region statistics natively from the successful segmentations
+    if native:
+        from regions import write_region_statistics
+        for vol in tqdm(volumes, desc="Region statistics"):
+            if vol in regions_done or isinstance(res_seg[vol], Exception):
+                continue
+            try : write_region_statistics(vol, volumes[vol], hu_window, retention)
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__)
+                res_seg[vol] = e
+                continue
+            write_journal(path_output, "regions", vol, JOURNAL_DONE)
+    # Process volume-pairs with two successful segmentations
+    return finish_pairs(pairs, res_seg, path_output, process, features, native,
+                        output_format)
+
+def run_parallel(volumes, pairs, path_output, workers,
+                 path_cache=None, cache_size=None, refresh=False,
+                 path_worker=None, models=None, fast=False, features=None,
+                 native=False, hu_window=None,
+                 states={}, timeout=None, retries=2, backoff=30.0,
+                 process=True, retention="all", output_format="parquet"):
+    # create working directory if not existend
+    if not path_output.exists() : os.mkdir(path_output)
+    # Skip volumes and volume-pairs which finished in an interrupted run
+    volumes, pairs, pboa, regions_done = resume_plan(volumes, pairs, path_output,
+                                                     states, native)
+    # Segmentations are pruned after the native region statistics
+    retention_seg = "all" if native else retention
+    # Create segmentation jobs for each unique volume
+    func_seg, jobs_seg = get_segmentation_jobs(
+                            {vol: volumes[vol] for vol in volumes if vol not in pboa},
+                            path_cache, cache_size, refresh, path_worker,
+                            models, fast, retention_seg, native)
+    # Run TotalSegmentator and BOA in isolated processes (or via a segmentation
+    # worker), hung jobs are killed and failed jobs retried with backoff
+    res_seg = run_isolated(func_seg, jobs_seg, workers, desc="Segmentation",
+                           timeout=timeout, retries=retries, backoff=backoff,
+                           on_event=journal_events(path_output, "volume"))
+    res_seg.update(pboa)
+    # Compute region statistics natively from the successful segmentations
+    if native:
+        from regions import write_region_statistics
+        jobs_reg = {vol: {"vol": vol, "path_out_vol": volumes[vol],
+                          "hu_window": hu_window, "retention": retention} \
+                    for vol in volumes if vol not in regions_done and \
+                    not isinstance(res_seg[vol], Exception)}
+        res_reg = run_jobs(write_region_statistics, jobs_reg, workers,
+                           desc="Region statistics")
+        for vol in res_reg:
+            if isinstance(res_reg[vol], Exception) : res_seg[vol] = res_reg[vol]
+        write_journal_batch(path_output, "regions",
+                            [vol for vol in res_reg \
+                             if not isinstance(res_reg[vol], Exception)],
+                            JOURNAL_DONE)
+
+    # Process volume-pairs with two successful segmentations
+    return finish_pairs(pairs, res_seg, path_output, process, features, native,
+                        output_format)
+
+def finish_pairs(pairs, res_seg, path_output, process=True, features=None,
+                 native=False, output_format="parquet"):
+    # Identify pairs with two successful segmentations
+    failed = []
+    pairs_seg = []
+    for vol_pre, vol_post, name_pair in pairs:
+        if isinstance(res_seg[vol_pre], Exception) or \
+            isinstance(res_seg[vol_post], Exception):
+            failed.append(name_pair)
+        else : pairs_seg.append((vol_pre, vol_post, name_pair))
+    # Segmentation only (volume-pairs are processed by the process subcommand)
+    rt_cohort = None
+    if process:
+        # Load, parse and store BOA results as radiomics tables
+        rt_cohort, failed_proc = process_pairs(pairs_seg, res_seg,
+                                               on_error="skip",
+                                               features=features, native=native)
+        store_pair_results(rt_cohort, path_output, output_format)
+        failed += failed_proc
+    write_journal_batch(path_output, "pair", failed, JOURNAL_FAILED)
+
+    # Report failed volume-pairs
+    if len(failed) > 0:
+        print("RadTA: " + ("Processing" if process else "Segmentation") + \
+              " failed for " + str(len(failed)) + " volume-pair(s): " + \
+              ", ".join(failed))
+    return rt_cohort, failed
+
+def run_processing(volumes, pairs, path_output, features=None, native=False,
+                   output_format="parquet"):
+    # Use the existing BOA outputs of all volumes (e.g. of the segment subcommand)
+    pboa = {}
+    for vol in volumes:
+        path_boa = os.path.join(volumes[vol], "output.xlsx")
+        # Volume-pairs without BOA outputs of both volumes can not be processed
+        if os.path.exists(path_boa) : pboa[vol] = path_boa
+        else : pboa[vol] = ValueError("RadTA: No BOA outputs " + path_boa)
+    # Load, parse and store BOA results as radiomics tables
+    return finish_pairs(pairs, pboa, path_output, features=features,
+                        native=native, output_format=output_format)
\ No newline at end of file
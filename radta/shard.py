@@ -0,0 +1,220 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import json
+import shutil
+import warnings
+from instrument import stage
+from aggregate import compute_aggregates, compute_aggregates_chunked, \
+                      merge_aggregates, load_aggregates, store_aggregates, \
+                      create_ledger
+from evaluate import list_pair_tables, iter_pair_tables, load_pair_tables, \
+                     store_radiomics_table, stream_radiomics_table, \
+                     get_table_path, find_table
+
+#-----------------------------------------------------#
+#                 Shard Configuration                 #
+#-----------------------------------------------------#
+# Description of a complete shard bundle (written last)
+BUNDLE_FILE = "bundle.json"
+
+#-----------------------------------------------------#
+#                   Shard Assignment                  #
+#-----------------------------------------------------#
+def find_root(parent, x):
+    # Root of a volume in the union-find forest (with path halving)
+    while parent[x] != x:
+        parent[x] = parent[parent[x]]
+        x = parent[x]
+    return x
+
+def group_pairs(pairs):
+    # Volume-pairs sharing a volume (longitudinal) are kept on one shard,
+    # so that every volume is segmented on a single node only
+    parent = {}
+    for vol_pre, vol_post, _ in pairs:
+        parent.setdefault(vol_pre, vol_pre)
+        parent.setdefault(vol_post, vol_post)
+        root_pre, root_post = find_root(parent, vol_pre), find_root(parent, vol_post)
+        if root_pre != root_post : parent[root_post] = root_pre
+    # Collect pair indices per group (ordered by first occurrence)
+    groups = {}
+    for i, (vol_pre, _, _) in enumerate(pairs):
+        groups.setdefault(find_root(parent, vol_pre), []).append(i)
+    return list(groups.values())
+
+def select_shard(volumes, pairs, costs, index, n_shards):
+    # Estimated cost of each group (each unique volume counted once)
+    groups = group_pairs(pairs)
+    group_costs = [sum(costs[v] for v in set(vol for i in group \
+                                              for vol in pairs[i][:2])) \
+                   for group in groups]
+    # Deterministic greedy balancing: most expensive group to the least
+    # loaded shard (equal on all nodes, as all nodes read the same manifest)
+    loads = [(0.0, 0)] * n_shards
+    selected = set()
+    for g in sorted(range(len(groups)), key=lambda g: -group_costs[g]):
+        shard = min(range(n_shards), key=lambda k: (loads[k], k))
+        loads[shard] = (loads[shard][0] + group_costs[g], loads[shard][1] + 1)
+        if shard == index : selected.update(groups[g])
+    # Return volumes (in scheduled order) and volume-pairs of the shard
+    pairs_shard = [pair for i, pair in enumerate(pairs) if i in selected]
+    required = set(vol for pair in pairs_shard for vol in pair[:2])
+    volumes_shard = {vol: volumes[vol] for vol in volumes if vol in required}
+    return volumes_shard, pairs_shard
+
+#-----------------------------------------------------#
+#                     Shard Bundle                    #
+#-----------------------------------------------------#
+def write_bundle(path_output, pairs, shard, rt_cohort=None, chunk_size=None,
+                 output_format="parquet"):
+    # Radiomics tables of the volume-pairs of this shard
+    index, n_shards = shard
+    names = set(pair[2] for pair in pairs)
+    rt_files = {name: path_file for name, path_file in \
+                list_pair_tables(path_output).items() if name in names}
+    path_eval = os.path.join(path_output, "evaluation")
+    if not os.path.exists(path_eval) : os.mkdir(path_eval)
+    path_rt = get_table_path(path_eval, "radiomics_table", output_format)
+
+    with stage("shard.bundle", shard=index, pairs=len(rt_files)):
+        # Merged radiomics table and mergeable per-feature aggregates
+        if len(rt_files) > 0 and chunk_size is None:
+            rt = load_pair_tables(rt_files, rt_cohort)
+            store_radiomics_table(rt, path_rt)
+            agg = compute_aggregates(rt)
+        elif len(rt_files) > 0:
+            chunks = iter_pair_tables(rt_files, rt_cohort, chunk_size=chunk_size)
+            chunks = stream_radiomics_table(chunks, path_rt)
+            agg = compute_aggregates_chunked(chunks,
+                                             os.path.join(path_eval, ".spill"))
+        if len(rt_files) > 0:
+            store_aggregates(path_eval, agg, create_ledger(rt_files))
+        # Describe bundle (written last, marks the bundle as complete)
+        bundle = {"shard": index, "shards": n_shards,
+                  "volume_pairs": sorted(rt_files)}
+        path_bundle = os.path.join(path_output, BUNDLE_FILE)
+        with open(path_bundle + ".tmp", "w") as fh : json.dump(bundle, fh)
+        os.replace(path_bundle + ".tmp", path_bundle)
+    return bundle
+
+#-----------------------------------------------------#
+#                    Bundle Merging                   #
+#-----------------------------------------------------#
+def load_bundles(paths_bundle):
+    # Load bundle descriptions (ordered by shard index)
+    bundles = []
+    for path_bundle in paths_bundle:
+        path_json = os.path.join(path_bundle, BUNDLE_FILE)
+        if not os.path.exists(path_json):
+            raise ValueError("RadTA: No complete shard bundle found in " + \
+                             str(path_bundle))
+        with open(path_json, "r") as fh : bundle = json.load(fh)
+        bundle["path"] = str(path_bundle)
+        bundles.append(bundle)
+    bundles = sorted(bundles, key=lambda b: b["shard"])
+    # Check that bundles belong to the same sharded run
+    n_shards = set(b["shards"] for b in bundles)
+    if len(n_shards) != 1:
+        raise ValueError("RadTA: Shard bundles have different numbers of shards.")
+    indices = [b["shard"] for b in bundles]
+    if len(set(indices)) != len(indices):
+        raise ValueError("RadTA: Shard bundles contain a shard twice.")
+    missing = set(range(n_shards.pop())) - set(indices)
+    if missing:
+        warnings.warn("RadTA: Merging without shard(s) " + \
+                      ", ".join(str(i) for i in sorted(missing)))
+    names = [name for b in bundles for name in b["volume_pairs"]]
+    if len(set(names)) != len(names):
+        raise ValueError("RadTA: Shard bundles contain the same volume-pair twice.")
+    return bundles
+
+def link_file(path_src, path_dst):
+    # Hard link files on the shared file system (copy if not supported)
+    if os.path.exists(path_dst):
+        if os.path.samefile(path_src, path_dst) : return
+        os.remove(path_dst)
+    try : os.link(path_src, path_dst)
+    except OSError : shutil.copy2(path_src, path_dst)
+
+def merge_bundles(paths_bundle, path_output):
+    bundles = load_bundles(paths_bundle)
+    path_eval = os.path.join(path_output, "evaluation")
+    os.makedirs(path_eval, exist_ok=True)
+    with stage("shard.merge", bundles=len(bundles)):
+        # Collect radiomics tables of all volume-pairs in the output directory
+        rt_files = {}
+        for bundle in bundles:
+            rt_bundle = list_pair_tables(bundle["path"])
+            for name_pair in bundle["volume_pairs"]:
+                path_dst = os.path.join(path_output,
+                                        os.path.basename(rt_bundle[name_pair]))
+                link_file(rt_bundle[name_pair], path_dst)
+                rt_files[name_pair] = path_dst
+        if len(rt_files) == 0:
+            raise ValueError("RadTA: No radiomics tables found in shard bundles.")
+        bundles = [b for b in bundles if len(b["volume_pairs"]) > 0]
+
+        # Merged radiomics tables of all shards (in the same output format)
+        paths_rt = [find_table(os.path.join(bundle["path"], "evaluation"),
+                               "radiomics_table") for bundle in bundles]
+        if len(set(os.path.splitext(str(p))[1] for p in paths_rt)) != 1:
+            raise ValueError("RadTA: Shard bundles have different output formats.")
+        path_rt = os.path.join(path_eval, os.path.basename(paths_rt[0]))
+        # Concatenate CSV tables (without parsing)
+        if path_rt.endswith(".csv"):
+            with open(path_rt + ".tmp", "w") as fh_out:
+                for i, path_rt_shard in enumerate(paths_rt):
+                    with open(path_rt_shard, "r") as fh:
+                        header = fh.readline()
+                        if i == 0 : fh_out.write(header)
+                        shutil.copyfileobj(fh, fh_out)
+            os.replace(path_rt + ".tmp", path_rt)
+        # Link the files of all Parquet datasets into one dataset (built aside,
+        # as the output directory can be one of the shards)
+        else:
+            path_tmp = path_rt + ".tmp"
+            if os.path.exists(path_tmp) : shutil.rmtree(path_tmp)
+            for i, path_rt_shard in enumerate(paths_rt):
+                for root, _, files in os.walk(path_rt_shard):
+                    path_part = os.path.join(path_tmp, os.path.relpath(root,
+                                                                  path_rt_shard))
+                    os.makedirs(path_part, exist_ok=True)
+                    for f in files:
+                        link_file(os.path.join(root, f), os.path.join(path_part,
+                                  "shard" + str(i) + "-" + f))
+            if os.path.exists(path_rt) : shutil.rmtree(path_rt)
+            os.replace(path_tmp, path_rt)
+
+        # Merge per-feature aggregates of all shards
+        agg = None
+        for bundle in bundles:
+            agg_shard, _ = load_aggregates(os.path.join(bundle["path"],
+                                                        "evaluation"))
+            if agg is None : agg = agg_shard
+            else : agg = merge_aggregates(agg, agg_shard)
+        store_aggregates(path_eval, agg, create_ledger(rt_files))
+    # Return radiomics tables of all merged volume-pairs
+    return rt_files
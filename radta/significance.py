@@ -0,0 +1,148 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import pandas as pd
+import numpy as np
+
+#-----------------------------------------------------#
+#               Resampling Configuration              #
+#-----------------------------------------------------#
+# Keys of the tested groups
+RES_KEYS = ["model", "feature", "metric"]
+# Maximum number of matrix elements per block (bounds memory usage)
+RES_BLOCK = 2**24
+
+#-----------------------------------------------------#
+#                  Group-Pair Matrix                  #
+#-----------------------------------------------------#
+def build_group_matrix(rt, pairs, keys=RES_KEYS, value="diff_relative"):
+    # Group index (sorted keys) and global pair index of each row
+    gb = rt.groupby(keys, observed=True, sort=True)
+    codes = gb.ngroup().to_numpy()
+    dt_keys = gb.size().reset_index()[keys]
+    pidx = pd.Categorical(rt["volume_pair"].astype(str),
+                          categories=pairs).codes
+    values = rt[value].to_numpy(dtype=np.float64)
+    valid = ~np.isnan(values) & (pidx >= 0)
+    # Return keys and sparse coordinates (sorted by group)
+    order = np.argsort(codes[valid], kind="stable")
+    return dt_keys, codes[valid][order], pidx[valid][order], values[valid][order]
+
+def densify_block(codes, pidx, values, start, stop, n_pairs):
+    # Dense values and observation mask for the groups [start, stop)
+    lo, hi = np.searchsorted(codes, [start, stop])
+    X = np.zeros((stop - start, n_pairs), dtype=np.float64)
+    M = np.zeros((stop - start, n_pairs), dtype=np.float64)
+    X[codes[lo:hi] - start, pidx[lo:hi]] = values[lo:hi]
+    M[codes[lo:hi] - start, pidx[lo:hi]] = 1.0
+    return X, M
+
+#-----------------------------------------------------#
+#             Batched Resampling Engine               #
+#-----------------------------------------------------#
+def calc_resampling(rt, pairs, n_resamples=10000, seed=0, alpha=0.05,
+                    keys=RES_KEYS):
+    # Sign-flip permutation test and bootstrap CI of the mean relative
+    # difference for all groups at once (shared resamples of the volume-pairs)
+    dt_keys, codes, pidx, values = build_group_matrix(rt, pairs, keys)
+    n_groups, n_pairs = len(dt_keys), len(pairs)
+    perm_pvalue = np.full(n_groups, np.nan)
+    ci_low = np.full(n_groups, np.nan)
+    ci_high = np.full(n_groups, np.nan)
+    # Block sizes for groups and resamples
+    size_group = max(1, min(n_groups, RES_BLOCK // max(n_pairs, n_resamples)))
+    size_res = max(1, min(n_resamples, RES_BLOCK // max(n_pairs, 1)))
+    for start in range(0, n_groups, size_group):
+        stop = min(start + size_group, n_groups)
+        X, M = densify_block(codes, pidx, values, start, stop, n_pairs)
+        n_obs = M.sum(axis=1)
+        stat_obs = np.abs(X.sum(axis=1))
+        tol = 1e-12 * np.maximum(stat_obs, 1.0)
+        exceed = np.zeros(stop - start, dtype=np.int64)
+        boot_means = np.empty((stop - start, n_resamples), dtype=np.float64)
+        # Same random streams for every group block (independent of blocking)
+        rng_perm = np.random.default_rng([seed, 0])
+        rng_boot = np.random.default_rng([seed, 1])
+        for r in range(0, n_resamples, size_res):
+            size = min(size_res, n_resamples - r)
+            # Permutation: random sign flips of the paired differences
+            signs = rng_perm.integers(0, 2, size=(size, n_pairs)).astype(np.float64)
+            signs = 2.0 * signs - 1.0
+            stat_perm = np.abs(X @ signs.T)
+            exceed += (stat_perm >= (stat_obs - tol)[:, None]).sum(axis=1)
+            # Bootstrap: multinomial resampling weights of the volume-pairs
+            weights = rng_boot.multinomial(n_pairs,
+                                           np.full(n_pairs, 1.0 / n_pairs),
+                                           size=size).astype(np.float64)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                boot_means[:, r:r+size] = (X @ weights.T) / (M @ weights.T)
+        # P-value with the observed statistic included (never zero)
+        valid = n_obs > 0
+        perm_pvalue[start:stop] = np.where(valid, (exceed + 1) / (n_resamples + 1),
+                                           np.nan)
+        # Percentile confidence interval of the mean
+        if valid.any():
+            with np.errstate(invalid="ignore"):
+                q = np.nanpercentile(boot_means[valid],
+                                     [100 * alpha / 2, 100 * (1 - alpha / 2)],
+                                     axis=1)
+            ci_low[start:stop][valid] = q[0]
+            ci_high[start:stop][valid] = q[1]
+    # Return resampling results with string keys
+    dt_res = dt_keys.copy()
+    for col in keys : dt_res[col] = dt_res[col].astype(str)
+    dt_res["perm_pvalue"] = perm_pvalue
+    dt_res["boot_ci_low"] = ci_low
+    dt_res["boot_ci_high"] = ci_high
+    return dt_res
+
+#-----------------------------------------------------#
+#               Multiple Testing Correction           #
+#-----------------------------------------------------#
+def adjust_pvalues(pvalues, method="fdr"):
+    # Adjust p-values of all tests (NaN p-values are ignored)
+    p = np.asarray(pvalues, dtype=np.float64)
+    p_adj = np.full(p.shape, np.nan)
+    valid = np.where(~np.isnan(p))[0]
+    m = len(valid)
+    if m == 0 or method == "none":
+        return p.copy() if method == "none" else p_adj
+    order = valid[np.argsort(p[valid], kind="stable")]
+    ranks = np.arange(1, m + 1)
+    # Benjamini-Hochberg false discovery rate
+    if method == "fdr":
+        adjusted = np.minimum.accumulate((p[order] * m / ranks)[::-1])[::-1]
+    # Holm-Bonferroni family-wise error rate
+    elif method == "holm":
+        adjusted = np.maximum.accumulate(p[order] * (m - ranks + 1))
+    else : raise ValueError("RadTA: Unknown p-value correction: " + str(method))
+    p_adj[order] = np.minimum(adjusted, 1.0)
+    return p_adj
+
+def calc_corrections(dt_eval, columns=["ttest_pvalue", "perm_pvalue"]):
+    # Add FDR and Holm adjusted p-values over all tests of the evaluation
+    for col in columns:
+        for method in ["fdr", "holm"]:
+            dt_eval[col + "_" + method] = adjust_pvalues(dt_eval[col], method)
+    return dt_eval
\ No newline at end of file
@@ -0,0 +1,150 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import sqlite3
+import pandas as pd
+from aggregate import create_ledger
+from evaluate import list_pair_tables, read_pair_table, compact_table, \
+                     find_table
+
+#-----------------------------------------------------#
+#                 Store Configuration                 #
+#-----------------------------------------------------#
+# Name of the results store in the output directory
+STORE_FILE = "radta.sqlite"
+# Primary key and measurements of the radiomics table
+STORE_KEYS = ["volume_pair", "model", "feature", "metric"]
+STORE_VALUES = ["volume_pre", "volume_post", "diff_absolute", "diff_relative"]
+# Radiomics are clustered by volume-pair, a second index serves feature queries
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS radiomics (
+    volume_pair TEXT NOT NULL, model TEXT NOT NULL,
+    feature TEXT NOT NULL, metric TEXT NOT NULL,
+    volume_pre REAL, volume_post REAL, diff_absolute REAL, diff_relative REAL,
+    PRIMARY KEY (volume_pair, model, feature, metric)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS radiomics_feature
+    ON radiomics (model, feature, metric);
+CREATE TABLE IF NOT EXISTS pairs (
+    volume_pair TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER);
+"""
+
+def open_store(path_output):
+    # Open (or create) the results store of an output directory
+    con = sqlite3.connect(os.path.join(path_output, STORE_FILE), timeout=60)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.executescript(STORE_SCHEMA)
+    return con
+
+def analyze_store(con):
+    # Refresh planner statistics on a sample of rows: feature and metric
+    # queries without models skip-scan the feature index instead of a full scan
+    con.execute("PRAGMA analysis_limit=1000")
+    con.execute("ANALYZE")
+
+#-----------------------------------------------------#
+#                    Store Updates                    #
+#-----------------------------------------------------#
+def insert_pairs(con, rt, rt_files):
+    # Replace all radiomics of the given volume-pairs
+    rt = rt[STORE_KEYS + STORE_VALUES].astype({col: str for col in STORE_KEYS})
+    ledger = create_ledger(rt_files).set_index("volume_pair")
+    for name_pair, dt in rt.groupby("volume_pair", sort=False):
+        con.execute("DELETE FROM radiomics WHERE volume_pair = ?", (name_pair,))
+        con.executemany("INSERT INTO radiomics VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        dt.itertuples(index=False, name=None))
+        # Remember state of the radiomics table file (detects later changes)
+        if name_pair in ledger.index:
+            state = ledger.loc[name_pair]
+            con.execute("INSERT OR REPLACE INTO pairs VALUES (?, ?, ?)",
+                        (name_pair, int(state["size"]), int(state["mtime_ns"])))
+
+def write_store(rt_cohort, path_output):
+    # Incrementally add the volume-pairs of a run (single transaction)
+    rt_files = {name: find_table(path_output, name) for name in \
+                rt_cohort["volume_pair"].astype(str).unique()}
+    rt_files = {name: path for name, path in rt_files.items() \
+                if path is not None}
+    con = open_store(path_output)
+    try:
+        with con : insert_pairs(con, rt_cohort, rt_files)
+        analyze_store(con)
+    finally : con.close()
+
+def sync_store(path_output):
+    # Import radiomics tables which are new or changed (e.g. merged shards)
+    rt_files = list_pair_tables(path_output)
+    ledger = create_ledger(rt_files)
+    con = open_store(path_output)
+    try:
+        stored = pd.read_sql_query("SELECT * FROM pairs", con)
+        merged = pd.merge(ledger, stored, on="volume_pair", how="left",
+                          suffixes=("", "_stored"))
+        changed = merged[(merged["size"] != merged["size_stored"]) | \
+                         (merged["mtime_ns"] != merged["mtime_ns_stored"])]
+        vanished = set(stored["volume_pair"]) - set(rt_files)
+        with con:
+            for name_pair in changed["volume_pair"]:
+                rt = read_pair_table(rt_files[name_pair], name_pair)
+                insert_pairs(con, rt, {name_pair: rt_files[name_pair]})
+            for name_pair in vanished:
+                con.execute("DELETE FROM radiomics WHERE volume_pair = ?",
+                            (name_pair,))
+                con.execute("DELETE FROM pairs WHERE volume_pair = ?",
+                            (name_pair,))
+        if len(changed) > 0 or len(vanished) > 0 : analyze_store(con)
+    finally : con.close()
+    return len(changed), len(vanished)
+
+#-----------------------------------------------------#
+#                    Store Queries                    #
+#-----------------------------------------------------#
+def query_store(path_output, pairs=None, models=None, features=None,
+                metrics=None):
+    # Load radiomics of a subset (features and metrics support wildcards)
+    con = open_store(path_output)
+    try:
+        sql = "SELECT r.* FROM radiomics r"
+        conditions, params = [], []
+        # Join the volume-pair subset on the primary key
+        if pairs is not None:
+            con.execute("CREATE TEMP TABLE subset (volume_pair TEXT PRIMARY KEY)")
+            con.executemany("INSERT OR IGNORE INTO subset VALUES (?)",
+                            [(str(p),) for p in pairs])
+            sql += " JOIN subset s ON r.volume_pair = s.volume_pair"
+        if models is not None:
+            conditions.append("r.model IN (" + ", ".join("?" * len(models)) + ")")
+            params += list(models)
+        for col, patterns in [("feature", features), ("metric", metrics)]:
+            if patterns is None : continue
+            conditions.append("(" + " OR ".join(["r." + col + " GLOB ?"] * \
+                                                len(patterns)) + ")")
+            params += list(patterns)
+        if len(conditions) > 0 : sql += " WHERE " + " AND ".join(conditions)
+        rt = pd.read_sql_query(sql, con, params=params)
+    finally : con.close()
+    # Return radiomics table in the layout of the processed cohort
+    rt = rt[["model", "feature", "metric"] + STORE_VALUES + ["volume_pair"]]
+    return compact_table(rt)
\ No newline at end of file
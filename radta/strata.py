@@ -0,0 +1,87 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import re
+import warnings
+import pandas as pd
+
+#-----------------------------------------------------#
+#                Strata Configuration                 #
+#-----------------------------------------------------#
+# Key of the stratum in stratified aggregates and evaluation tables
+STRATUM_KEY = "stratum"
+# Directory of the per-stratum evaluations (inside the evaluation directory)
+STRATA_DIR = "strata"
+
+#-----------------------------------------------------#
+#                   Metadata Join                     #
+#-----------------------------------------------------#
+def load_strata(path_metadata, stratify_by, mode="separate"):
+    # Metadata table with one row per volume-pair (all values as strings)
+    dt_meta = pd.read_csv(path_metadata, dtype=str, keep_default_na=False)
+    missing = [col for col in ["volume_pair"] + list(stratify_by) \
+               if col not in dt_meta.columns]
+    if len(missing) > 0:
+        raise ValueError("RadTA: Metadata " + str(path_metadata) + \
+                         " lacks the column(s): " + ", ".join(missing))
+    if dt_meta["volume_pair"].duplicated().any():
+        raise ValueError("RadTA: Metadata contains duplicated volume-pairs.")
+    dt_meta = dt_meta.set_index("volume_pair")[list(stratify_by)]
+    # Splits of the cohort: one per column (e.g. "site=A" and "sex=F") or the
+    # crossed strata of all columns (e.g. "site=A,sex=F")
+    if mode == "crossed" : splits = [list(stratify_by)]
+    else : splits = [[col] for col in stratify_by]
+    strata = pd.DataFrame(index=dt_meta.index)
+    for cols in splits:
+        complete = (dt_meta[cols] != "").all(axis=1)
+        labels = dt_meta[cols].apply(lambda row: ",".join(col + "=" + row[col] \
+                                     for col in cols), axis=1)
+        strata[",".join(cols)] = labels.where(complete)
+    # Return stratum of each volume-pair in every split (missing if incomplete)
+    return strata.dropna(how="all")
+
+def assign_strata(rt, strata):
+    # Add stratum to the radiomics (pairs without stratum are left out and pairs
+    # are repeated for each split of the cohort)
+    categories = sorted(strata.stack().unique())
+    list_rt = []
+    for split in strata.columns:
+        stratum = rt["volume_pair"].astype(str).map(strata[split])
+        rt_split = rt[stratum.notna().to_numpy()].copy(deep=False)
+        rt_split[STRATUM_KEY] = pd.Categorical(stratum.dropna(), categories)
+        list_rt.append(rt_split)
+    return pd.concat(list_rt, axis=0, ignore_index=True)
+
+def report_unstratified(pairs, strata):
+    # Warn about volume-pairs without (complete) metadata
+    complete = strata.dropna(how="any").index
+    missing = [name_pair for name_pair in pairs if name_pair not in complete]
+    if len(missing) > 0:
+        warnings.warn("RadTA: " + str(len(missing)) + " volume-pair(s) without " + \
+                      "complete metadata are (partly) excluded from the " + \
+                      "stratified evaluation: " + ", ".join(missing))
+
+def get_stratum_dir(stratum):
+    # Directory name of a stratum (path separators and spaces replaced)
+    return re.sub(r"[^\w.,=+-]+", "_", str(stratum))
\ No newline at end of file
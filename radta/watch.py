@@ -0,0 +1,105 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import time
+import warnings
+from pathlib import Path
+from instrument import get_path_size, stage
+
+#-----------------------------------------------------#
+#                  Input Stability                    #
+#-----------------------------------------------------#
+def get_signature(path):
+    # Size and modification time of a volume file or DICOM directory
+    try : return get_path_size(path), os.stat(path).st_mtime_ns
+    except OSError : return None
+
+def list_complete_pairs(dir_pre, dir_post):
+    # Volume names present in both input directories (hidden files are skipped)
+    names = set(os.listdir(dir_pre)) & set(os.listdir(dir_post))
+    return sorted(x for x in names if not x.startswith("."))
+
+def poll_pairs(dir_pre, dir_post, pending, done, settle):
+    # Complete volume-pairs whose files are unchanged for the settle time
+    now = time.monotonic()
+    stable = []
+    for x in list_complete_pairs(dir_pre, dir_post):
+        if x in done : continue
+        signature = (get_signature(os.path.join(dir_pre, x)),
+                     get_signature(os.path.join(dir_post, x)))
+        # Volume vanished while scanning (e.g. renamed after the export)
+        if None in signature:
+            pending.pop(x, None)
+            continue
+        # Restart the settle time on every change of size or modification time
+        if x not in pending or pending[x][0] != signature:
+            pending[x] = (signature, now)
+        if now - pending[x][1] >= settle:
+            del pending[x]
+            done.add(x)
+            stable.append(x)
+    return stable
+
+#-----------------------------------------------------#
+#                     Watch Runner                    #
+#-----------------------------------------------------#
+def run_watch(dir_pre, dir_post, func_batch, func_eval, poll=30.0, settle=60.0,
+              interval=600.0):
+    # Pending volume-pairs (signature, first seen) and already queued pairs
+    pending, done = {}, set()
+    last_eval, updated = float("-inf"), False
+    print("RadTA: Watching " + str(dir_pre) + " and " + str(dir_post) + \
+          " (stop with Ctrl+C)")
+    try:
+        while True:
+            # Segment and process all volume-pairs which became stable
+            names = poll_pairs(dir_pre, dir_post, pending, done, settle)
+            if len(names) > 0:
+                print("RadTA: Found " + str(len(names)) + \
+                      " complete volume-pair(s): " + ", ".join(names))
+                # A failed batch is reported and retried on the next start
+                try:
+                    with stage("watch.batch", pairs=len(names)):
+                        func_batch([Path(os.path.join(dir_pre, x)) for x in names],
+                                   [Path(os.path.join(dir_post, x)) for x in names])
+                except Exception as error:
+                    warnings.warn("RadTA: Processing of volume-pair(s) " + \
+                                  ", ".join(names) + " failed: " + str(error))
+                updated = True
+            # Refresh the cohort evaluation at most once per interval
+            if updated and time.monotonic() - last_eval >= interval:
+                run_watch_eval(func_eval)
+                last_eval, updated = time.monotonic(), False
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        print("RadTA: Watch mode stopped.")
+    # Include the volume-pairs of the last interval in the evaluation
+    if updated : run_watch_eval(func_eval)
+
+def run_watch_eval(func_eval):
+    # A failed evaluation (e.g. no radiomics tables yet) does not stop watching
+    try : func_eval()
+    except Exception as error:
+        warnings.warn("RadTA: Evaluation failed: " + str(error))
\ No newline at end of file
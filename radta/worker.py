@@ -0,0 +1,177 @@
+#==============================================================================#
+#  Author:       Dominik Müller 1, Hannes Ulrich 2                             #
+#  Copyright:    2024                                                          #
+#                1 Research group: Reliable AI-driven Medical Image Analysis,  #
+#                  University of Augsburg, University Hospital Augsburg        #
+#                2 Junior research group: IMPETUS, University Hospital         #
+#                  Schleswig-Holstein                                          #
+#                                                                              #
+#  This program is free software: you can redistribute it and/or modify        #
+#  it under the terms of the GNU General Public License as published by        #
+#  the Free Software Foundation, either version 3 of the License, or           #
+#  (at your option) any later version.                                         #
+#                                                                              #
+#  This program is distributed in the hope that it will be useful,             #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+#  GNU General Public License for more details.                                #
+#                                                                              #
+#  You should have received a copy of the GNU General Public License           #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.       #
+#==============================================================================#
+#-----------------------------------------------------#
+#                   Library imports                   #
+#-----------------------------------------------------#
+import os
+import inspect
+import argparse
+import threading
+import traceback
+from pathlib import Path
+from multiprocessing.connection import Listener, Client
+from instrument import stage
+from cache import enable_volume_cache
+from retention import apply_retention
+
+#-----------------------------------------------------#
+#                  nnU-Net Weight Cache               #
+#-----------------------------------------------------#
+def enable_weight_cache():
+    # Keep loaded nnU-Net networks and weights in memory between BOA calls
+    # (BOA runs TotalSegmentator with its bundled nnU-Net v2, which is only
+    # importable after body_organ_analysis added it to the module path)
+    try:
+        import body_organ_analysis
+        from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+    except ImportError as e:
+        return "off, nnU-Net v2 predictor not found (" + str(e) + ")"
+    if not hasattr(nnUNetPredictor, "manual_initialization"):
+        return "off, nnU-Net v2 predictor without manual initialization"
+    initialize = nnUNetPredictor.initialize_from_trained_model_folder
+    loaded = {}
+
+    def initialize_cached(self, model_training_output_dir, use_folds,
+                          checkpoint_name="checkpoint_final.pth"):
+        key = (str(model_training_output_dir),
+               None if use_folds is None else tuple(use_folds),
+               checkpoint_name)
+        # First use of a model: load from disk and keep a reference
+        if key not in loaded:
+            initialize(self, model_training_output_dir, use_folds, checkpoint_name)
+            loaded[key] = (self.network, self.plans_manager,
+                           self.configuration_manager, self.list_of_parameters,
+                           self.dataset_json, self.trainer_name,
+                           self.allowed_mirroring_axes)
+        # Reuse of a model: initialize predictor from memory
+        else : self.manual_initialization(*loaded[key])
+
+    nnUNetPredictor.initialize_from_trained_model_folder = initialize_cached
+    return "on, " + inspect.getsourcefile(nnUNetPredictor)
+
+#-----------------------------------------------------#
+#                 Segmentation Worker                 #
+#-----------------------------------------------------#
+def serve(path_socket):
+    # Pay import, CUDA and model setup only once for the worker lifetime
+    from boa import run_boa_volume
+    # Report which predictor is cached (or why the cache is inactive)
+    print("RadTA: nnU-Net weight cache " + enable_weight_cache())
+    # Open Unix socket (accessible only for the current user)
+    if os.path.exists(path_socket) : os.remove(path_socket)
+    listener = Listener(str(path_socket), family="AF_UNIX", backlog=64)
+    os.chmod(path_socket, 0o600)
+    print("RadTA: Segmentation worker listening on " + str(path_socket))
+    # Segmentations run one after another, clients wait on the lock
+    lock = threading.Lock()
+    threads = []
+
+    def handle(conn, job):
+        with conn:
+            try:
+                with lock : result = ("ok", run_boa_volume(**job))
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__)
+                result = ("error", e)
+            try : conn.send(result)
+            except (OSError, EOFError) : pass
+
+    # Accept clients until a shutdown request (job None) arrives
+    try:
+        while True:
+            conn = listener.accept()
+            try : job = conn.recv()
+            except EOFError:
+                conn.close()
+                continue
+            if job is None : break
+            thread = threading.Thread(target=handle, args=(conn, job), daemon=True)
+            thread.start()
+            threads = [t for t in threads if t.is_alive()] + [thread]
+        # Finish running and waiting jobs before shutdown
+        for thread in threads : thread.join()
+        conn.send(("ok", None))
+        conn.close()
+    except KeyboardInterrupt : pass
+    finally:
+        listener.close()
+        if os.path.exists(path_socket) : os.remove(path_socket)
+
+#-----------------------------------------------------#
+#                   Worker Client                     #
+#-----------------------------------------------------#
+def submit_volume(vol, path_out_vol, path_cache=None, cache_size=None,
+                  refresh=False, models=None, fast=False, path_socket=None,
+                  retention="all", native=False):
+    # Same interface as run_boa_volume but executed by the segmentation worker
+    if path_socket is None or not os.path.exists(path_socket):
+        raise ValueError("RadTA: Segmentation worker socket does not exist: " + \
+                         str(path_socket))
+    job = {"vol": Path(vol), "path_out_vol": Path(path_out_vol),
+           "path_cache": path_cache, "cache_size": cache_size,
+           "refresh": refresh, "models": models, "fast": fast,
+           "native": native}
+    with stage("segmentation.submit", volume=str(vol)), \
+         Client(str(path_socket), family="AF_UNIX") as conn:
+        conn.send(job)
+        status, result = conn.recv()
+    # Raise errors of the worker in the client
+    if status == "error" : raise result
+    # Prune or archive the masks in the client (the worker segments the next volume)
+    apply_retention(path_out_vol, retention)
+    return result
+
+def shutdown_worker(path_socket):
+    # Ask the segmentation worker to finish after running jobs
+    with Client(str(path_socket), family="AF_UNIX") as conn:
+        conn.send(None)
+        conn.recv()
+
+#-----------------------------------------------------#
+#                  Worker Entry Point                 #
+#-----------------------------------------------------#
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RadTA: Persistent segmentation worker")
+    parser.add_argument("-s", "--socket", 
+                        type=Path,
+                        help="Path to the Unix socket of the worker",
+                        default="/tmp/radta.sock",
+                        dest="path_socket")
+    parser.add_argument("--shutdown", 
+                        action="store_true",
+                        help="Stop a running worker on this socket",
+                        dest="shutdown")
+    parser.add_argument("--volume_cache", 
+                        type=Path,
+                        help="Path to a cache of decompressed volumes (default: disabled)",
+                        default=None,
+                        dest="path_volcache")
+    parser.add_argument("--volume_cache_size", 
+                        type=float,
+                        help="Size limit of the volume cache in GB (LRU eviction)",
+                        default=50.0,
+                        dest="volcache_size")
+    args = parser.parse_args()
+    if args.path_volcache is not None:
+        enable_volume_cache(args.path_volcache, int(args.volcache_size * 1024**3))
+    if args.shutdown : shutdown_worker(args.path_socket)
+    else : serve(args.path_socket)
\ No newline at end of file